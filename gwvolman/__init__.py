@@ -4,6 +4,9 @@ import docker
 from girder_worker import GirderWorkerPluginABC
 from kombu.common import Broadcast, Exchange, Queue
 
+# Seconds between pre-pulls of the most used images (0 disables them)
+IMAGE_PREPULL_INTERVAL = float(os.environ.get("IMAGE_PREPULL_INTERVAL", 3600.0))
+
 
 class GWVolumeManagerPlugin(GirderWorkerPluginABC):
     """Custom WT Manager providing WT tasks."""
@@ -38,13 +41,37 @@ class GWVolumeManagerPlugin(GirderWorkerPluginABC):
                     Exchange("celery", type="direct"),
                     routing_key="celery",
                 ),
+                # Without node ids every worker is expected to manage the Tales
+                Queue("manager", Exchange("manager", type="direct"), routing_key="manager"),
             ]
         queues.append(Broadcast("broadcast_tasks"))
 
-        self.app.conf.task_queues = queues
-        self.app.conf.task_routes = {
-            "gwvolman.tasks.shutdown_container": {"queue": "broadcast_tasks"}
+        routes = {
+            # Only managers can remove services. Girder sends shutdowns without
+            # knowing about nodes, so they can't depend on the sender's environment
+            "gwvolman.tasks.shutdown_container": {"queue": "manager"},
+            # The pool is made of services, so it's managed from a manager too
+            "gwvolman.tasks.maintain_instance_pool": {"queue": "manager"},
+            "gwvolman.tasks.launch_pooled_instances": {"queue": "manager"},
+            "gwvolman.tasks.prepull_images": {"queue": "broadcast_tasks"},
+            "gwvolman.tasks.reap_orphans": {"queue": "broadcast_tasks"},
+            "gwvolman.tasks.detect_idle_instances": {"queue": "broadcast_tasks"},
         }
+        if node_id:
+            # Listing services only works on managers
+            routes["gwvolman.tasks.prepull_popular_images"] = {"queue": "manager"}
+
+        self.app.conf.task_queues = queues
+        self.app.conf.task_routes = routes
+        if IMAGE_PREPULL_INTERVAL > 0:
+            # Used when the worker runs with an embedded beat (-B) or a beat service
+            self.app.conf.beat_schedule = {
+                **(self.app.conf.beat_schedule or {}),
+                "prepull-popular-images": {
+                    "task": "gwvolman.tasks.prepull_popular_images",
+                    "schedule": IMAGE_PREPULL_INTERVAL,
+                },
+            }
         # self.app.config.update({
         #     'TASK_TIME_LIMIT': 300
         # })
@@ -100,7 +100,7 @@ class RunStatus(object):
 
 
 CREATE_VOLUME_STEP_TOTAL = 2
-LAUNCH_CONTAINER_STEP_TOTAL = 2
+LAUNCH_CONTAINER_STEP_TOTAL = 3
 UPDATE_CONTAINER_STEP_TOTAL = 2
 IMPORT_TALE_STEP_TOTAL = 2
 RECORDED_RUN_STEP_TOTAL = 4
@@ -1,32 +1,48 @@
 # Description: Context manager for changing the current working directory
 
 import logging
+import os
+import socket
+import threading
 import time
 import docker
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
 from .constants import GIRDERFS_IMAGE, VOLUMES_ROOT
-from .utils import stop_container
+from .utils import get_docker_client, new_user, stop_container
 
+# Number of idle WT Filesystem containers kept ready on each node (0 disables the pool)
+FS_POOL_SIZE = int(os.environ.get("FS_POOL_SIZE", 0))
+FS_POOL_PREFIX = "wt-fs-pool-"
+FS_POOL_LABEL = "wholetale.fs.pool"
+FS_PORT = 8888
+FS_READY_TIMEOUT = 30.0
 
+# The server is known to be listening by the time we send anything, these are
+# just a safety net.
 retries = Retry(
     connect=5,
-    backoff_factor=0.5,
+    backoff_factor=0.1,
 )
+_pool_lock = threading.Lock()
 
 
 class FSContainer(object):
     @staticmethod
     def start_container(name):
-        cli = docker.from_env()
-        # Create container for handling FUSE mounts
         print("Creating WT Filesystem container...")
+        return FSContainer._run_container(name)
+
+    @staticmethod
+    def _run_container(name, labels=None):
+        cli = get_docker_client()
+        # Create container for handling FUSE mounts
         fscontainer = cli.containers.run(
             image=GIRDERFS_IMAGE,
             name=name,
             detach=True,
-            labels={"traefik.enable": "false"},
+            labels={"traefik.enable": "false", **(labels or {})},
             mounts=[
                 docker.types.Mount(
                     target=VOLUMES_ROOT,
@@ -44,21 +60,97 @@ class FSContainer(object):
             network="wt_celery",
             remove=True,
         )
-        # wait for the container to be up and running
-        # fail after 30s
-        t = 0
+        FSContainer.wait_until_ready(fscontainer)
+        return fscontainer
+
+    @staticmethod
+    def wait_until_ready(container, timeout=FS_READY_TIMEOUT, max_interval=0.5):
+        """Wait until the container's HTTP server accepts connections.
+
+        Polls with a short, exponentially growing interval so that the mount
+        payload can be sent as soon as the server is listening.
+        """
+        deadline = time.time() + timeout
+        interval = 0.02
         while True:
-            time.sleep(1)
             try:
-                fscontainer.reload()
+                container.reload()
             except docker.errors.NotFound:
                 raise Exception("Failed to create WT Filesystem container")
-            if fscontainer.status == "running":
-                break
-            if t > 30 or fscontainer.status == "exited":
+            status = container.status
+            if status == "exited":
                 raise Exception("Failed to create WT Filesystem container")
-            t += 1
-        return fscontainer
+            if status == "running":
+                try:
+                    socket.create_connection(
+                        (container.name, FS_PORT), timeout=max_interval
+                    ).close()
+                    return
+                except OSError:
+                    pass
+            if time.time() > deadline:
+                raise Exception("WT Filesystem container did not start in time")
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    @staticmethod
+    def claim_container(name):
+        """Get a running WT Filesystem container named ``name``.
+
+        If the pool is enabled, an idle container is taken from it by renaming
+        it, which Docker does atomically, so concurrent claims never end up with
+        the same container. Otherwise (or if the pool is empty) a new container
+        is started.
+        """
+        if FS_POOL_SIZE <= 0:
+            return FSContainer.start_container(name)
+
+        cli = get_docker_client()
+        try:
+            for container in FSContainer._pooled_containers(cli):
+                try:
+                    cli.api.rename(container.name, name)
+                except docker.errors.APIError:
+                    continue  # claimed by someone else in the meantime
+                container.reload()
+                print("Using a WT Filesystem container from the pool...")
+                return container
+        finally:
+            FSContainer.replenish_pool()
+        return FSContainer.start_container(name)
+
+    @staticmethod
+    def _pooled_containers(cli):
+        # Claimed containers keep the label, but not the name
+        return cli.containers.list(
+            filters={"label": FS_POOL_LABEL, "name": FS_POOL_PREFIX}
+        )
+
+    @staticmethod
+    def replenish_pool():
+        """Top up (or trim) the pool of idle containers in the background."""
+        if FS_POOL_SIZE > 0:
+            threading.Thread(target=FSContainer.fill_pool, daemon=True).start()
+
+    @staticmethod
+    def fill_pool(size=None):
+        size = FS_POOL_SIZE if size is None else size
+        if not _pool_lock.acquire(blocking=False):
+            return  # Another thread is already on it
+        try:
+            cli = get_docker_client()
+            idle = FSContainer._pooled_containers(cli)
+            for container in idle[size:]:
+                logging.info("Removing pooled WT Filesystem container %s", container.name)
+                stop_container(container)
+            for _ in range(size - len(idle)):
+                name = f"{FS_POOL_PREFIX}{new_user(8).lower()}"
+                logging.info("Adding WT Filesystem container %s to the pool", name)
+                FSContainer._run_container(name, labels={FS_POOL_LABEL: "true"})
+        except Exception as exc:
+            logging.error("Unable to replenish WT Filesystem pool: %s", exc)
+        finally:
+            _pool_lock.release()
 
     @staticmethod
     def mount(container, payload):
@@ -67,7 +159,7 @@ class FSContainer(object):
         with requests.Session() as session:
             session.mount("http://", HTTPAdapter(max_retries=retries))
             response = session.post(
-                f"http://{container.name}:8888/",
+                f"http://{container.name}:{FS_PORT}/",
                 json=payload,
                 headers={"Content-Type": "application/json"},
             )
@@ -76,12 +168,12 @@ class FSContainer(object):
     @staticmethod
     def stop_container(name):
         print("Sending shutdown request to WT Filesystem container...")
-        cli = docker.from_env()
+        cli = get_docker_client()
         try:
             container = cli.containers.get(name)
         except docker.errors.NotFound:
             return
-        resp = requests.delete(f"http://{container.name}:8888/")
+        resp = requests.delete(f"http://{container.name}:{FS_PORT}/")
         try:
             resp.raise_for_status()
         except requests.exceptions.HTTPError:
@@ -0,0 +1,148 @@
+"""Detection of idle Tale instances (Docker Swarm only).
+
+Instances run until someone shuts them down, and an idle one still holds its
+full ``mem_limit``. Every node periodically samples the containers of the
+Tales it runs (see the ``detect_idle_instances`` task). An instance counts as
+active whenever it used more than ``IDLE_CPU_THRESHOLD`` percent of CPU or
+sent/received more than ``IDLE_NETWORK_THRESHOLD`` bytes per second (which
+includes any HTTP traffic to it) since the previous sample.
+
+Environments from the instance pool are started before they belong to an
+instance, so their containers carry a pool label instead; their instances are
+looked up by service name.
+
+Stats are taken with ``one_shot``, so sampling doesn't wait for the daemon to
+measure CPU usage. Usage is computed from the counters of two consecutive
+samples instead, which are kept in a small state file shared by the workers of
+a node.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import docker
+
+from .instance_pool import POOL_LABEL
+from .lib.stats_collector import DockerStatsCollectorThread
+from .utils import get_docker_client
+
+INSTANCE_LABEL = "wholetale.instanceId"
+SERVICE_NAME_LABEL = "com.docker.swarm.service.name"
+# Seconds without activity after which an instance is idle (0 disables detection)
+IDLE_TIMEOUT = float(os.environ.get("IDLE_TIMEOUT", 3600.0))
+IDLE_CPU_THRESHOLD = float(os.environ.get("IDLE_CPU_THRESHOLD", 1.0))
+IDLE_NETWORK_THRESHOLD = float(os.environ.get("IDLE_NETWORK_THRESHOLD", 1024.0))
+# "report" idle instances or "cull" them (through Girder)
+IDLE_ACTION = os.environ.get("IDLE_ACTION", "report")
+IDLE_STATE = os.environ.get(
+    "IDLE_STATE", os.path.join(tempfile.gettempdir(), "gwvolman_idle.json")
+)
+
+_state_lock = threading.Lock()
+
+
+def _network_bytes(stats):
+    return sum(
+        data["rx_bytes"] + data["tx_bytes"] for data in (stats.get("networks") or {}).values()
+    )
+
+
+class IdleDetector:
+    def __init__(
+        self, cli=None, state_path=IDLE_STATE, timeout=IDLE_TIMEOUT, pooled_instances=None
+    ):
+        """``pooled_instances`` maps the service names of claimed pooled
+        environments to their instance ids.
+        """
+        self.cli = cli or get_docker_client()
+        self.state_path = state_path
+        self.timeout = timeout
+        self.pooled_instances = pooled_instances or {}
+
+    def instance_id(self, container):
+        if instance_id := container.labels.get(INSTANCE_LABEL):
+            return instance_id
+        return self.pooled_instances.get(container.labels.get(SERVICE_NAME_LABEL))
+
+    def _load(self):
+        try:
+            with open(self.state_path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state):
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.state_path) or None)
+        with os.fdopen(fd, "w") as fp:
+            json.dump(state, fp)
+        os.replace(path, self.state_path)
+
+    @staticmethod
+    def is_active(previous, sample):
+        """Whether a container did anything between two samples."""
+        elapsed = sample["time"] - previous["time"]
+        if elapsed <= 0:
+            return False
+        cpu = DockerStatsCollectorThread.calculate_cpu_percent(
+            {"cpu_stats": sample["cpu_stats"], "precpu_stats": previous["cpu_stats"]}
+        )
+        network = (sample["network"] - previous["network"]) / elapsed
+        return cpu > IDLE_CPU_THRESHOLD or network > IDLE_NETWORK_THRESHOLD
+
+    def sample(self, container):
+        stats = container.stats(stream=False, one_shot=True)
+        cpu_stats = stats.get("cpu_stats") or {}
+        return {
+            "time": time.time(),
+            "cpu_stats": {
+                "cpu_usage": cpu_stats.get("cpu_usage") or {"total_usage": 0},
+                "system_cpu_usage": cpu_stats.get("system_cpu_usage", 0),
+                "online_cpus": cpu_stats.get("online_cpus"),
+            },
+            "network": _network_bytes(stats),
+        }
+
+    def idle_instances(self):
+        """Sample the Tales on this node, return how long idle ones have been idle.
+
+        Only the containers of services launched with a ``wholetale.instanceId``
+        container label, or of claimed pooled environments, can be attributed
+        to an instance.
+        """
+        containers = [
+            container
+            for label in (INSTANCE_LABEL, POOL_LABEL)
+            for container in self.cli.containers.list(filters={"label": label})
+            if self.instance_id(container)
+        ]
+        samples = {}
+        for container in containers:
+            try:
+                samples[container.id] = self.sample(container)
+            except docker.errors.APIError as exc:
+                logging.warning("Unable to sample %s: %s", container.id, exc)
+
+        idle = {}
+        with _state_lock:
+            state = self._load()
+            for container in containers:
+                previous = state.get(container.id)
+                if (sample := samples.get(container.id)) is None:
+                    if previous is not None:
+                        samples[container.id] = previous
+                    continue
+                if previous is None or self.is_active(previous, sample):
+                    sample["active"] = sample["time"]
+                else:
+                    sample["active"] = previous["active"]
+                instance_id = self.instance_id(container)
+                idle_for = sample["time"] - sample["active"]
+                if self.timeout > 0 and idle_for > self.timeout:
+                    idle[instance_id] = idle_for
+            # Containers that are gone are dropped
+            self._save(samples)
+        return idle
@@ -0,0 +1,165 @@
+"""Per-node cache of Tale images (Docker Swarm only).
+
+Swarm pulls an image only once a service is scheduled on a node, which on a
+cold node can take minutes. Images are pre-pulled onto every node instead
+(see the ``prepull_images`` task), and to keep the disk usage of a node in
+check, Tale images are evicted in least recently used order once they exceed
+``IMAGE_CACHE_BUDGET``.
+
+Docker does not record when an image was last used, so that is tracked in a
+small state file: an image counts as used when it's pulled and whenever it is
+found backing a container.
+"""
+
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+import docker
+
+from .utils import (
+    DEPLOYMENT,
+    REGISTRY_PASS,
+    REGISTRY_USER,
+    get_docker_client,
+    size_notation_to_bytes,
+)
+
+# Disk space Tale images may take on each node (0 disables eviction)
+IMAGE_CACHE_BUDGET = size_notation_to_bytes(os.environ.get("IMAGE_CACHE_BUDGET", "0"))
+IMAGE_CACHE_STATE = os.environ.get(
+    "IMAGE_CACHE_STATE", os.path.join(tempfile.gettempdir(), "gwvolman_image_cache.json")
+)
+# Number of the most used images pre-pulled by prepull_popular_images
+IMAGE_PREPULL_COUNT = int(os.environ.get("IMAGE_PREPULL_COUNT", 10))
+
+_state_lock = threading.Lock()
+
+
+def pull_reference(image):
+    """Turn ``name:tag@digest`` (as stored in imageInfo) into ``name@digest``."""
+    if "@" not in image:
+        return image
+    name, digest = image.split("@", 1)
+    repository, _, tag = name.rpartition(":")
+    if repository and "/" not in tag:
+        name = repository
+    return f"{name}@{digest}"
+
+
+def service_image(service):
+    return service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Image"]
+
+
+def popular_images(cli, count=IMAGE_PREPULL_COUNT):
+    """Images of the running Tales, most used first."""
+    counts = collections.Counter()
+    for service in cli.services.list(filters={"label": "wholetale.instanceId"}):
+        counts[service_image(service)] += 1
+    return [image for image, _ in counts.most_common(count)]
+
+
+class ImageCache:
+    def __init__(self, cli=None, budget=IMAGE_CACHE_BUDGET, state_path=IMAGE_CACHE_STATE):
+        self.cli = cli or get_docker_client()
+        self.budget = budget
+        self.state_path = state_path
+        self.registry = urlparse(DEPLOYMENT.registry_url).netloc
+
+    def _load(self):
+        try:
+            with open(self.state_path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, state):
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.state_path) or None)
+        with os.fdopen(fd, "w") as fp:
+            json.dump(state, fp)
+        os.replace(path, self.state_path)
+
+    def touch(self, *image_ids):
+        with _state_lock:
+            state = self._load()
+            now = time.time()
+            for image_id in image_ids:
+                state[image_id] = now
+            self._save(state)
+
+    def used(self, *images):
+        """Record that containers were just started from ``images`` on this node.
+
+        Images pulled by swarm itself would otherwise look unused to ``evict``.
+        """
+        image_ids = []
+        for image in images:
+            try:
+                image_ids.append(self.cli.images.get(pull_reference(image)).id)
+            except docker.errors.APIError as exc:
+                logging.warning("Unable to find image %s: %s", image, exc)
+        if image_ids:
+            self.touch(*image_ids)
+
+    def pull(self, image):
+        """Pull ``image`` onto this node, return its id or None on failure."""
+        self.cli.login(
+            username=REGISTRY_USER, password=REGISTRY_PASS, registry=DEPLOYMENT.registry_url
+        )
+        try:
+            pulled = self.cli.images.pull(pull_reference(image))
+        except docker.errors.APIError as exc:
+            logging.error("Unable to pre-pull %s: %s", image, exc)
+            return None
+        logging.info("Pre-pulled %s", image)
+        self.touch(pulled.id)
+        return pulled.id
+
+    def is_tale_image(self, image):
+        refs = (image.attrs.get("RepoTags") or []) + (image.attrs.get("RepoDigests") or [])
+        return any(ref.startswith(f"{self.registry}/") for ref in refs)
+
+    def evict(self, keep=()):
+        """Remove least recently used Tale images until they fit in the budget."""
+        if self.budget <= 0:
+            return []
+
+        in_use = {
+            container.attrs["ImageID"]
+            for container in self.cli.containers.list(all=True, sparse=True)
+        }
+        self.touch(*in_use)
+        last_used = self._load()
+
+        images = [image for image in self.cli.images.list() if self.is_tale_image(image)]
+        usage = sum(image.attrs["Size"] for image in images)
+        candidates = sorted(
+            (image for image in images if image.id not in in_use and image.id not in keep),
+            key=lambda image: last_used.get(image.id, 0),
+        )
+
+        removed = []
+        for image in candidates:
+            if usage <= self.budget:
+                break
+            try:
+                self.cli.images.remove(image.id, force=True)
+            except docker.errors.APIError as exc:
+                logging.warning("Unable to evict image %s: %s", image.id, exc)
+                continue
+            logging.info("Evicted image %s", image.id)
+            usage -= image.attrs["Size"]
+            removed.append(image.id)
+
+        if removed:
+            with _state_lock:
+                state = self._load()
+                for image_id in removed:
+                    state.pop(image_id, None)
+                self._save(state)
+        return removed
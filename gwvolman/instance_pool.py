@@ -0,0 +1,362 @@
+"""Pool of pre-launched Tale environments (Docker Swarm only).
+
+Most of the time it takes to launch a Tale is spent pulling its image and
+starting the service, which hurts the most when many people launch the same
+Tale at once (e.g. during a workshop). The pool keeps a few services running
+on each node for the most launched container configs. They are started
+without a route and with their mountpoints bound (with slave propagation) to
+an empty slot directory. Claiming one only requires mounting the WT Filesystem
+into that directory and adding the routing labels, neither of which restarts
+the service.
+
+User specific credentials (``GIRDER_TOKEN``, ``GIRDER_API_KEY``,
+``GIRDER_API_URL``) cannot be added to a running service. Instead, the
+command of a pooled environment waits for them to be written to an env file,
+bind-mounted from the host, once the WT Filesystem is mounted for the user.
+The Tale's server (and everything it starts) is only launched once that
+happened.
+
+Only swarm managers can list, create and update services, so the pool is
+filled and claimed from there, with the ``wholetale.pool.node`` label telling
+which node a pooled service runs on. The slots (the directories mounted into
+the services) and the credentials are set up by the nodes themselves.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shlex
+import tempfile
+import threading
+import uuid
+
+import docker
+from girder_worker.app import app
+
+from .constants import MOUNTPOINTS, VOLUMES_ROOT
+from .scheduler import ready_nodes
+from .utils import (
+    CONTAINER_CONFIG_LABEL,
+    DEPLOYMENT,
+    DOMAIN,
+    REGISTRY_PASS,
+    REGISTRY_USER,
+    ContainerConfig,
+    PooledContainer,
+    _get_container_volumes,
+    _render_command,
+    _safe_mkdir,
+    _get_api_key,
+    _traefik_labels,
+    get_docker_client,
+    new_user,
+)
+
+# Number of idle environments kept per container config on each node (0 disables the pool)
+INSTANCE_POOL_SIZE = int(os.environ.get("INSTANCE_POOL_SIZE", 0))
+# Number of the most launched container configs that get a pool
+INSTANCE_POOL_CONFIGS = int(os.environ.get("INSTANCE_POOL_CONFIGS", 3))
+POOL_LABEL = "wholetale.pool"
+POOL_DIRECTORIES = MOUNTPOINTS + ["home", "workspace"]
+# Credentials of the user a pooled environment is claimed for
+POOL_ENV_ROOT = os.path.join(VOLUMES_ROOT, "pool_env")
+POOL_ENV_TARGET = "/run/wholetale"
+POOL_ENV_FILE = "girder.env"
+
+_pool_lock = threading.Lock()
+
+
+def config_hash(container_config):
+    payload = json.dumps(container_config._asdict(), sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class InstancePool:
+    def __init__(self, cli=None):
+        self.cli = cli or get_docker_client()
+        self.node_id = self.cli.info()["Swarm"]["NodeID"]
+
+    def idle(self, container_config=None, node_id=None):
+        """List idle pooled services (on ``node_id``)."""
+        labels = [f"{POOL_LABEL}.state=idle"]
+        if node_id is not None:
+            labels.insert(0, f"{POOL_LABEL}.node={node_id}")
+        if container_config is not None:
+            labels.append(f"{POOL_LABEL}={config_hash(container_config)}")
+        return self.cli.services.list(filters={"label": labels})
+
+    @staticmethod
+    def _take(service, state, **labels):
+        """Move an idle service to ``state``, return False if someone beat us to it."""
+        labels = {**service.attrs["Spec"]["Labels"], **labels}
+        labels[f"{POOL_LABEL}.state"] = state
+        try:
+            # Updates carry the version of the spec they are based on and
+            # Docker rejects stale ones, so only one concurrent update wins.
+            service.update(labels=labels)
+        except docker.errors.APIError:
+            return False
+        return True
+
+    def claim(self, container_config, instance_id, node_id):
+        """Take an environment matching ``container_config`` on ``node_id`` out of the pool.
+
+        Returns a PooledContainer whose ``path`` is the slot the WT Filesystem
+        has to be mounted in, or None if there is no idle environment. The
+        service is labeled with ``instance_id`` right away, so it's reaped
+        with the instance if that never gets launched.
+        """
+        try:
+            for service in self.idle(container_config, node_id):
+                if self._take(service, "claimed", **{"wholetale.instanceId": instance_id}):
+                    print("Using a Tale environment from the pool...")
+                    return PooledContainer(
+                        id=service.id,
+                        path=service.attrs["Spec"]["Labels"][f"{POOL_LABEL}.volume"],
+                        host=service.name,
+                    )
+        except docker.errors.APIError as exc:
+            logging.warning("Unable to claim a pooled Tale environment: %s", exc)
+        finally:
+            self.replenish()
+        return None
+
+    @staticmethod
+    def set_credentials(slot, gc):
+        """Hand the credentials of ``gc``'s user to the environment in ``slot``."""
+        credentials = {
+            "GIRDER_TOKEN": gc.token,
+            "GIRDER_API_URL": gc.urlBase,
+            "GIRDER_API_KEY": _get_api_key(gc),
+        }
+        env_dir = os.path.join(POOL_ENV_ROOT, slot)
+        fd, path = tempfile.mkstemp(dir=env_dir)
+        with os.fdopen(fd, "w") as fp:
+            for key, value in credentials.items():
+                fp.write(f"{key}={shlex.quote(value)}\n")
+        os.chmod(path, 0o644)
+        # The environment starts as soon as the file shows up, never let it
+        # see a partial one.
+        os.replace(path, os.path.join(env_dir, POOL_ENV_FILE))
+
+    @staticmethod
+    def remove_credentials(slot):
+        env_dir = os.path.join(POOL_ENV_ROOT, slot)
+        try:
+            os.remove(os.path.join(env_dir, POOL_ENV_FILE))
+        except OSError:
+            pass
+        try:
+            os.rmdir(env_dir)
+        except OSError:
+            pass
+
+    @staticmethod
+    def prepare_slot():
+        """Create the directories of a new slot on this node, return its name."""
+        slot = f"pool_{new_user(12).lower()}"
+        # They have to exist before the service starts, so that the WT
+        # Filesystem mounts propagate into it.
+        source_mount = os.path.join(VOLUMES_ROOT, "mountpoints", slot)
+        _safe_mkdir(source_mount)
+        for directory in POOL_DIRECTORIES:
+            _safe_mkdir(os.path.join(source_mount, directory))
+        _safe_mkdir(os.path.join(POOL_ENV_ROOT, slot))
+        return slot
+
+    @staticmethod
+    def release_slot(slot):
+        """Remove the directories of an unused slot on this node."""
+        InstancePool.remove_credentials(slot)
+        source_mount = os.path.join(VOLUMES_ROOT, "mountpoints", slot)
+        for directory in POOL_DIRECTORIES + [""]:
+            try:
+                os.rmdir(os.path.join(source_mount, directory))
+            except OSError:
+                pass
+
+    def activate(self, service_info, container_config):
+        """Route traffic to a claimed environment.
+
+        The Tale in it started as soon as its node got the user's credentials
+        (see ``set_credentials``). Returns the service and its attributes (like
+        _launch_container) or None if the environment can't be used anymore,
+        e.g. the Tale's image changed since it was claimed.
+        """
+        try:
+            service = self.cli.services.get(service_info["pooledService"])
+        except docker.errors.NotFound:
+            return None
+
+        labels = dict(service.attrs["Spec"]["Labels"])
+        if labels.get(POOL_LABEL) != config_hash(container_config):
+            self.remove(service)
+            return None
+
+        labels.update(_traefik_labels(service.name, container_config))
+        labels.update(
+            {
+                f"{POOL_LABEL}.state": "active",
+                "wholetale.instanceId": service_info["instanceId"],
+                "wholetale.taleId": service_info["taleId"],
+            }
+        )
+        service.update(labels=labels)
+        service.reload()
+        url = "https://{host}.{domain}/{path}".format(
+            host=service.name, domain=DOMAIN, path=labels[f"{POOL_LABEL}.urlPath"]
+        )
+        return service, {"url": url}
+
+    def launch(self, container_config, node_id, slot):
+        """Start an idle environment for ``container_config`` in ``slot`` of ``node_id``."""
+        token = uuid.uuid4().hex
+        rendered_command, rendered_url_path = _render_command(container_config, token)
+        host = "tmp-{}".format(new_user(12).lower())
+        logging.info("Adding Tale environment %s on node %s to the pool", host, node_id)
+
+        # Mount the slot's directories before anything is mounted in them, so
+        # that the WT Filesystem mounts propagate into the running service.
+        source_mount = os.path.join(VOLUMES_ROOT, "mountpoints", slot)
+        volumes = _get_container_volumes(source_mount, container_config, POOL_DIRECTORIES)
+        mounts = [
+            docker.types.Mount(
+                type="bind",
+                source=source,
+                target=volumes[source]["bind"],
+                propagation="rslave" if source.startswith(source_mount) else None,
+            )
+            for source in volumes
+        ]
+        env_dir = os.path.join(POOL_ENV_ROOT, slot)
+        mounts.append(
+            docker.types.Mount(
+                type="bind", source=env_dir, target=POOL_ENV_TARGET, read_only=True
+            )
+        )
+        env_file = f"{POOL_ENV_TARGET}/{POOL_ENV_FILE}"
+        command = [
+            "sh",
+            "-c",
+            f"while [ ! -f {env_file} ]; do sleep 0.1; done; "
+            f"set -a; . {env_file}; set +a; exec {rendered_command}",
+        ]
+
+        environment = list(container_config.environment or [])
+        environment.append(f"TMP_URL={host}.{DOMAIN}")
+
+        self.cli.login(
+            username=REGISTRY_USER, password=REGISTRY_PASS, registry=DEPLOYMENT.registry_url
+        )
+        return self.cli.services.create(
+            container_config.image,
+            command=command,
+            labels={
+                "traefik.enable": "false",
+                POOL_LABEL: config_hash(container_config),
+                f"{POOL_LABEL}.node": node_id,
+                f"{POOL_LABEL}.state": "idle",
+                f"{POOL_LABEL}.volume": slot,
+                f"{POOL_LABEL}.urlPath": rendered_url_path,
+                CONTAINER_CONFIG_LABEL: json.dumps(container_config._asdict()),
+            },
+            container_labels={POOL_LABEL: "true"},
+            env=environment,
+            mode=docker.types.ServiceMode("replicated", replicas=1),
+            networks=[DEPLOYMENT.traefik_network],
+            name=host,
+            hosts={f"{host}.{DOMAIN}": "host-gateway"},
+            mounts=mounts,
+            endpoint_spec=docker.types.EndpointSpec(mode="vip"),
+            constraints=[f"node.id == {node_id}"],
+            resources=docker.types.Resources(mem_limit=container_config.mem_limit),
+            restart_policy=docker.types.RestartPolicy(condition="none"),
+        )
+
+    def remove(self, service):
+        service.remove()
+        # Nothing is mounted in the slot of an unused environment
+        labels = service.attrs["Spec"]["Labels"]
+        if slot := labels.get(f"{POOL_LABEL}.volume"):
+            node_id = labels.get(f"{POOL_LABEL}.node", self.node_id)
+            if node_id == self.node_id:
+                self.release_slot(slot)
+            else:
+                app.send_task("gwvolman.tasks.release_pool_slot", args=[slot], queue=node_id)
+
+    def nodes(self):
+        """Nodes that get a pool, all of them if the workers have per-node queues."""
+        if not os.environ.get("SWARM_NODE_ID"):
+            return [self.node_id]
+        return [node.id for node in ready_nodes(self.cli)]
+
+    def grow(self, node_id, container_config, count):
+        """Add ``count`` environments for ``container_config`` to the pool of ``node_id``.
+
+        The node sets up their slots first (``prepare_slot``) and hands them
+        back to the managers (``launch_pooled_instances``).
+        """
+        if node_id == self.node_id:
+            for _ in range(count):
+                self.launch(container_config, node_id, self.prepare_slot())
+            return
+        app.send_task(
+            "gwvolman.tasks.prepare_pool_slots",
+            args=[container_config._asdict(), count],
+            queue=node_id,
+        )
+
+    def popular_configs(self, count=INSTANCE_POOL_CONFIGS):
+        """Container configs of the running Tales, most launched first.
+
+        Only configs with a command can be pooled, as it has to be wrapped to
+        wait for the user's credentials.
+        """
+        counts = collections.Counter()
+        for service in self.cli.services.list(filters={"label": "wholetale.instanceId"}):
+            if config := service.attrs["Spec"]["Labels"].get(CONTAINER_CONFIG_LABEL):
+                if json.loads(config).get("command"):
+                    counts[config] += 1
+        return [
+            ContainerConfig(**json.loads(config))
+            for config, _ in counts.most_common(count)
+        ]
+
+    def replenish(self):
+        """Top up (or trim) the pool in the background."""
+        if INSTANCE_POOL_SIZE > 0:
+            threading.Thread(target=self.fill, daemon=True).start()
+
+    def fill(self, size=None):
+        """Bring the pools of all the nodes in line with current usage (on a manager)."""
+        size = INSTANCE_POOL_SIZE if size is None else size
+        if not _pool_lock.acquire(blocking=False):
+            return  # Another thread is already on it
+        try:
+            configs = {}
+            if size > 0:
+                configs = {config_hash(c): c for c in self.popular_configs()}
+
+            nodes = self.nodes()
+            idle = collections.defaultdict(list)
+            for service in self.idle():
+                labels = service.attrs["Spec"]["Labels"]
+                idle[(labels[f"{POOL_LABEL}.node"], labels[POOL_LABEL])].append(service)
+
+            for (node_id, key), services in idle.items():
+                keep = size if key in configs and node_id in nodes else 0
+                for service in services[keep:]:
+                    if self._take(service, "retired"):
+                        logging.info("Removing pooled Tale environment %s", service.name)
+                        self.remove(service)
+
+            for node_id in nodes:
+                for key, container_config in configs.items():
+                    if (missing := size - len(idle[(node_id, key)])) > 0:
+                        self.grow(node_id, container_config, missing)
+        except Exception as exc:
+            logging.error("Unable to replenish the Tale environment pool: %s", exc)
+        finally:
+            _pool_lock.release()
@@ -0,0 +1,98 @@
+"""Girder client that remembers the responses to repeated GET requests."""
+
+import copy
+import logging
+import os
+import threading
+import time
+
+from girder_client import GirderClient
+
+# Responses are kept for the whole task (the cache is dropped when it ends),
+# loops waiting for Girder to change something use ``get_fresh``
+GIRDER_CACHE_TTL = float(os.environ.get("GIRDER_CACHE_TTL", 300.0))
+
+
+def _resource(path):
+    """'/tale/abc/restore' -> 'tale/abc'"""
+    return "/".join(path.strip("/").split("/")[:2])
+
+
+def get_fresh(gc, path):
+    """GET ``path`` bypassing (and refreshing) the cache of a caching client."""
+    if isinstance(gc, CachingGirderClient):
+        gc.invalidate(path)
+    return gc.get(path)
+
+
+class CachingGirderClient(GirderClient):
+    """GirderClient caching JSON GET responses for ``ttl`` seconds.
+
+    Any other request to a resource (e.g. ``PUT /tale/abc/...``) drops what
+    was cached for that resource (``/tale/abc...``). Cached documents are
+    handed out as copies, so callers are free to modify them.
+    """
+
+    def __init__(self, *args, ttl=GIRDER_CACHE_TTL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._init_get_cache(ttl)
+
+    @classmethod
+    def wrap(cls, client, ttl=GIRDER_CACHE_TTL):
+        """Turn an existing client (with its url, token and session) into a caching one."""
+        wrapped = cls.__new__(cls)
+        wrapped.__dict__.update(client.__dict__)
+        wrapped._init_get_cache(ttl)
+        return wrapped
+
+    def _init_get_cache(self, ttl):
+        self.cache_ttl = ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._get_cache = {}
+        self._get_cache_lock = threading.Lock()
+
+    def invalidate(self, path=None):
+        """Drop cached responses for the resource of ``path`` (or all of them)."""
+        with self._get_cache_lock:
+            if path is None:
+                self._get_cache.clear()
+                return
+            resource = _resource(path)
+            for key in [key for key in self._get_cache if _resource(key[0]) == resource]:
+                del self._get_cache[key]
+
+    def sendRestRequest(self, method, path, parameters=None, data=None, files=None,
+                        json=None, headers=None, jsonResp=True, **kwargs):
+        cacheable = (
+            method.upper() == "GET"
+            and jsonResp
+            and self.cache_ttl > 0
+            and not (data or files or json or headers or kwargs)
+        )
+        if not cacheable:
+            if method.upper() != "GET":
+                self.invalidate(path)
+            return super().sendRestRequest(
+                method, path, parameters=parameters, data=data, files=files,
+                json=json, headers=headers, jsonResp=jsonResp, **kwargs
+            )
+
+        key = (path.strip("/"), repr(sorted((parameters or {}).items())))
+        now = time.monotonic()
+        with self._get_cache_lock:
+            result, expires = self._get_cache.get(key, (None, 0))
+            if expires > now:
+                self.cache_hits += 1
+                return copy.deepcopy(result)
+            self.cache_misses += 1
+
+        result = super().sendRestRequest(method, path, parameters=parameters)
+        with self._get_cache_lock:
+            self._get_cache[key] = (result, now + self.cache_ttl)
+        return copy.deepcopy(result)
+
+    def log_stats(self):
+        logging.info(
+            "Girder GET cache: %d hits, %d misses", self.cache_hits, self.cache_misses
+        )
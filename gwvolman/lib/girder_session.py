@@ -0,0 +1,68 @@
+"""HTTP session shared by all Girder clients of a worker process."""
+
+import http.cookiejar
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+GIRDER_POOL_SIZE = int(os.environ.get("GIRDER_POOL_SIZE", 20))
+GIRDER_RETRIES = int(os.environ.get("GIRDER_RETRIES", 5))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def girder_retries(total=GIRDER_RETRIES):
+    """Retry policy for Girder requests.
+
+    Connection errors are retried for any request (nothing was sent), while
+    read errors and 502/503/504 (e.g. Girder restarting behind traefik) only
+    for GET and HEAD: Girder uses PUT and DELETE for requests that aren't
+    safe to repeat (e.g. ``PUT /tale/:id/build``). Backoff is jittered, so that the requests of all
+    tasks that failed at the same time don't come back at the same time.
+    """
+    return Retry(
+        total=total,
+        connect=total,
+        read=total,
+        status=total,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        raise_on_status=False,
+    )
+
+
+def get_girder_session():
+    """requests.Session: Keep-alive session with pooling and retries, created on first use.
+
+    Tokens are sent with each request (``Girder-Token``) and cookies are never
+    stored, so the session can be shared by clients of different users.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(
+                    max_retries=girder_retries(),
+                    pool_connections=GIRDER_POOL_SIZE,
+                    pool_maxsize=GIRDER_POOL_SIZE,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def _reset_session():
+    global _session
+    _session = None
+
+
+# Connections can't be shared with the pool processes celery forks
+os.register_at_fork(after_in_child=_reset_session)
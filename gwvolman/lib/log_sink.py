@@ -0,0 +1,177 @@
+"""Batched, size-capped forwarding of task output to the Girder job log."""
+
+import collections
+import glob
+import logging
+import os
+import tempfile
+import threading
+import time
+
+JOB_LOG_BATCH_BYTES = int(os.environ.get("JOB_LOG_BATCH_BYTES", 64 * 1024))
+JOB_LOG_BATCH_INTERVAL = float(os.environ.get("JOB_LOG_BATCH_INTERVAL", 2.0))
+JOB_LOG_HEAD_LINES = int(os.environ.get("JOB_LOG_HEAD_LINES", 5000))
+JOB_LOG_TAIL_LINES = int(os.environ.get("JOB_LOG_TAIL_LINES", 1000))
+JOB_LOG_DIR = os.environ.get("JOB_LOG_DIR")
+# Full logs that couldn't be uploaded to Girder are removed after this many seconds
+JOB_LOG_RETENTION = float(os.environ.get("JOB_LOG_RETENTION", 86400.0))
+# Folder in the user's Girder home that full logs of truncated jobs go to
+JOB_LOG_FOLDER = os.environ.get("JOB_LOG_FOLDER", "Logs")
+
+
+class JobLogSink:
+    """Forward output lines to stdout (i.e. the job log) in batches.
+
+    girder_worker turns every write to stdout into a job log update, so lines
+    are accumulated and printed in a single chunk once ``batch_bytes`` have
+    been collected or ``interval`` seconds have passed since the last flush
+    (checked on every write and by a timer, so output preceding a long silent
+    step isn't held back).
+
+    Only the first ``head_lines`` lines are forwarded right away. Later lines
+    are kept in a ring buffer and the last ``tail_lines`` of them are forwarded
+    when the sink is closed. If ``keep_full_log`` is set, every line is also
+    written to a temporary file. When the output got truncated, that file is
+    uploaded to the ``JOB_LOG_FOLDER`` folder of the user ``gc`` belongs to.
+    Files that can't be uploaded stay in ``JOB_LOG_DIR`` for
+    ``JOB_LOG_RETENTION`` seconds.
+    """
+
+    def __init__(
+        self,
+        batch_bytes=JOB_LOG_BATCH_BYTES,
+        interval=JOB_LOG_BATCH_INTERVAL,
+        head_lines=JOB_LOG_HEAD_LINES,
+        tail_lines=JOB_LOG_TAIL_LINES,
+        keep_full_log=True,
+        gc=None,
+    ):
+        self.batch_bytes = batch_bytes
+        self.interval = interval
+        self.head_lines = head_lines
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.keep_full_log = keep_full_log
+        self.gc = gc
+        self.full_log_path = None
+        self.full_log_file = None
+        self.lines = 0
+        self.truncated = 0
+        self._fp = None
+        self._buffer = []
+        self._buffered = 0
+        self._last = time.monotonic()
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._timer = None
+
+    def write(self, line):
+        with self._lock:
+            self.lines += 1
+            if self.keep_full_log:
+                self._write_full_log(line)
+
+            if self.lines <= self.head_lines:
+                self._buffer.append(line)
+                self._buffered += len(line) + 1
+            else:
+                if self.lines == self.head_lines + 1:
+                    self._buffer.append(
+                        f"[Output exceeded {self.head_lines} lines, only the last "
+                        f"{self.tail.maxlen} lines will be shown]"
+                    )
+                if len(self.tail) == self.tail.maxlen:
+                    self.truncated += 1
+                self.tail.append(line)
+            self.flush(force=self._buffered >= self.batch_bytes)
+        if self._timer is None and self.interval > 0:
+            self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._timer.start()
+
+    def flush(self, force=True):
+        """Forward buffered lines, unless the batch is not due yet."""
+        with self._lock:
+            if not force and time.monotonic() - self._last < self.interval:
+                return
+            if self._buffer:
+                print("\n".join(self._buffer), flush=True)
+                self._buffer = []
+                self._buffered = 0
+            self._last = time.monotonic()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.interval):
+            self.flush(force=False)
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+                if self.truncated:
+                    self._upload_full_log()
+                else:
+                    os.remove(self.full_log_path)
+                    self.full_log_path = None
+
+            if self.truncated:
+                msg = f"[... {self.truncated} lines omitted"
+                if self.full_log_file:
+                    msg += f", full log uploaded to {self.full_log_file}"
+                self._buffer.append(msg + " ...]")
+            self._buffer += list(self.tail)
+            self.tail.clear()
+            self.flush()
+
+    def _upload_full_log(self):
+        if self.gc is None:
+            return
+        try:
+            user = self.gc.get("/user/me")
+            folder = self.gc.createFolder(
+                user["_id"], JOB_LOG_FOLDER, parentType="user", public=False, reuseExisting=True
+            )
+            name = os.path.basename(self.full_log_path)
+            self.gc.uploadFileToFolder(folder["_id"], self.full_log_path, filename=name)
+        except Exception as exc:
+            logging.warning("Unable to upload the full log %s: %s", self.full_log_path, exc)
+            return
+        os.remove(self.full_log_path)
+        self.full_log_path = None
+        self.full_log_file = f"{JOB_LOG_FOLDER}/{name}"
+
+    @staticmethod
+    def remove_expired_logs(now=None):
+        """Remove full logs older than ``JOB_LOG_RETENTION``."""
+        now = now or time.time()
+        pattern = os.path.join(JOB_LOG_DIR or tempfile.gettempdir(), "gwvolman-*.log")
+        for path in glob.glob(pattern):
+            try:
+                if now - os.path.getmtime(path) > JOB_LOG_RETENTION:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _write_full_log(self, line):
+        if self._fp is None:
+            self.remove_expired_logs()
+            try:
+                self._fp = tempfile.NamedTemporaryFile(
+                    mode="w",
+                    prefix="gwvolman-",
+                    suffix=".log",
+                    dir=JOB_LOG_DIR,
+                    delete=False,
+                )
+            except OSError as exc:
+                logging.warning("Unable to create a file for the full log: %s", exc)
+                self.keep_full_log = False
+                return
+            self.full_log_path = self._fp.name
+        self._fp.write(line + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -5,9 +5,11 @@ import tempfile
 
 import docker
 
+from ..lib.log_sink import JobLogSink
 from ..utils import (
     DEPLOYMENT,
     DummyTask,
+    get_docker_client,
     stop_container,
 )
 from .builder import ImageBuilderBase
@@ -20,13 +22,11 @@ class DockerHelper:
         username = registry_user or os.environ.get("REGISTRY_USER", "fido")
         password = registry_password or os.environ.get("REGISTRY_PASS")
         registry_url = registry_url or DEPLOYMENT.registry_url
-        self.cli = docker.from_env(version="1.28")
-        self.apicli = docker.APIClient(base_url="unix://var/run/docker.sock")
+        self.cli = get_docker_client()
+        self.apicli = self.cli.api
         if auth:
+            # Both share the same low-level client
             self.cli.login(username=username, password=password, registry=registry_url)
-            self.apicli.login(
-                username=username, password=password, registry=registry_url
-            )
 
 
 class DockerImageBuilder(ImageBuilderBase):
@@ -96,16 +96,17 @@ class DockerImageBuilder(ImageBuilderBase):
 
         # Job output must come from stdout/stderr
         h = hashlib.md5("R2D output".encode())
-        for line in container.logs(stream=True):
-            if task.canceled:
-                task.request.chain = None
-                stop_container(container)
-                break
-            output = line.decode("utf-8").strip()
-            if not output.startswith("Using local repo"):  # contains variable path
-                h.update(output.encode("utf-8"))
-            if not dry_run:  # We don't want to see it.
-                print(output)
+        with JobLogSink(keep_full_log=not dry_run, gc=self.gc) as log:
+            for line in container.logs(stream=True):
+                if task.canceled:
+                    task.request.chain = None
+                    stop_container(container)
+                    break
+                output = line.decode("utf-8").strip()
+                if not output.startswith("Using local repo"):  # contains variable path
+                    h.update(output.encode("utf-8"))
+                if not dry_run:  # We don't want to see it.
+                    log.write(output)
 
         try:
             ret = container.wait()
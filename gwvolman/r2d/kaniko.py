@@ -7,6 +7,7 @@ import time
 from kubernetes import client, config
 
 from ..constants import NAMESPACE, REPO2DOCKER_VERSION
+from ..lib.log_sink import JobLogSink
 from ..utils import (
     DOMAIN,
     DummyTask,
@@ -54,15 +55,16 @@ def get_pod_logs(api_instance, pod_name, container_name, state):
             follow=True,
             _preload_content=False,
         )
-        for line in pod_logs:
-            output = line.decode("utf-8").strip()
-            if not (
-                output.startswith("Using local repo")
-                or output.startswith("[Repo2Docker]")
-            ):
-                state["state"].update(output.encode("utf-8"))
-            if not state["dry_run"]:
-                print(output, end="\n")
+        with JobLogSink(keep_full_log=not state["dry_run"], gc=state.get("gc")) as log:
+            for line in pod_logs:
+                output = line.decode("utf-8").strip()
+                if not (
+                    output.startswith("Using local repo")
+                    or output.startswith("[Repo2Docker]")
+                ):
+                    state["state"].update(output.encode("utf-8"))
+                if not state["dry_run"]:
+                    log.write(output)
     except client.exceptions.ApiException as e:
         if e.status != 404:
             print("Exception when calling CoreV1Api->read_namespaced_pod_log: %s\n" % e)
@@ -224,7 +226,11 @@ class KanikoImageBuilder(ImageBuilderBase):
         try:
             # Print Job logs while waiting
             logging.info("Starting logs thread (dry_run=%s)" % dry_run)
-            state = {"state": hashlib.md5("R2D output".encode()), "dry_run": dry_run}
+            state = {
+                "state": hashlib.md5("R2D output".encode()),
+                "dry_run": dry_run,
+                "gc": self.gc,
+            }
             logging.info("Printing logs (in a thread)")
             pod_thread = threading.Thread(
                 target=get_pod_logs,
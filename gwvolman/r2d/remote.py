@@ -1,13 +1,33 @@
 import json
 import os
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter, Retry
 
 from .builder import ImageBuilderBase
+from ..lib.log_sink import JobLogSink
 from ..utils import DOMAIN
 
+BUILDER_GZIP = os.environ.get("BUILDER_GZIP", "false").lower() in ("1", "true", "yes")
+BUILDER_POOL_SIZE = int(os.environ.get("BUILDER_POOL_SIZE", 10))
+
+retries = Retry(
+    connect=5,
+    backoff_factor=0.5,
+)
+
+
+def _decode(chunk):
+    if isinstance(chunk, bytes):
+        return chunk.decode("utf-8", errors="replace")
+    return str(chunk)
+
 
 class RemoteImageBuilder(ImageBuilderBase):
+    _session = None
+    _session_lock = threading.Lock()
+
     def __init__(
         self,
         gc,
@@ -18,6 +38,7 @@ class RemoteImageBuilder(ImageBuilderBase):
         registry_password=None,
         registry_url=None,
         auth=True,
+        gzip=BUILDER_GZIP,
     ):
         super().__init__(gc, imageId=imageId, tale=tale, auth=auth)
         self.builder_url = builder_url or os.environ.get(
@@ -26,29 +47,50 @@ class RemoteImageBuilder(ImageBuilderBase):
         self.registry_url = registry_url or f"https://registry.{DOMAIN}"
         self.registry_user = registry_user or os.environ.get("REGISTRY_USER", "fido")
         self.registry_password = registry_password or os.environ.get("REGISTRY_PASS")
+        self.gzip = gzip
+
+    @classmethod
+    def session(cls):
+        """requests.Session: Keep-alive session shared by all remote builders."""
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        max_retries=retries,
+                        pool_connections=BUILDER_POOL_SIZE,
+                        pool_maxsize=BUILDER_POOL_SIZE,
+                    )
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    cls._session = session
+        return cls._session
+
+    @property
+    def headers(self):
+        # requests decodes gzip transparently, so all we need to do is to
+        # tell the builder whether it's allowed to compress the stream.
+        return {"Accept-Encoding": "gzip" if self.gzip else "identity"}
 
     def pull_r2d(self):
-        response = requests.put(
+        response = self.session().put(
             f"{self.builder_url}/pull",
             params={
                 "repo2docker_version": self.container_config.repo2docker_version,
             },
+            headers=self.headers,
             stream=True,
         )
-        for chunk in response.iter_lines():  # Adjust chunk size as needed
-            try:
-                msg = json.loads(chunk)
+        with JobLogSink(keep_full_log=False) as log:
+            for chunk in response.iter_lines():
                 try:
-                    print(msg["status"])
-                except KeyError:
-                    raise json.jsonJSONDecodeError
-            except json.JSONDecodeError:
-                print(chunk)
+                    log.write(json.loads(chunk)["status"])
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    log.write(_decode(chunk))
 
     def push_image(self, image):
         """Push image to the registry"""
-        repository, tag = image.split(":", 1)
-        response = requests.put(
+        response = self.session().put(
             f"{self.builder_url}/push",
             params={
                 "image": image,
@@ -56,10 +98,12 @@ class RemoteImageBuilder(ImageBuilderBase):
                 "registry_password": self.registry_password,
                 "registry_url": f"https://registry.{DOMAIN}",
             },
+            headers=self.headers,
             stream=True,
         )
-        for chunk in response.iter_lines():  # Adjust chunk size as needed
-            print(chunk)
+        with JobLogSink(keep_full_log=False) as log:
+            for chunk in response.iter_lines():
+                log.write(_decode(chunk))
 
     def run_r2d(self, tag, dry_run=False, task=None):
         """
@@ -67,7 +111,7 @@ class RemoteImageBuilder(ImageBuilderBase):
         this uses the "local" provider.  Use the same default user-id and
         user-name as BinderHub
         """
-        response = requests.post(
+        response = self.session().post(
             f"{self.builder_url}/build",
             params={
                 "taleId": self.tale["_id"],
@@ -77,20 +121,23 @@ class RemoteImageBuilder(ImageBuilderBase):
                 "dry_run": dry_run,
                 "tag": tag,
             },
+            headers=self.headers,
             stream=True,
         )
-        for chunk in response.iter_lines():
-            try:
-                msg = json.loads(chunk)
+        with JobLogSink(gc=self.gc) as log:
+            for chunk in response.iter_lines():
+                try:
+                    msg = json.loads(chunk)
+                except json.JSONDecodeError:
+                    log.write(_decode(chunk))
+                    continue
                 if "message" in msg:
                     msg = msg["message"]
                     if isinstance(msg, dict) and "error" in msg.keys():
                         return {"StatusCode": 1, "error": msg["error"]}, None
-                    print(msg)
+                    log.write(str(msg))
                 elif "return" in msg:
                     data = msg["return"]
                     return data["ret"], data["digest"]
                 elif "error" in msg:
                     return {"StatusCode": 1, "error": msg["error"]}, None
-            except json.JSONDecodeError:
-                print(chunk)
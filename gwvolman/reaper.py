@@ -0,0 +1,97 @@
+"""Reconciliation of gwvolman's resources with Girder.
+
+Tasks that crash (or workers that get killed) leave Tale services, WT
+Filesystem containers, recorded run containers and image build jobs behind,
+each holding on to memory and FUSE mounts. They are found by listing
+everything gwvolman owns (one call per kind of resource) and comparing it
+with the instances and runs Girder knows about.
+"""
+
+import datetime
+import logging
+import os
+
+from dateutil import parser
+from girder_client import HttpError
+
+from .constants import RunStatus
+
+# Resources younger than this may belong to an instance or a run that Girder
+# doesn't know about yet.
+ORPHAN_GRACE_PERIOD = float(os.environ.get("ORPHAN_GRACE_PERIOD", 900.0))
+ORPHAN_REAP_CONCURRENCY = int(os.environ.get("ORPHAN_REAP_CONCURRENCY", 8))
+RUN_LABEL = "wholetale.runId"
+LIVE_RUN_STATES = {RunStatus.UNKNOWN, RunStatus.STARTING, RunStatus.RUNNING}
+
+
+def is_stale(created, now=None):
+    """Whether a resource created at ``created`` is past the grace period.
+
+    Docker reports creation times as RFC 3339 strings (or a unix timestamp
+    when listing containers), Kubernetes as datetimes.
+    """
+    if isinstance(created, (int, float)):
+        created = datetime.datetime.fromtimestamp(created, datetime.timezone.utc)
+    elif isinstance(created, str):
+        created = parser.isoparse(created)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return (now - created).total_seconds() > ORPHAN_GRACE_PERIOD
+
+
+def live_instances(gc):
+    """All the instances Girder knows about, by id."""
+    user = gc.get("/user/me")
+    if not (user or {}).get("admin"):
+        # Anyone else would only see (and keep) their own instances
+        raise ValueError("Reconciling resources requires an admin token")
+    instances = gc.get("/instance", parameters={"limit": 0})
+    return {instance["_id"]: instance for instance in instances}
+
+
+def live_runs(gc, run_ids, executor):
+    """The ids among ``run_ids`` of recorded runs that are still going on."""
+
+    def is_live(run_id):
+        try:
+            status = gc.get(f"/run/{run_id}/status")["status"]
+        except HttpError as exc:
+            if exc.status in (400, 403, 404):
+                return False  # Not a run (anymore)
+            raise
+        return status in LIVE_RUN_STATES
+
+    run_ids = list(run_ids)
+    return {
+        run_id
+        for run_id, live in zip(run_ids, executor.map(is_live, run_ids))
+        if live
+    }
+
+
+def reap(orphans, executor, dry_run=False):
+    """Remove ``orphans`` concurrently and report on them.
+
+    ``orphans`` is a list of ``(kind, name, remove)`` where ``remove`` is a
+    callable that tears the resource down.
+    """
+    report = [{"type": kind, "name": name} for kind, name, _ in orphans]
+    if dry_run:
+        for entry in report:
+            logging.info("Would remove orphaned %s %s", entry["type"], entry["name"])
+        return report
+
+    def remove(orphan):
+        kind, name, func = orphan
+        logging.info("Removing orphaned %s %s", kind, name)
+        func()
+
+    futures = [executor.submit(remove, orphan) for orphan in orphans]
+    for entry, future in zip(report, futures):
+        try:
+            future.result()
+            entry["removed"] = True
+        except Exception as exc:
+            logging.error("Unable to remove %s %s: %s", entry["type"], entry["name"], exc)
+            entry["removed"] = False
+            entry["error"] = str(exc)
+    return report
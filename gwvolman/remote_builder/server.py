@@ -6,12 +6,16 @@ import tempfile
 
 import docker
 from fastapi import FastAPI, HTTPException, Query
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse
 from girder_client import GirderClient
 
+from ..lib.girder_session import get_girder_session
 from ..r2d.docker import DockerImageBuilder
 
 app = FastAPI()
+# Only used when the client asks for it (see RemoteImageBuilder.gzip)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 client = docker.from_env()
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -70,6 +74,7 @@ async def build_tale(
 ):
     girder_client = GirderClient(apiUrl=apiUrl)
     girder_client.token = token
+    girder_client._session = get_girder_session()
     try:
         tale = girder_client.get("tale/%s" % taleId)
     except Exception:
@@ -0,0 +1,210 @@
+"""Load-aware placement of Tale instances on swarm nodes.
+
+An instance runs on the node whose worker handles its ``create_volume`` task.
+Instead of leaving that to whichever worker consumes the message first, the
+task is re-routed to the queue of the node that fits the Tale best (see
+``select_node``). Only managers can list nodes and services, so a task that
+lands on another node is first passed on to the managers' queue, which makes
+the decision.
+"""
+
+import logging
+import os
+import re
+from collections import namedtuple
+
+import docker
+
+from .utils import get_docker_client
+
+SCHEDULE_INSTANCES = os.environ.get("SCHEDULE_INSTANCES", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+SCHEDULED_HEADER = "wholetale_scheduled"
+MANAGER_QUEUE = "manager"
+# Headers girder_worker needs to keep reporting to the same job
+FORWARDED_HEADERS = [
+    "jobInfoSpec",
+    "girder_client_token",
+    "girder_api_url",
+    "girder_result_hooks",
+    "girder_client_session_kwargs",
+]
+NODE_CONSTRAINT_RE = re.compile(r"node\.id\s*==\s*(\S+)")
+
+NodeLoad = namedtuple("NodeLoad", ["node_id", "memory", "reserved", "instances", "images"])
+
+
+def _service_node(service):
+    labels = service.attrs["Spec"].get("Labels") or {}
+    if node_id := labels.get("wholetale.pool.node"):
+        return node_id
+    placement = service.attrs["Spec"]["TaskTemplate"].get("Placement") or {}
+    for constraint in placement.get("Constraints") or []:
+        if match := NODE_CONSTRAINT_RE.match(constraint):
+            return match.group(1)
+    return None
+
+
+def ready_nodes(cli):
+    """Nodes new Tales can be placed on."""
+    return [
+        node
+        for node in cli.nodes.list()
+        if node.attrs["Status"]["State"] == "ready"
+        and node.attrs["Spec"].get("Availability", "active") == "active"
+    ]
+
+
+def node_loads(cli):
+    """Memory, reserved memory, instances and images of the available nodes."""
+    loads = {}
+    for node in ready_nodes(cli):
+        memory = node.attrs["Description"]["Resources"]["MemoryBytes"]
+        loads[node.id] = NodeLoad(node.id, memory, 0, 0, set())
+
+    # Both running Tales and pooled environments take up memory
+    services = cli.services.list(filters={"label": "wholetale.instanceId"})
+    services += cli.services.list(filters={"label": "wholetale.pool.node"})
+    for service in {service.id: service for service in services}.values():
+        if (node_id := _service_node(service)) not in loads:
+            continue
+        replicated = service.attrs["Spec"].get("Mode", {}).get("Replicated") or {}
+        if replicated.get("Replicas", 1) == 0:
+            continue  # Suspended
+        task_template = service.attrs["Spec"]["TaskTemplate"]
+        limits = (task_template.get("Resources") or {}).get("Limits") or {}
+        load = loads[node_id]
+        load.images.add(task_template["ContainerSpec"]["Image"])
+        loads[node_id] = load._replace(
+            reserved=load.reserved + limits.get("MemoryBytes", 0),
+            instances=load.instances + 1,
+        )
+    return list(loads.values())
+
+
+def _best_node(loads, container_config):
+    mem_limit = container_config.mem_limit or 0
+
+    def free(load):
+        return load.memory - load.reserved
+
+    candidates = [load for load in loads if free(load) >= mem_limit]
+    if not candidates:
+        logging.warning("No node has %s bytes of memory to spare", mem_limit)
+        candidates = [max(loads, key=free)]
+    return min(
+        candidates,
+        key=lambda load: (
+            container_config.image not in load.images,
+            load.instances,
+            -free(load),
+        ),
+    )
+
+
+def select_node(cli, container_config):
+    """Pick the node to run a Tale with ``container_config`` on.
+
+    Nodes with enough unreserved memory for the Tale's ``mem_limit`` are
+    preferred (or the ones with the most free memory if none has enough), then
+    nodes that already run the Tale's image (so it doesn't have to be pulled)
+    and then nodes with fewer instances. Returns None if nothing is known
+    about the nodes. ``cli`` has to be connected to a swarm manager.
+    """
+    loads = node_loads(cli)
+    if not loads:
+        return None
+    return _best_node(loads, container_config).node_id
+
+
+def select_nodes(cli, container_configs):
+    """Pick the nodes for several Tales, like ``select_node``.
+
+    Each Tale is placed as if the ones before it were already running, so
+    that they are spread over the nodes.
+    """
+    loads = node_loads(cli)
+    if not loads:
+        return [None] * len(container_configs)
+    node_ids = []
+    for container_config in container_configs:
+        best = _best_node(loads, container_config)
+        loads[loads.index(best)] = best._replace(
+            reserved=best.reserved + (container_config.mem_limit or 0),
+            instances=best.instances + 1,
+            images=best.images | {container_config.image},
+        )
+        node_ids.append(best.node_id)
+    return node_ids
+
+
+def reroute(task, queue, scheduled=True, **kwargs):
+    """Replace ``task`` with the same call sent to ``queue``.
+
+    Unless ``scheduled`` is False, the new task is marked as moved, so that
+    it isn't moved again. ``kwargs`` are added to the ones of the call.
+    """
+    headers = {
+        key: task.request.get(key)
+        for key in FORWARDED_HEADERS
+        if task.request.get(key) is not None
+    }
+    if scheduled:
+        headers[SCHEDULED_HEADER] = True
+    signature = task.signature(
+        args=task.request.args,
+        kwargs={**(task.request.kwargs or {}), **kwargs},
+        queue=queue,
+        headers=headers,
+    )
+    return task.replace(signature)
+
+
+def _scheduling_client(task):
+    if not SCHEDULE_INSTANCES or task.request.get(SCHEDULED_HEADER):
+        return None
+    if not os.environ.get("SWARM_NODE_ID"):
+        return None  # Workers don't listen on per-node queues
+    return get_docker_client()
+
+
+def schedule(task, container_config, local_node):
+    """Return the node ``task`` should be run on if it's not ``local_node``.
+
+    On nodes that aren't managers this is ``MANAGER_QUEUE``: the task has to
+    be sent there (with ``reroute(..., scheduled=False)``) to be placed.
+    """
+    if (cli := _scheduling_client(task)) is None:
+        return None
+    try:
+        if not cli.info()["Swarm"].get("ControlAvailable", True):
+            return MANAGER_QUEUE
+        node_id = select_node(cli, container_config)
+    except docker.errors.APIError as exc:
+        logging.warning("Unable to schedule the instance, keeping it here: %s", exc)
+        return None
+    if node_id is None or node_id == local_node:
+        return None
+    return node_id
+
+
+def schedule_many(task, container_configs, local_node):
+    """Like ``schedule``, for several Tales.
+
+    Returns ``MANAGER_QUEUE`` if ``task`` has to be placed on a manager, else
+    the node of each Tale (None for ``local_node``).
+    """
+    placement = [None] * len(container_configs)
+    if (cli := _scheduling_client(task)) is None:
+        return placement
+    try:
+        if not cli.info()["Swarm"].get("ControlAvailable", True):
+            return MANAGER_QUEUE
+        node_ids = select_nodes(cli, container_configs)
+    except docker.errors.APIError as exc:
+        logging.warning("Unable to schedule the instances, keeping them here: %s", exc)
+        return placement
+    return [None if node_id == local_node else node_id for node_id in node_ids]
@@ -3,9 +3,13 @@ import logging
 import os
 import time
 
+from celery.signals import task_postrun, task_prerun, worker_ready
+from girder_client import GirderClient
 from girder_worker.app import app
 from girder_worker.utils import girder_job
 
+from .lib.caching_client import CachingGirderClient
+from .lib.girder_session import get_girder_session
 from .r2d import ImageBuilder
 from .tasks_factory import TasksFactory
 
@@ -17,10 +21,33 @@ from .utils import (
 tasks = TasksFactory(os.environ.get("DEPLOYMENT", "docker")).getTasksInstance()
 
 
+@task_prerun.connect
+def cache_girder_requests(task=None, sender=None, **kwargs):
+    """Let tasks reuse responses to their repeated Girder lookups and connections."""
+    if not sender.name.startswith("gwvolman."):
+        return
+    if type(task.girder_client) is GirderClient:
+        task.girder_client = CachingGirderClient.wrap(task.girder_client)
+        task.girder_client._session = get_girder_session()
+
+
+@task_postrun.connect
+def log_girder_cache_stats(task=None, sender=None, **kwargs):
+    """Drop what the task cached, the next task must not see stale documents."""
+    if isinstance(task.girder_client, CachingGirderClient):
+        task.girder_client.log_stats()
+        task.girder_client.invalidate()
+
+
+@worker_ready.connect
+def warm_up(sender=None, **kwargs):
+    tasks.warm_up()
+
+
 @girder_job(title="Create Tale Data Volume")
 @app.task(bind=True)
-def create_volume(task, instance_id, mounts):
-    return tasks.create_volume(task, instance_id, mounts=mounts)
+def create_volume(task, instance_id, mounts, pooled=None):
+    return tasks.create_volume(task, instance_id, mounts=mounts, pooled=pooled)
 
 
 @girder_job(title="Spawn Instance")
@@ -29,6 +56,24 @@ def launch_container(task, service_info):
     return tasks.launch_container(task, service_info)
 
 
+@girder_job(title="Spawn Instances")
+@app.task(bind=True)
+def bulk_launch(task, instanceIds):
+    return tasks.bulk_launch(task, instanceIds)
+
+
+@app.task()
+def create_volumes(volumes):
+    """Set up the WT Filesystems of bulk launched instances on this node."""
+    return tasks.create_volumes(volumes)
+
+
+@app.task()
+def remove_volumes(volumes):
+    """Remove the WT Filesystems of bulk launched instances that failed to start."""
+    return tasks.remove_volumes(volumes)
+
+
 @girder_job(title="Update Instance")
 @app.task(bind=True)
 def update_container(task, instanceId, digest=None):
@@ -41,12 +86,80 @@ def shutdown_container(task, instanceId):
     return tasks.shutdown_container(task, instanceId)
 
 
+@girder_job(title="Suspend Instance")
+@app.task(bind=True)
+def suspend_instance(task, instanceId):
+    return tasks.suspend_instance(task, instanceId)
+
+
+@girder_job(title="Resume Instance")
+@app.task(bind=True)
+def resume_instance(task, instanceId):
+    return tasks.resume_instance(task, instanceId)
+
+
 @girder_job(title="Remove Tale Data Volume")
 @app.task(bind=True)
 def remove_volume(task, instanceId):
     return tasks.remove_volume(task, instanceId)
 
 
+@girder_job(title="Reap Orphaned Resources")
+@app.task(bind=True)
+def reap_orphans(task, dry_run=False):
+    """Remove services, containers and jobs of instances and runs that are gone.
+
+    Meant to be run periodically, with an admin token.
+    """
+    return tasks.reap_orphans(task, dry_run=dry_run)
+
+
+@girder_job(title="Detect Idle Instances")
+@app.task(bind=True)
+def detect_idle_instances(task, cull=None):
+    """Report (or shut down) the instances that have been idle for IDLE_TIMEOUT.
+
+    Meant to be run periodically on every node, with an admin token.
+    """
+    return tasks.detect_idle_instances(task, cull=cull)
+
+
+@app.task()
+def maintain_instance_pool():
+    """Top up or trim the pool of pre-launched Tale environments on each node."""
+    return tasks.maintain_instance_pool()
+
+
+@app.task()
+def prepare_pool_slots(container_config, count):
+    """Set up slots for pooled Tale environments on this node."""
+    return tasks.prepare_pool_slots(container_config, count)
+
+
+@app.task()
+def launch_pooled_instances(node_id, container_config, slots):
+    """Start pooled Tale environments in the slots a node set up."""
+    return tasks.launch_pooled_instances(node_id, container_config, slots)
+
+
+@app.task()
+def release_pool_slot(slot):
+    """Remove the slot of a retired pooled Tale environment on this node."""
+    return tasks.release_pool_slot(slot)
+
+
+@app.task()
+def prepull_images(images):
+    """Pull images onto every node ahead of the Tales that use them."""
+    return tasks.prepull_images(images)
+
+
+@app.task()
+def prepull_popular_images():
+    """Pre-pull the most used images, meant to be run periodically on a manager."""
+    return tasks.prepull_popular_images()
+
+
 @girder_job(title="Build Tale Image")
 @app.task(bind=True)
 def build_tale_image(task, tale_id, force=False):
@@ -6,9 +6,16 @@ from urllib.parse import urlparse
 
 import girder_client
 
-from .constants import BUILD_TALE_IMAGE_STEP_TOTAL, InstanceStatus, TaleStatus
+from .constants import (
+    BUILD_TALE_IMAGE_STEP_TOTAL,
+    LAUNCH_CONTAINER_STEP_TOTAL,
+    InstanceStatus,
+    TaleStatus,
+)
+from .lib.caching_client import get_fresh
 from .lib.zenodo import ZenodoPublishProvider
 from .r2d import ImageBuilder
+from .utils import READINESS_PROBE_TIMEOUT, _wait_for_server
 
 
 class TasksBase:
@@ -18,15 +25,79 @@ class TasksBase:
     def launch_container(self, task, service_info):
         raise NotImplementedError()
 
+    def bulk_launch(self, task, instanceIds):
+        raise NotImplementedError()
+
+    def create_volumes(self, volumes):
+        raise NotImplementedError()
+
+    def remove_volumes(self, volumes):
+        raise NotImplementedError()
+
     def update_container(self, task, instanceId, digest=None):
         raise NotImplementedError()
 
+    def wait_for_instance(self, task, url):
+        """Wait for the server inside of a Tale to respond and report it as progress."""
+        if READINESS_PROBE_TIMEOUT <= 0:
+            return None
+        task.job_manager.updateProgress(
+            message="Waiting for the environment to respond",
+            total=LAUNCH_CONTAINER_STEP_TOTAL,
+            current=2,
+            forceFlush=True,
+        )
+        latency = _wait_for_server(url)
+        if latency is None:
+            print("Environment did not respond in time, it may still be starting.")
+        else:
+            print(f"Environment responded after {latency:.1f}s.")
+        return latency
+
     def shutdown_container(self, task, instanceId):
         raise NotImplementedError()
 
     def remove_volume(self, task, instanceId):
         raise NotImplementedError()
 
+    def suspend_instance(self, task, instanceId):
+        raise NotImplementedError()
+
+    def resume_instance(self, task, instanceId):
+        raise NotImplementedError()
+
+    def reap_orphans(self, task, dry_run=False):
+        raise NotImplementedError()
+
+    def detect_idle_instances(self, task, cull=None):
+        raise NotImplementedError()
+
+    def maintain_instance_pool(self):
+        raise NotImplementedError()
+
+    def prepare_pool_slots(self, container_config, count):
+        raise NotImplementedError()
+
+    def launch_pooled_instances(self, node_id, container_config, slots):
+        raise NotImplementedError()
+
+    def release_pool_slot(self, slot):
+        raise NotImplementedError()
+
+    def warm_up(self):
+        """Get the node ready for its first tasks, once the worker is up."""
+        pass
+
+    def distribute_image(self, image):
+        """Make a freshly pushed image available on the nodes ahead of time."""
+        pass
+
+    def prepull_images(self, images):
+        raise NotImplementedError()
+
+    def prepull_popular_images(self):
+        raise NotImplementedError()
+
     def build_tale_image(self, task, tale_id, force=False):
         """
         Build docker image from Tale workspace using repo2docker and push to Whole Tale registry.
@@ -44,7 +115,7 @@ class TasksBase:
         tale = task.girder_client.get("/tale/%s" % tale_id)
         while tale["status"] != TaleStatus.READY:
             time.sleep(2)
-            tale = task.girder_client.get("/tale/{_id}".format(**tale))
+            tale = get_fresh(task.girder_client, "/tale/{_id}".format(**tale))
             if tale["status"] == TaleStatus.ERROR:
                 raise ValueError("Cannot build image for a Tale in error state.")
             if time.time() - tic > 5 * 60.0:
@@ -122,10 +193,12 @@ class TasksBase:
         logging.info(
             f"Successfully built image {image['name']}:{image['tag']} ({image['digest']})"
         )
+        image_digest = f"{image['name']}:{image['tag']}@{image['digest']}"
+        self.distribute_image(image_digest)
 
         # Image digest used by updateBuildStatus handler
         return {
-            "image_digest": f"{image['name']}:{image['tag']}@{image['digest']}",
+            "image_digest": image_digest,
             "repo2docker_version": image_builder.container_config.repo2docker_version,
             "last_build": build_time,
         }
@@ -283,7 +356,7 @@ class TasksBase:
             while instance["status"] == InstanceStatus.LAUNCHING:
                 # TODO: Timeout? Raise error?
                 time.sleep(1)
-                instance = task.girder_client.get("/instance/{_id}".format(**instance))
+                instance = get_fresh(task.girder_client, "/instance/{_id}".format(**instance))
         else:
             instance = None
 
@@ -1,10 +1,16 @@
+import concurrent.futures
 import docker
-from datetime import datetime, timedelta
+import functools
 import os
+import threading
 import time
 import logging
 import json
 
+from girder_client import GirderClient
+from girder_worker.app import app
+import requests
+
 from .constants import (
     CREATE_VOLUME_STEP_TOTAL,
     LAUNCH_CONTAINER_STEP_TOTAL,
@@ -12,26 +18,138 @@ from .constants import (
     UPDATE_CONTAINER_STEP_TOTAL,
 )
 from .utils import (
+    READINESS_PROBE_TIMEOUT,
+    ContainerConfig,
     new_user,
+    get_docker_client,
     _get_api_key,
+    _invalidate_api_key,
     _get_container_config,
     _launch_container,
     _get_user_and_instance,
     _recorded_run,
+    _wait_for_server,
+    _wait_for_service,
+    _wait_for_services,
+    _wait_for_service_update,
     stop_container,
 )
-from .fs_container import FSContainer
+from .lib.caching_client import get_fresh
+from .fs_container import FS_POOL_PREFIX, FSContainer
+from .idle_detector import IDLE_ACTION, IdleDetector
+from .image_cache import ImageCache, popular_images
+from .instance_pool import INSTANCE_POOL_SIZE, InstancePool
+from .reaper import (
+    ORPHAN_REAP_CONCURRENCY,
+    RUN_LABEL,
+    is_stale,
+    live_instances,
+    live_runs,
+    reap,
+)
+from .scheduler import (
+    MANAGER_QUEUE,
+    reroute,
+    schedule,
+    schedule_many,
+)
 from .tasks_base import TasksBase
-from .constants import GIRDER_API_URL, RunStatus, VOLUMES_ROOT
+from .constants import GIRDERFS_IMAGE, GIRDER_API_URL, RunStatus, VOLUMES_ROOT
 
 from .r2d import DockerImageBuilder
 
+# Instances set up at the same time by bulk_launch
+BULK_LAUNCH_CONCURRENCY = int(os.environ.get("BULK_LAUNCH_CONCURRENCY", 8))
+# Time the nodes get to set up the volumes of a bulk launch
+BULK_LAUNCH_TIMEOUT = float(os.environ.get("BULK_LAUNCH_TIMEOUT", 900.0))
+
+
+def _mount(gc, fs_sidecar, payload):
+    """Mount the WT Filesystem, retrying with a fresh API key if it's rejected."""
+    try:
+        FSContainer.mount(fs_sidecar, payload)
+    except requests.HTTPError as exc:
+        if exc.response is None or exc.response.status_code not in (401, 403):
+            raise
+        logging.warning("API key rejected, retrying with a fresh one")
+        _invalidate_api_key(gc)
+        payload["girderApiKey"] = _get_api_key(gc)
+        FSContainer.mount(fs_sidecar, payload)
+
+
+def _owner_client(gc, user, owner_id):
+    """Girder client and user document of the owner of an instance.
+
+    Admins launch the instances of other users with the key those users
+    launch their Tales with, so that the instances run as their owners.
+    """
+    if owner_id == user["_id"]:
+        return gc, user
+    if not user.get("admin"):
+        raise ValueError("Only admins can launch the instances of other users")
+    owner = gc.get(f"/user/{owner_id}")
+    for key in gc.get("/api_key", parameters={"userId": owner_id}):
+        if key["name"] == "tmpnb" and key["active"]:
+            owner_gc = GirderClient(apiUrl=gc.urlBase)
+            owner_gc.authenticate(apiKey=key["key"])
+            return owner_gc, owner
+    raise ValueError(f"User {owner['login']} has no API key to launch Tales with")
+
+
+def _claim_pooled(cli, tale, container_config, instance_id, node_id):
+    """Claim a pooled environment for an instance on ``node_id``.
+
+    Only managers can claim them, elsewhere (or if there's none left) the
+    instance gets a service of its own.
+    """
+    if INSTANCE_POOL_SIZE <= 0 or "digest" not in tale.get("imageInfo", {}):
+        return None
+    if not cli.info()["Swarm"].get("ControlAvailable", True):
+        return None
+    pooled = InstancePool(cli).claim(container_config, instance_id, node_id)
+    return pooled._asdict() if pooled else None
+
+
+def _remove_instance(service_info, local_node, service=None):
+    """Remove what was set up for an instance that failed to start."""
+    if service is not None:
+        try:
+            service.remove()
+        except docker.errors.APIError as exc:
+            logging.warning("Unable to remove service %s: %s", service.id, exc)
+    if service_info["nodeId"] == local_node:
+        InstancePool.remove_credentials(service_info["volumeName"])
+        FSContainer.stop_container(service_info["fscontainerId"])
+    else:
+        # The WT Filesystem is on the node the instance was placed on
+        app.send_task(
+            "gwvolman.tasks.remove_volumes", args=[[service_info]], queue=service_info["nodeId"]
+        )
+
 
 class DockerTasks(TasksBase):
-    def create_volume(self, task, instance_id, mounts=None):
+    def create_volume(self, task, instance_id, mounts=None, pooled=None):
         """Create a mountpoint and compose WT-fs."""
         user, instance = _get_user_and_instance(task.girder_client, instance_id)
         tale = task.girder_client.get("/tale/{taleId}".format(**instance))
+        cli = get_docker_client()
+        local_node = cli.info()["Swarm"]["NodeID"]
+
+        container_config = None
+        if tale.get("imageId"):
+            container_config = _get_container_config(task.girder_client, tale)
+            # The instance runs where its volume is, so pick a node right away
+            node_id = schedule(task, container_config, local_node)
+            if node_id == MANAGER_QUEUE:
+                return reroute(task, node_id, scheduled=False)
+            if pooled is None and mounts is None:
+                # The volume goes into the slot of the pooled environment
+                pooled = _claim_pooled(
+                    cli, tale, container_config, instance_id, node_id or local_node
+                )
+            if node_id:
+                print(f"Moving the instance to node {node_id}...")
+                return reroute(task, node_id, pooled=pooled)
 
         task.job_manager.updateProgress(
             message="Creating volume",
@@ -40,8 +158,42 @@ class DockerTasks(TasksBase):
             forceFlush=True,
         )
 
-        vol_name = "%s_%s_%s" % (tale["_id"], user["login"], new_user(6))
-        fs_sidecar = FSContainer.start_container(vol_name)
+        service_info = self._create_volume(
+            task.girder_client, user, tale, instance_id, container_config, local_node, mounts,
+            pooled=pooled,
+        )
+        task.job_manager.updateProgress(
+            message="Volume created",
+            total=CREATE_VOLUME_STEP_TOTAL,
+            current=CREATE_VOLUME_STEP_TOTAL,
+            forceFlush=True,
+        )
+        print("WT Filesystem created successfully.")
+        return service_info
+
+    def _create_volume(
+        self, gc, user, tale, instance_id, container_config, local_node, mounts=None,
+        pooled=None, pull=True,
+    ):
+        """Set up the WT Filesystem of an instance on this node.
+
+        ``pooled`` is the environment claimed for the instance (see
+        ``_claim_pooled``), its slot is used as the volume.
+        """
+        prepull = None
+        digest = tale.get("imageInfo", {}).get("digest")
+        if pooled:
+            vol_name = pooled["path"]
+        else:
+            vol_name = "%s_%s_%s" % (tale["_id"], user["login"], new_user(6))
+            if digest and pull:
+                # The Tale will run on this node, pull its image while the
+                # WT Filesystem is being set up.
+                prepull = threading.Thread(
+                    target=ImageCache().pull, args=(digest,), daemon=True
+                )
+                prepull.start()
+        fs_sidecar = FSContainer.claim_container(vol_name)
         if mounts is None:
             mounts = [
                 {
@@ -76,28 +228,31 @@ class DockerTasks(TasksBase):
             "taleId": tale["_id"],
             "userId": user["_id"],
             "girderApiUrl": GIRDER_API_URL,
-            "girderApiKey": _get_api_key(task.girder_client),
-            "girderToken": task.girder_client.token,
+            "girderApiKey": _get_api_key(gc, user),
+            "girderToken": gc.token,
             "root": vol_name,
         }
         print(json.dumps(payload))
-        FSContainer.mount(fs_sidecar, payload)
-        task.job_manager.updateProgress(
-            message="Volume created",
-            total=CREATE_VOLUME_STEP_TOTAL,
-            current=CREATE_VOLUME_STEP_TOTAL,
-            forceFlush=True,
-        )
-        print("WT Filesystem created successfully.")
-
-        cli = docker.from_env()
-        return dict(
-            nodeId=cli.info()["Swarm"]["NodeID"],
+        _mount(gc, fs_sidecar, payload)
+        if pooled:
+            # Starts the Tale in the pooled environment
+            InstancePool.set_credentials(vol_name, gc)
+        if prepull is not None:
+            print("Waiting for the Tale image to be pulled...")
+            prepull.join()
+        elif digest:
+            # The Tale's container is started on this node, but by a manager
+            ImageCache().used(digest)
+        service_info = dict(
+            nodeId=local_node,
             fscontainerId=fs_sidecar.id,
             volumeName=vol_name,
             instanceId=instance_id,
             taleId=tale["_id"],
         )
+        if pooled:
+            service_info["pooledService"] = pooled["id"]
+        return service_info
 
     def launch_container(self, task, service_info):
         """Launch a container using a Tale object."""
@@ -121,7 +276,7 @@ class DockerTasks(TasksBase):
             time_interval = 5
 
             while time.time() - tic < timeout:
-                tale = task.girder_client.get("/tale/{taleId}".format(**instance))
+                tale = get_fresh(task.girder_client, "/tale/{taleId}".format(**instance))
                 if "imageInfo" in tale and "digest" in tale["imageInfo"]:
                     break
                 msg = f"Waiting for image build to complete. ({time_interval}s)"
@@ -130,41 +285,24 @@ class DockerTasks(TasksBase):
                 time.sleep(5)
 
         container_config = _get_container_config(task.girder_client, tale)
-        service, attrs = _launch_container(
-            service_info, container_config, task.girder_client
+        service, attrs = self._start_instance(
+            task.girder_client, service_info, container_config
         )
         print(
             f"Started a container using volume: {service_info['volumeName']} "
             f"on node: {service_info['nodeId']}"
         )
 
-        # wait until task is started
-        tic = time.time()
-        timeout = 300.0
-        started = False
-
         print("Waiting for the environment to be accessible...")
-        while time.time() - tic < timeout:
-            try:
-                status = service.tasks()[0]["Status"]
-
-                if status["State"] in {"failed", "rejected"}:
-                    raise ValueError("Failed to start environment: %s" % status["Err"])
-                elif status["State"] == "running":
-                    started = True
-                    break
-
-            except IndexError:
-                started = False
+        _wait_for_service(service, timeout=300.0)
 
-            time.sleep(0.2)
-
-        if not started:
-            raise ValueError("Tale did not start before timeout exceeded")
+        message = "Container started"
+        if (latency := self.wait_for_instance(task, attrs["url"])) is not None:
+            message += f" (responded after {latency:.1f}s)"
 
         print("Environment is up and running.")
         task.job_manager.updateProgress(
-            message="Container started",
+            message=message,
             total=LAUNCH_CONTAINER_STEP_TOTAL,
             current=LAUNCH_CONTAINER_STEP_TOTAL,
             forceFlush=True,
@@ -174,10 +312,239 @@ class DockerTasks(TasksBase):
         service_info["name"] = service.name
         return service_info
 
+    @staticmethod
+    def _start_instance(gc, service_info, container_config):
+        """Start the service of an instance, from the pool if it got a pooled volume."""
+        if service_info.get("pooledService"):
+            pooled = InstancePool().activate(service_info, container_config)
+            if pooled:
+                return pooled
+            print("Pooled environment is no longer usable, starting a new one...")
+            del service_info["pooledService"]
+        return _launch_container(service_info, container_config, gc)
+
+    def bulk_launch(self, task, instanceIds, concurrency=BULK_LAUNCH_CONCURRENCY):
+        """Create volumes for and launch many instances at once.
+
+        Every instance ties a user (its creator) to a Tale and runs as that
+        user, the caller has to own the instances or be an admin. The instances
+        are spread over the nodes (see ``schedule_many``), each node sets up
+        the volumes of its share (see ``create_volumes``) while the services
+        are started and awaited here, on a manager. Tales, images and API keys
+        are looked up once for all the instances. Returns the service info of
+        every instance or the error that prevented it from starting.
+        """
+        gc = task.girder_client
+        cli = get_docker_client()
+        local_node = cli.info()["Swarm"]["NodeID"]
+        user = gc.get("/user/me")
+
+        results = {instance_id: {"instanceId": instance_id} for instance_id in instanceIds}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            instances = dict(
+                zip(instanceIds, executor.map(lambda i: gc.get(f"/instance/{i}"), instanceIds))
+            )
+            tales = {}
+            for tale_id in {instance["taleId"] for instance in instances.values()}:
+                tale = gc.get(f"/tale/{tale_id}")
+                if "digest" not in tale.get("imageInfo", {}):
+                    continue  # Building images is left to the single launches
+                tales[tale_id] = (tale, _get_container_config(gc, tale))
+            launchable = []
+            for instance_id in instanceIds:
+                if (tale_id := instances[instance_id]["taleId"]) in tales:
+                    launchable.append(instance_id)
+                else:
+                    results[instance_id]["error"] = f"Tale {tale_id} does not have an image yet"
+
+            placement = schedule_many(
+                task, [tales[instances[i]["taleId"]][1] for i in launchable], local_node
+            )
+            if placement == MANAGER_QUEUE:
+                return reroute(task, MANAGER_QUEUE, scheduled=False)
+
+            total = 3 * len(launchable) + 1
+            progress = {"current": 0}
+            progress_lock = threading.Lock()
+
+            def report(message, steps=1):
+                print(message)
+                with progress_lock:
+                    progress["current"] += steps
+                    task.job_manager.updateProgress(
+                        message=message, total=total, current=progress["current"], forceFlush=True
+                    )
+
+            owners = {}
+            for owner_id in {instances[i]["creatorId"] for i in launchable}:
+                try:
+                    owners[owner_id] = _owner_client(gc, user, owner_id)
+                    _get_api_key(*owners[owner_id])  # Once for all of their instances
+                except Exception as exc:
+                    owners[owner_id] = exc
+
+            volumes = {}
+            for instance_id, node_id in zip(launchable, placement):
+                owner = owners[instances[instance_id]["creatorId"]]
+                if isinstance(owner, Exception):
+                    results[instance_id]["error"] = str(owner)
+                    report(f"Instance {instance_id} failed to start", steps=3)
+                    continue
+                owner_gc, owner_user = owner
+                node_id = node_id or local_node
+                tale, container_config = tales[instances[instance_id]["taleId"]]
+                volumes.setdefault(node_id, []).append(
+                    {
+                        "instanceId": instance_id,
+                        "tale": tale,
+                        "containerConfig": container_config._asdict(),
+                        "owner": owner_user,
+                        "girderApiUrl": owner_gc.urlBase,
+                        "girderToken": owner_gc.token,
+                        # Claimed here, as only managers can
+                        "pooled": _claim_pooled(
+                            cli, tale, container_config, instance_id, node_id
+                        ),
+                    }
+                )
+
+            # Volumes are set up on the nodes the instances run on
+            pending = {
+                node_id: app.send_task(
+                    "gwvolman.tasks.create_volumes", args=[node_volumes], queue=node_id
+                )
+                for node_id, node_volumes in volumes.items()
+                if node_id != local_node
+            }
+            created = self.create_volumes(volumes.get(local_node, []), concurrency=concurrency)
+            for node_id, result in pending.items():
+                try:
+                    created += result.get(
+                        timeout=BULK_LAUNCH_TIMEOUT, disable_sync_subtasks=False
+                    )
+                except Exception as exc:
+                    logging.error("Unable to create volumes on node %s: %s", node_id, exc)
+                    created += [
+                        {"instanceId": volume["instanceId"], "error": str(exc)}
+                        for volume in volumes[node_id]
+                    ]
+            for service_info in created:
+                instance_id = service_info["instanceId"]
+                if "error" in service_info:
+                    results[instance_id] = service_info
+                    report(f"Instance {instance_id} failed to start", steps=3)
+                else:
+                    report(f"Volume for instance {instance_id} created")
+
+            def start(service_info):
+                owner_gc, _ = owners[instances[service_info["instanceId"]]["creatorId"]]
+                _, container_config = tales[instances[service_info["instanceId"]]["taleId"]]
+                try:
+                    service, attrs = self._start_instance(
+                        owner_gc, service_info, container_config
+                    )
+                except Exception:
+                    _remove_instance(service_info, local_node)
+                    raise
+                service_info.update(attrs)
+                service_info["name"] = service.name
+                return service, service_info
+
+            launched = {}
+            futures = {
+                executor.submit(start, service_info): service_info["instanceId"]
+                for service_info in created
+                if "error" not in service_info
+            }
+            for future in concurrent.futures.as_completed(futures):
+                instance_id = futures[future]
+                try:
+                    service, results[instance_id] = future.result()
+                    launched[service.id] = (service, instance_id)
+                    report(f"Instance {instance_id} started")
+                except Exception as exc:
+                    logging.error("Unable to launch instance %s: %s", instance_id, exc)
+                    results[instance_id] = {"instanceId": instance_id, "error": str(exc)}
+                    report(f"Instance {instance_id} failed to start", steps=2)
+
+            report(f"Waiting for {len(launched)} environments to be accessible...")
+            statuses = _wait_for_services(
+                [service for service, _ in launched.values()], timeout=300.0
+            )
+            running = []
+            for service_id, status in statuses.items():
+                service, instance_id = launched[service_id]
+                if isinstance(status, Exception):
+                    self._fail_instance(results, instance_id, status, local_node, service)
+                    report(f"Instance {instance_id} failed to start")
+                else:
+                    running.append((service, instance_id))
+
+            def responded(instance_id):
+                if READINESS_PROBE_TIMEOUT <= 0:
+                    return True  # The probe is disabled
+                return _wait_for_server(results[instance_id]["url"]) is not None
+
+            for (service, instance_id), ready in zip(
+                running, executor.map(lambda r: responded(r[1]), running)
+            ):
+                if ready:
+                    report(f"Instance {instance_id} is up and running")
+                    continue
+                error = f"Environment did not respond within {READINESS_PROBE_TIMEOUT:.0f}s"
+                self._fail_instance(results, instance_id, error, local_node, service)
+                report(f"Instance {instance_id} failed to start")
+
+        return [results[instance_id] for instance_id in instanceIds]
+
+    @staticmethod
+    def _fail_instance(results, instance_id, error, local_node, service):
+        """Remove a bulk launched instance that didn't come up and record why."""
+        _remove_instance(results[instance_id], local_node, service)
+        results[instance_id] = {"instanceId": instance_id, "error": str(error)}
+
+    def create_volumes(self, volumes, concurrency=BULK_LAUNCH_CONCURRENCY):
+        """Set up the WT Filesystems of instances bulk launched on this node.
+
+        ``volumes`` are put together by ``bulk_launch``, each comes with the
+        token of the instance's owner. Returns the service info of every
+        instance or the error that prevented its volume from being created.
+        """
+        local_node = get_docker_client().info()["Swarm"]["NodeID"]
+        for digest in {volume["tale"]["imageInfo"]["digest"] for volume in volumes}:
+            ImageCache().pull(digest)
+
+        def create(volume):
+            gc = GirderClient(apiUrl=volume["girderApiUrl"])
+            gc.setToken(volume["girderToken"])
+            try:
+                return self._create_volume(
+                    gc,
+                    volume["owner"],
+                    volume["tale"],
+                    volume["instanceId"],
+                    ContainerConfig(**volume["containerConfig"]),
+                    local_node,
+                    pooled=volume["pooled"],
+                    pull=False,
+                )
+            except Exception as exc:
+                logging.error("Unable to create volume for %s: %s", volume["instanceId"], exc)
+                return {"instanceId": volume["instanceId"], "error": str(exc)}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(create, volumes))
+
+    def remove_volumes(self, volumes):
+        """Remove the WT Filesystems of instances that failed to start on this node."""
+        for service_info in volumes:
+            InstancePool.remove_credentials(service_info["volumeName"])
+            FSContainer.stop_container(service_info["fscontainerId"])
+
     def update_container(self, task, instanceId, digest=None):
         user, instance = _get_user_and_instance(task.girder_client, instanceId)
 
-        cli = docker.from_env(version="1.28")
+        cli = get_docker_client()
         if "containerInfo" not in instance:
             return
         containerInfo = instance["containerInfo"]  # VALIDATE
@@ -210,10 +577,27 @@ class DockerTasks(TasksBase):
             )
             return {"image_digest": digest}
 
+        # Have the image on the node before the old container goes away. Only
+        # managers can update services, so if the Tale runs elsewhere its node
+        # is asked to pull it, and start-first keeps the old container serving
+        # while that (or swarm's own pull) is going on.
+        node_id = containerInfo.get("nodeId")
+        if node_id and node_id != cli.info()["Swarm"]["NodeID"]:
+            if os.environ.get("SWARM_NODE_ID"):
+                try:
+                    app.send_task(
+                        "gwvolman.tasks.prepull_images", args=[[digest]], queue=node_id
+                    )
+                except Exception as exc:
+                    logging.warning("Unable to schedule pre-pull of %s: %s", digest, exc)
+        else:
+            ImageCache().pull(digest)
         try:
             # NOTE: Only "image" passed currently, but this can be easily extended
             logging.info("Restarting container [%s].", service.name)
-            service.update(image=digest)
+            service.update(
+                image=digest, update_config=docker.types.UpdateConfig(order="start-first")
+            )
             logging.info(
                 "Restart command has been sent to Container [%s].", service.name
             )
@@ -222,32 +606,7 @@ class DockerTasks(TasksBase):
                 "Unable to send restart command to container [%s]: %s", service.id, e
             )
 
-        updated = False
-        expired = False
-        timeout = datetime.now() + timedelta(minutes=3)
-        while not (updated or expired or task.canceled):
-            service = cli.services.get(containerInfo["name"])
-
-            try:
-                state = service.attrs["UpdateStatus"]["State"]
-            except KeyError:
-                state = ""
-
-            if state == "paused":
-                raise RuntimeError(
-                    'Restarting the Tale failed with "{}"'.format(
-                        service.attrs["UpdateStatus"]["Message"]
-                    )
-                )
-
-            updated = state == "completed"
-            expired = datetime.now() > timeout
-            time.sleep(1.0)
-
-        if task.canceled:
-            raise RuntimeError("Tale restart cancelled")
-        elif expired:
-            raise RuntimeError("Tale update timed out")
+        _wait_for_service_update(service, canceled=lambda: task.canceled)
 
         task.job_manager.updateProgress(
             message="Tale restarted with the new image",
@@ -258,10 +617,17 @@ class DockerTasks(TasksBase):
         return {"image_digest": digest}
 
     def shutdown_container(self, task, instanceId):
-        """Shutdown a running Tale."""
-        user, instance = _get_user_and_instance(task.girder_client, instanceId)
+        """Shutdown a running Tale.
+
+        It's sent to the managers' queue, as only managers can remove services.
+        """
+        cli = get_docker_client()
+        if not cli.info()["Swarm"].get("ControlAvailable", True):
+            raise RuntimeError(
+                f"Unable to shut down instance {instanceId}, this node isn't a swarm manager"
+            )
 
-        cli = docker.from_env(version="1.28")
+        user, instance = _get_user_and_instance(task.girder_client, instanceId)
         if "containerInfo" not in instance:
             return
         containerInfo = instance["containerInfo"]  # VALIDATE
@@ -278,6 +644,53 @@ class DockerTasks(TasksBase):
         except Exception as e:
             logging.error("Unable to release container [%s]: %s", service.id, e)
 
+    def _get_instance_service(self, task, instanceId):
+        user, instance = _get_user_and_instance(task.girder_client, instanceId)
+        if "containerInfo" not in instance:
+            return None, None
+        containerInfo = instance["containerInfo"]
+        try:
+            return containerInfo, get_docker_client().services.get(containerInfo["name"])
+        except docker.errors.NotFound:
+            logging.info("Service not present [%s].", containerInfo["name"])
+            return containerInfo, None
+
+    def suspend_instance(self, task, instanceId):
+        """Stop a Tale's container, but keep its service and WT Filesystem around."""
+        containerInfo, service = self._get_instance_service(task, instanceId)
+        if service is None:
+            return
+        logging.info("Suspending container [%s].", service.name)
+        service.scale(0)
+        return containerInfo
+
+    def resume_instance(self, task, instanceId):
+        """Start the container of a suspended Tale again."""
+        containerInfo, service = self._get_instance_service(task, instanceId)
+        if service is None:
+            raise RuntimeError("Instance can't be resumed, it has to be launched again")
+
+        task.job_manager.updateProgress(
+            message="Resuming container",
+            total=LAUNCH_CONTAINER_STEP_TOTAL,
+            current=1,
+            forceFlush=True,
+        )
+        logging.info("Resuming container [%s].", service.name)
+        service.scale(1)
+        _wait_for_service(service, timeout=300.0)
+
+        message = "Container resumed"
+        if (latency := self.wait_for_instance(task, containerInfo["url"])) is not None:
+            message += f" (responded after {latency:.1f}s)"
+        task.job_manager.updateProgress(
+            message=message,
+            total=LAUNCH_CONTAINER_STEP_TOTAL,
+            current=LAUNCH_CONTAINER_STEP_TOTAL,
+            forceFlush=True,
+        )
+        return containerInfo
+
     def remove_volume(self, task, instanceId):
         """Unmount WT-fs and remove mountpoint."""
         logging.info("Stopping FS container for instance %s", instanceId)
@@ -287,9 +700,162 @@ class DockerTasks(TasksBase):
             logging.warning("No containerInfo for instance %s", instanceId)
             return
         containerInfo = instance["containerInfo"]  # VALIDATE
+        InstancePool.remove_credentials(containerInfo["volumeName"])
         FSContainer.stop_container(containerInfo["fscontainerId"])
         logging.info("FS container %s stopped", containerInfo["fscontainerId"])
 
+    def reap_orphans(self, task, dry_run=False):
+        """Remove this node's services and containers Girder no longer knows about.
+
+        Tale services are only handled by managers, WT Filesystem and recorded
+        run containers by every node.
+        """
+        instances = live_instances(task.girder_client)
+        volumes = {
+            instance["containerInfo"].get("volumeName")
+            for instance in instances.values()
+            if instance.get("containerInfo")
+        }
+        cli = get_docker_client()
+        orphans = []
+
+        if cli.info()["Swarm"].get("ControlAvailable", True):
+            for service in cli.services.list(filters={"label": "wholetale.instanceId"}):
+                instance_id = service.attrs["Spec"]["Labels"]["wholetale.instanceId"]
+                if instance_id not in instances and is_stale(service.attrs["CreatedAt"]):
+                    orphans.append(("service", service.name, service.remove))
+
+        def name(container):
+            return container.attrs["Names"][0].lstrip("/")
+
+        # Sidecars of instances are named after their volumes, the ones of
+        # recorded runs start with the id of the run.
+        sidecars = [
+            container
+            for container in cli.containers.list(
+                sparse=True, filters={"ancestor": GIRDERFS_IMAGE}
+            )
+            if not name(container).startswith(FS_POOL_PREFIX)
+            and name(container) not in volumes
+            and is_stale(container.attrs["Created"])
+        ]
+        run_containers = [
+            container
+            for container in cli.containers.list(
+                all=True, sparse=True, filters={"name": "rrun-"}
+            )
+            if is_stale(container.attrs["Created"])
+        ]
+
+        def run_id(container):
+            return (container.attrs.get("Labels") or {}).get(RUN_LABEL)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=ORPHAN_REAP_CONCURRENCY
+        ) as executor:
+            run_ids = {name(container).split("_")[0] for container in sidecars}
+            run_ids |= {run_id(container) for container in run_containers if run_id(container)}
+            runs = live_runs(task.girder_client, run_ids, executor)
+
+            for container in sidecars:
+                if name(container).split("_")[0] not in runs:
+                    orphans.append(
+                        (
+                            "WT Filesystem container",
+                            name(container),
+                            functools.partial(FSContainer.stop_container, name(container)),
+                        )
+                    )
+            for container in run_containers:
+                if run_id(container) in runs:
+                    continue
+                if run_id(container) is None and container.attrs["State"] == "running":
+                    continue  # Can't tell whose it is
+                orphans.append(
+                    (
+                        "recorded run container",
+                        name(container),
+                        functools.partial(cli.api.remove_container, container.id, force=True),
+                    )
+                )
+
+            return reap(orphans, executor, dry_run=dry_run)
+
+    def detect_idle_instances(self, task, cull=None):
+        """Find the idle instances on this node and report them or shut them down.
+
+        Idle instances are shut down through Girder (deleting the instance),
+        so that it cleans up after them as usual.
+        """
+        cull = IDLE_ACTION == "cull" if cull is None else cull
+        pooled_instances = {}
+        if INSTANCE_POOL_SIZE > 0:
+            # Pooled containers were started before they had an instance
+            pooled_instances = {
+                instance["containerInfo"]["name"]: instance_id
+                for instance_id, instance in live_instances(task.girder_client).items()
+                if instance.get("containerInfo", {}).get("name")
+            }
+        idle = IdleDetector(pooled_instances=pooled_instances).idle_instances()
+        results = []
+        for instance_id, idle_for in idle.items():
+            logging.info("Instance %s has been idle for %.0fs", instance_id, idle_for)
+            result = {"instanceId": instance_id, "idleFor": idle_for, "culled": False}
+            if cull:
+                try:
+                    task.girder_client.delete(f"/instance/{instance_id}")
+                    result["culled"] = True
+                except Exception as exc:
+                    logging.error("Unable to shut down instance %s: %s", instance_id, exc)
+                    result["error"] = str(exc)
+            results.append(result)
+        return results
+
+    def maintain_instance_pool(self):
+        """Bring the pools of Tale environments in line with current usage."""
+        InstancePool().fill()
+
+    def prepare_pool_slots(self, container_config, count):
+        """Set up slots on this node and have a manager start environments in them."""
+        slots = [InstancePool.prepare_slot() for _ in range(count)]
+        node_id = get_docker_client().info()["Swarm"]["NodeID"]
+        app.send_task(
+            "gwvolman.tasks.launch_pooled_instances", args=[node_id, container_config, slots]
+        )
+        return slots
+
+    def launch_pooled_instances(self, node_id, container_config, slots):
+        pool = InstancePool()
+        for slot in slots:
+            pool.launch(ContainerConfig(**container_config), node_id, slot)
+
+    def release_pool_slot(self, slot):
+        InstancePool.release_slot(slot)
+
+    def warm_up(self):
+        # Otherwise the pool is only filled after the first claim on this node
+        FSContainer.replenish_pool()
+
+    def distribute_image(self, image):
+        try:
+            app.send_task("gwvolman.tasks.prepull_images", args=[[image]])
+        except Exception as exc:
+            logging.warning("Unable to schedule pre-pull of %s: %s", image, exc)
+
+    def prepull_images(self, images):
+        """Pull images onto this node and evict old ones over the budget."""
+        cache = ImageCache()
+        pulled = [image_id for image in images if (image_id := cache.pull(image))]
+        cache.evict(keep=pulled)
+        return pulled
+
+    def prepull_popular_images(self):
+        """Pre-pull the images of the most used Tales onto every node."""
+        images = popular_images(get_docker_client())
+        if images:
+            app.send_task("gwvolman.tasks.prepull_images", args=[images])
+        return images
+
     def recorded_run(self, task, run_id, tale_id, entrypoint):
         """Start a recorded run for a tale version"""
         run = task.girder_client.get(f"/run/{run_id}")
@@ -317,7 +883,7 @@ class DockerTasks(TasksBase):
 
         # Create Docker volume
         vol_name = "%s_%s_%s" % (run_id, user["login"], new_user(6))
-        fs_sidecar = FSContainer.start_container(vol_name)
+        fs_sidecar = FSContainer.claim_container(vol_name)
         payload = {
             "mounts": [
                 {
@@ -332,13 +898,13 @@ class DockerTasks(TasksBase):
                 },
             ],
             "girderApiUrl": GIRDER_API_URL,
-            "girderApiKey": _get_api_key(task.girder_client),
+            "girderApiKey": _get_api_key(task.girder_client, user),
             "root": vol_name,
             "taleId": tale["_id"],
             "runId": run["_id"],
             "userId": user["_id"],
         }
-        FSContainer.mount(fs_sidecar, payload)
+        _mount(task.girder_client, fs_sidecar, payload)
         state.volume_created = vol_name
 
         # Build the image for the run
@@ -407,6 +973,7 @@ class DockerTasks(TasksBase):
                 entrypoint,
                 container_name,
                 task=task,
+                labels={RUN_LABEL: run["_id"]},
             )
             if task.canceled:
                 state.cleanup()
@@ -426,7 +993,7 @@ class DockerTasks(TasksBase):
             state.cleanup(False)
 
     def check_on_run(self, run_state):
-        cli = docker.from_env(version="1.28")
+        cli = get_docker_client()
         try:
             container = cli.containers.get(run_state["container_name"])
             return container.status == "running"
@@ -451,7 +1018,7 @@ class RecordedRunCleaner:
     def __init__(self, run, gc):
         self.gc = gc
         self.run = run
-        self.docker_cli = docker.from_env(version="1.28")
+        self.docker_cli = get_docker_client()
 
     def set_run_status(self, status):
         self.gc.patch(
@@ -1,4 +1,7 @@
+import concurrent.futures
+import functools
 import logging
+import os
 import time
 import uuid
 
@@ -9,7 +12,10 @@ from kubernetes.stream import stream
 from .constants import (
     CREATE_VOLUME_STEP_TOTAL,
     LAUNCH_CONTAINER_STEP_TOTAL,
+    NAMESPACE,
 )
+from .lib.caching_client import get_fresh
+from .reaper import ORPHAN_REAP_CONCURRENCY, is_stale, live_instances, reap
 from .tasks_base import TasksBase
 from .utils import (
     DOMAIN,
@@ -19,7 +25,16 @@ from .utils import (
     _get_container_config,
     _get_api_key,
 )
-from .utils_k8s import tale_deployment, tale_service, tale_ingress
+from .utils_k8s import (
+    DEFAULT_MEMORY_LIMIT,
+    remove_tale_objects,
+    tale_deployment,
+    tale_ingress,
+    tale_service,
+)
+
+# Seconds a Tale's pod gets to start running
+POD_START_TIMEOUT = float(os.environ.get("POD_START_TIMEOUT", 300.0))
 
 
 class KubernetesTasks(TasksBase):
@@ -28,7 +43,7 @@ class KubernetesTasks(TasksBase):
         kubernetes.config.load_incluster_config()
         self.deployment = K8SDeployment()
 
-    def create_volume(self, task, instance_id: str, mounts=None):
+    def create_volume(self, task, instance_id: str, mounts=None, pooled=None):
         user, instance = _get_user_and_instance(task.girder_client, instance_id)
         tale = task.girder_client.get("/tale/{taleId}".format(**instance))
 
@@ -75,37 +90,93 @@ class KubernetesTasks(TasksBase):
     def remove_volume(self, task, instanceId):
         return
 
-    def _wait_for_pod(self, instanceId):
+    @staticmethod
+    def _pod_running(pod, instanceId):
+        if pod.status.phase == "Running":
+            return True
+        elif pod.status.phase == "Failed":
+            raise Exception(
+                "Pod %s failed. Reason: %s, message: %s"
+                % (instanceId, pod.status.reason, pod.status.message)
+            )
+        return False
+
+    @staticmethod
+    def _pod_problem(pod):
+        """Why a pending pod isn't starting (yet), e.g. it can't be scheduled."""
+        for condition in pod.status.conditions or []:
+            if condition.type == "PodScheduled" and condition.status == "False":
+                return f"Waiting for a node: {condition.message or condition.reason}"
+        for status in pod.status.container_statuses or []:
+            waiting = status.state.waiting if status.state else None
+            if waiting and waiting.reason not in (None, "ContainerCreating"):
+                return f"Container {status.name}: {waiting.reason} {waiting.message or ''}".strip()
+        return None
+
+    def _wait_for_pod(self, instanceId, timeout=POD_START_TIMEOUT, task=None):
+        """Wait until the pod of an instance is running.
+
+        Pods with the instance's label are watched (rather than listed every
+        few seconds) until ``timeout`` passes. Problems keeping the pod from
+        starting, like failing image pulls or a lack of resources, are reported
+        as job progress of ``task``.
+        """
         api = kubernetes.client.CoreV1Api()
-        tic = time.time()
-        timeout = 30.0
+        selector = "instanceId=%s" % instanceId
+        deadline = time.time() + timeout
+        reported = None
+
+        def report(pod):
+            nonlocal reported
+            problem = self._pod_problem(pod)
+            if problem and problem != reported:
+                reported = problem
+                logging.info("Pod %s: %s", instanceId, problem)
+                if task is not None:
+                    task.job_manager.updateProgress(
+                        message=problem,
+                        total=LAUNCH_CONTAINER_STEP_TOTAL,
+                        current=1,
+                        forceFlush=True,
+                    )
 
-        # wait until task is started
-        while time.time() - tic < timeout:
-            pods = api.list_namespaced_pod(
-                self.deployment.namespace, label_selector="instanceId=%s" % instanceId
-            )
-            if len(pods.items) == 0:
-                logging.info("_wait_for_pod with instance id %s no match" % instanceId)
-            elif len(pods.items) > 1:
+        while True:
+            pods = api.list_namespaced_pod(self.deployment.namespace, label_selector=selector)
+            # Pods being deleted (e.g. replaced by a rollout) never become ready
+            live = [pod for pod in pods.items if not pod.metadata.deletion_timestamp]
+            if len(live) > 1:
                 logging.error(
                     "_wait_for_pod %s multiple matches; this should not be happening"
                     % instanceId
                 )
-            else:
-                pod = pods.items[0]
-                if pod.status.phase == "Running":
+            for pod in live:
+                if self._pod_running(pod, instanceId):
                     return pod
-                elif pod.status.phase == "Pending":
-                    # Reset deadline
-                    tic = time.time()
-                elif pod.status.phase == "Failed":
-                    raise Exception(
-                        "Pod %s failed. Reason: %s, message: %s"
-                        % (instanceId, pod.status.reason, pod.status.message)
-                    )
-            time.sleep(5)
-        raise Exception("Pod %s startup timed out" % instanceId)
+                report(pod)
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception("Pod %s startup timed out" % instanceId)
+            watch = kubernetes.watch.Watch()
+            try:
+                for event in watch.stream(
+                    api.list_namespaced_pod,
+                    self.deployment.namespace,
+                    label_selector=selector,
+                    resource_version=pods.metadata.resource_version,
+                    timeout_seconds=max(int(remaining), 1),
+                ):
+                    pod = event["object"]
+                    if event["type"] == "DELETED" or pod.metadata.deletion_timestamp:
+                        continue
+                    if self._pod_running(pod, instanceId):
+                        return pod
+                    report(pod)
+            except ApiException as exc:
+                if exc.status != 410:  # Resource version too old, list again
+                    raise
+            finally:
+                watch.stop()
 
     def _render_config(self, container_config):
         token = uuid.uuid4().hex
@@ -149,7 +220,7 @@ class KubernetesTasks(TasksBase):
             time_interval = 5
 
             while time.time() - tic < timeout:
-                tale = task.girder_client.get("/tale/{taleId}".format(**instance))
+                tale = get_fresh(task.girder_client, "/tale/{taleId}".format(**instance))
                 if "imageInfo" in tale and "digest" in tale["imageInfo"]:
                     break
                 msg = f"Waiting for image build to complete. ({time_interval}s)"
@@ -173,7 +244,7 @@ class KubernetesTasks(TasksBase):
             "claimName": K8SDeployment.existing_claim,
             "claimSubPath": K8SDeployment.existing_claim_subpath,
             "girderApiUrl": girder_api_url,
-            "girderApiKey": _get_api_key(task.girder_client),
+            "girderApiKey": _get_api_key(task.girder_client, user),
             "mounterImage": self.deployment.mounter_image,
             "instanceId": instanceId,
             "girderToken": task.girder_client.token,
@@ -182,7 +253,9 @@ class KubernetesTasks(TasksBase):
             "workspaceSubPath": f"workspaces/{tale['_id'][0]}/{tale['_id']}",
         }
 
-        container_config = _get_container_config(task.girder_client, tale)
+        container_config = _get_container_config(
+            task.girder_client, tale, default_mem_limit=DEFAULT_MEMORY_LIMIT
+        )
 
         container_config = self._render_config(container_config)
         self._render_config(container_config)
@@ -192,6 +265,8 @@ class KubernetesTasks(TasksBase):
                 "mountPoint": container_config.target_mount,
                 "instancePort": container_config.container_port,
                 "instanceImage": container_config.image,
+                "memLimit": container_config.mem_limit,
+                "cpuShares": container_config.cpu_shares,
             }
         )
 
@@ -199,7 +274,7 @@ class KubernetesTasks(TasksBase):
         template_params["girderfsDef"] = {
             "mounts": payload["mounts"],
             "girderApiUrl": girder_api_url,
-            "girderApiKey": _get_api_key(task.girder_client),
+            "girderApiKey": template_params["girderApiKey"],
             "girderToken": task.girder_client.token,
             "taleId": tale["_id"],
             "userId": user["_id"],
@@ -207,27 +282,40 @@ class KubernetesTasks(TasksBase):
             "root": "/",
         }
 
-        # create deployment and service
-        tale_deployment(template_params)
+        # create deployment, service and ingress; only the mount has to wait
+        # for the pod, so they are all created at once
+        creates = (tale_deployment, tale_service, tale_ingress)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(create, template_params) for create in creates]
+        failed = [future.exception() for future in futures if future.exception()]
+        if failed:
+            # Don't leave a partial instance behind
+            created = [create for create, future in zip(creates, futures) if not future.exception()]
+            try:
+                remove_tale_objects(template_params, created)
+            except Exception as exc:
+                logging.error("Unable to clean up after a failed launch of %s: %s", instanceId, exc)
+            raise failed[0]
 
         # wait until task is started
-        pod = self._wait_for_pod(instanceId)
+        pod = self._wait_for_pod(instanceId, task=task)
 
         # exec girderfs-mount in mounter container
         self._execute_girderfs(pod, "girderfs-mount")
 
-        tale_service(template_params)
-        tale_ingress(template_params)
+        payload["url"] = f"https://{host}.{DOMAIN}/{container_config.url_path}"
+        message = "Container started"
+        if (latency := self.wait_for_instance(task, payload["url"])) is not None:
+            message += f" (responded after {latency:.1f}s)"
 
         print("Environment is up and running.")
         task.job_manager.updateProgress(
-            message="Container started",
+            message=message,
             total=LAUNCH_CONTAINER_STEP_TOTAL,
             current=LAUNCH_CONTAINER_STEP_TOTAL,
             forceFlush=True,
         )
 
-        payload["url"] = f"https://{host}.{DOMAIN}/{container_config.url_path}"
         payload["name"] = service_name
         return payload
 
@@ -253,6 +341,116 @@ class KubernetesTasks(TasksBase):
                 % e
             )
 
+    def reap_orphans(self, task, dry_run=False):
+        """Remove Tale deployments and image build jobs Girder no longer knows about."""
+        instances = live_instances(task.girder_client)
+        orphans = []
+
+        api = kubernetes.client.AppsV1Api()
+        deployments = api.list_namespaced_deployment(
+            namespace=self.deployment.namespace, label_selector="instanceId"
+        )
+        for deployment in deployments.items:
+            instance_id = deployment.metadata.labels["instanceId"]
+            if instance_id not in instances and is_stale(
+                deployment.metadata.creation_timestamp
+            ):
+                orphans.append(
+                    (
+                        "deployment",
+                        deployment.metadata.name,
+                        functools.partial(self.shutdown_container, task, instance_id),
+                    )
+                )
+
+        # Image builds clean up after themselves, unless their task died
+        batch_api = kubernetes.client.BatchV1Api()
+        core_api = kubernetes.client.CoreV1Api()
+
+        def remove_job(job_name):
+            batch_api.delete_namespaced_job(
+                name=job_name, namespace=NAMESPACE, propagation_policy="Background"
+            )
+            try:
+                core_api.delete_namespaced_config_map(
+                    name=job_name.replace("r2d-job-", "job-configmap-"), namespace=NAMESPACE
+                )
+            except ApiException as exc:
+                if exc.status != 404:
+                    raise
+
+        for job in batch_api.list_namespaced_job(namespace=NAMESPACE).items:
+            if not job.metadata.name.startswith("r2d-job-"):
+                continue
+            finished = job.status.succeeded or job.status.failed
+            if finished and is_stale(job.metadata.creation_timestamp):
+                orphans.append(
+                    (
+                        "build job",
+                        job.metadata.name,
+                        functools.partial(remove_job, job.metadata.name),
+                    )
+                )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=ORPHAN_REAP_CONCURRENCY
+        ) as executor:
+            return reap(orphans, executor, dry_run=dry_run)
+
+    def _scale_deployment(self, instanceId, replicas):
+        api = kubernetes.client.AppsV1Api()
+        deployments = api.list_namespaced_deployment(
+            namespace=self.deployment.namespace,
+            label_selector=f"instanceId={instanceId}",
+        )
+        deployment = self._ensure_one(deployments.items, "deployments", instanceId)
+        if deployment is None:
+            return None
+        api.patch_namespaced_deployment_scale(
+            name=deployment.metadata.name,
+            namespace=self.deployment.namespace,
+            body={"spec": {"replicas": replicas}},
+        )
+        return deployment
+
+    def suspend_instance(self, task, instanceId):
+        """Scale a Tale's deployment to 0, keeping its service and ingress."""
+        logging.info("Suspending container for instance %s" % instanceId)
+        user, instance = _get_user_and_instance(task.girder_client, instanceId)
+        if self._scale_deployment(instanceId, 0) is None:
+            return
+        return instance.get("containerInfo")
+
+    def resume_instance(self, task, instanceId):
+        """Scale a suspended Tale's deployment back to 1."""
+        logging.info("Resuming container for instance %s" % instanceId)
+        user, instance = _get_user_and_instance(task.girder_client, instanceId)
+        task.job_manager.updateProgress(
+            message="Resuming container",
+            total=LAUNCH_CONTAINER_STEP_TOTAL,
+            current=1,
+            forceFlush=True,
+        )
+        if self._scale_deployment(instanceId, 1) is None:
+            raise RuntimeError("Instance can't be resumed, it has to be launched again")
+
+        # The new pod needs the WT Filesystem mounted again
+        pod = self._wait_for_pod(instanceId, task=task)
+        self._execute_girderfs(pod, "girderfs-mount")
+
+        containerInfo = instance.get("containerInfo", {})
+        message = "Container resumed"
+        if containerInfo.get("url"):
+            if (latency := self.wait_for_instance(task, containerInfo["url"])) is not None:
+                message += f" (responded after {latency:.1f}s)"
+        task.job_manager.updateProgress(
+            message=message,
+            total=LAUNCH_CONTAINER_STEP_TOTAL,
+            current=LAUNCH_CONTAINER_STEP_TOTAL,
+            forceFlush=True,
+        )
+        return containerInfo
+
     def shutdown_container(self, task, instanceId):
         """Shutdown a running Tale."""
         logging.info("Shutting down container for instance %s" % instanceId)
@@ -4,6 +4,8 @@
 """A set of helper routines for WT related tasks."""
 
 from collections import namedtuple
+import copy
+import json
 import os
 import queue
 import random
@@ -17,6 +19,7 @@ import uuid
 import logging
 import docker
 import datetime
+import dateutil.parser
 import dateutil.relativedelta as rel
 
 from .constants import (
@@ -27,9 +30,12 @@ from .constants import (
     VOLUMES_ROOT,
     GIRDERFS_IMAGE,
 )
+from .lib.log_sink import JobLogSink
 from .lib.stats_collector import DockerStatsCollectorThread
 
 DOCKER_URL = os.environ.get("DOCKER_URL", "unix://var/run/docker.sock")
+DOCKER_API_VERSION = os.environ.get("DOCKER_API_VERSION", "1.41")
+DOCKER_POOL_SIZE = int(os.environ.get("DOCKER_POOL_SIZE", 10))
 MAX_FILE_SIZE = os.environ.get("MAX_FILE_SIZE", 200)
 DOMAIN = os.environ.get("DOMAIN", "dev.wholetale.org")
 TRAEFIK_ENTRYPOINT = os.environ.get("TRAEFIK_ENTRYPOINT", "websecure")
@@ -37,9 +43,54 @@ REGISTRY_USER = os.environ.get("REGISTRY_USER", "fido")
 REGISTRY_PASS = os.environ.get("REGISTRY_PASS")
 MOUNTS = {}
 RETRIES = 5
+SERVICE_POLL_INTERVAL = float(os.environ.get("SERVICE_POLL_INTERVAL", 5.0))
+DEPLOYMENT_CACHE = os.environ.get(
+    "DEPLOYMENT_CACHE", os.path.join(tempfile.gettempdir(), "wt_deployment.json")
+)
+DEPLOYMENT_REFRESH_INTERVAL = float(os.environ.get("DEPLOYMENT_REFRESH_INTERVAL", 300.0))
+IMAGE_DOC_TTL = float(os.environ.get("IMAGE_DOC_TTL", 300.0))
+API_KEY_CACHE_TTL = float(os.environ.get("API_KEY_CACHE_TTL", 600.0))
+READINESS_PROBE_TIMEOUT = float(os.environ.get("READINESS_PROBE_TIMEOUT", 60.0))
+# Traefik answers with these while the router or the backend is not there yet
+NOT_READY_STATUS_CODES = {404, 502, 503, 504}
+CONTAINER_CONFIG_LABEL = "wholetale.containerConfig"
 container_name_pattern = re.compile(r"tmp\.([^.]+)\.(.+)\Z")
 logger = logging.getLogger(__name__)
 
+_docker_client = None
+_docker_client_lock = threading.Lock()
+_api_keys = {}
+_api_keys_lock = threading.Lock()
+_image_docs = {}
+_image_docs_lock = threading.Lock()
+_deployment_refresher_lock = threading.Lock()
+
+
+def get_docker_client():
+    """Get the docker client shared by the whole worker process.
+
+    The client (and its low-level counterpart, ``.api``) is thread safe and
+    keeps a pool of connections to the daemon, so it's created once, on first
+    use, and reused by all tasks.
+    """
+    global _docker_client
+    if _docker_client is None:
+        with _docker_client_lock:
+            if _docker_client is None:
+                _docker_client = docker.from_env(
+                    version=DOCKER_API_VERSION, max_pool_size=DOCKER_POOL_SIZE
+                )
+    return _docker_client
+
+
+def _reset_docker_client():
+    global _docker_client
+    _docker_client = None
+
+
+# Connections can't be shared with the pool processes celery forks
+os.register_at_fork(after_in_child=_reset_docker_client)
+
 PooledContainer = namedtuple("PooledContainer", ["id", "path", "host"])
 ContainerConfig = namedtuple(
     "ContainerConfig",
@@ -106,6 +157,11 @@ class DockerDeployment(object):
 
     This class allows to read and store configuration of services in a WT
     deployment. It's meant to be used as a singleton across gwvolman.
+
+    Discovered values are shared with the other workers on the node through
+    DEPLOYMENT_CACHE and refreshed in the background every
+    DEPLOYMENT_REFRESH_INTERVAL seconds, so that changes to the stack are
+    picked up without restarting the workers.
     """
 
     __name__ = "DockerDeployment"
@@ -115,55 +171,159 @@ class DockerDeployment(object):
     builder_url = os.environ.get("BUILDER_URL", "https://builder.{DOMAIN}")
     _traefik_network = None
     _tmpdir_mount = None
+    _docker_client = None
+    _cache_loaded = False
+    _refresher = None
+    _DISCOVERED = (
+        "tmpdir_mount",
+        "traefik_network",
+        "dashboard_url",
+        "girder_url",
+        "registry_url",
+    )
 
-    def __init__(self):
-        self.docker_client = docker.from_env(version="1.28")
+    @property
+    def docker_client(self):
+        """docker.DockerClient: The shared client, unless one was set explicitly."""
+        return self._docker_client or get_docker_client()
+
+    @docker_client.setter
+    def docker_client(self, value):
+        self._docker_client = value
+
+    @docker_client.deleter
+    def docker_client(self):
+        self._docker_client = None
+
+    def _discovered(self, name):
+        """Get a value discovered from the stack, from this process, the shared cache or docker."""
+        value = getattr(self, "_" + name)
+        if value is None and not self._cache_loaded:
+            self._cache_loaded = True
+            self.load_cache()
+            value = getattr(self, "_" + name)
+        if value is None:
+            value = getattr(self, "_discover_" + name)()
+            setattr(self, "_" + name, value)
+            self.save_cache()
+        self._start_refresher()
+        return value
+
+    def _cache_age(self):
+        try:
+            return time.time() - os.path.getmtime(DEPLOYMENT_CACHE)
+        except OSError:
+            return None
+
+    def load_cache(self):
+        """Take the values other workers discovered from the shared cache file."""
+        try:
+            with open(DEPLOYMENT_CACHE, "r") as fp:
+                cached = json.load(fp)
+        except (OSError, ValueError):
+            return
+        for name in self._DISCOVERED:
+            if cached.get(name) is not None:
+                setattr(self, "_" + name, cached[name])
+
+    def save_cache(self):
+        values = {name: getattr(self, "_" + name) for name in self._DISCOVERED}
+        tmp_path = "{}.{}".format(DEPLOYMENT_CACHE, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, "w") as fp:
+                json.dump(values, fp)
+            os.replace(tmp_path, DEPLOYMENT_CACHE)
+        except OSError as exc:
+            logger.warning("Unable to write the deployment cache: %s", exc)
+
+    def refresh(self):
+        """Discover everything again, unless another worker just did."""
+        age = self._cache_age()
+        if age is not None and age < DEPLOYMENT_REFRESH_INTERVAL:
+            self.load_cache()
+            return
+        for name in self._DISCOVERED:
+            try:
+                value = getattr(self, "_discover_" + name)()
+            except Exception as exc:
+                logger.warning("Unable to discover the deployment's %s: %s", name, exc)
+                continue
+            old_value = getattr(self, "_" + name)
+            if old_value is not None and old_value != value:
+                logger.warning(
+                    "Deployment's %s changed from %s to %s", name, old_value, value
+                )
+            setattr(self, "_" + name, value)
+        self.save_cache()
+
+    def _start_refresher(self):
+        if DEPLOYMENT_REFRESH_INTERVAL <= 0 or self._refresher is not None:
+            return
+        with _deployment_refresher_lock:
+            if self._refresher is None:
+                age = self._cache_age() or 0.0
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop,
+                    args=(max(DEPLOYMENT_REFRESH_INTERVAL - age, 0.0),),
+                    daemon=True,
+                )
+                self._refresher.start()
+
+    def _refresh_loop(self, delay):
+        while True:
+            time.sleep(delay)
+            try:
+                self.refresh()
+            except Exception as exc:
+                logger.warning("Unable to refresh the deployment: %s", exc)
+            delay = DEPLOYMENT_REFRESH_INTERVAL
 
     @property
     def tmpdir_mount(self):
         """str: Path to the temporary directory used by gwvolman."""
-        if self._tmpdir_mount is None:
-            service = self.docker_client.services.get("wt_celery_worker")
-            tmpdir = tempfile.gettempdir()
-            mounts = service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Mounts"]
-            self._tmpdir_mount = next(
-                (_["Source"] for _ in mounts if _["Target"] == tmpdir), "/tmp"
-            )
-        return self._tmpdir_mount
+        return self._discovered("tmpdir_mount")
+
+    def _discover_tmpdir_mount(self):
+        service = self.docker_client.services.get("wt_celery_worker")
+        tmpdir = tempfile.gettempdir()
+        mounts = service.attrs["Spec"]["TaskTemplate"]["ContainerSpec"]["Mounts"]
+        return next((_["Source"] for _ in mounts if _["Target"] == tmpdir), "/tmp")
 
     @property
     def traefik_network(self):
         """str: Name of the overlay network used by traefik for ingress."""
-        if self._traefik_network is None:
-            try:
-                service = self.docker_client.services.get("wt_dashboard")
-                self._traefik_network = service.attrs["Spec"]["Labels"][
-                    "traefik.docker.network"
-                ]
-            except docker.errors.APIError:
-                self._traefik_network = "wt_traefik-net"  # Default...
-        return self._traefik_network
+        return self._discovered("traefik_network")
+
+    def _discover_traefik_network(self):
+        try:
+            service = self.docker_client.services.get("wt_dashboard")
+            return service.attrs["Spec"]["Labels"]["traefik.docker.network"]
+        except docker.errors.APIError:
+            return "wt_traefik-net"  # Default...
 
     @property
     def dashboard_url(self):
         """str: Dashboard's public url."""
-        if self._dashboard_url is None:
-            self._dashboard_url = self.get_host_from_traefik_rule("wt_dashboard")
-        return self._dashboard_url
+        return self._discovered("dashboard_url")
+
+    def _discover_dashboard_url(self):
+        return self.get_host_from_traefik_rule("wt_dashboard")
 
     @property
     def girder_url(self):
         """str: Girder's public url."""
-        if self._girder_url is None:
-            self._girder_url = self.get_host_from_traefik_rule("wt_girder")
-        return self._girder_url
+        return self._discovered("girder_url")
+
+    def _discover_girder_url(self):
+        return self.get_host_from_traefik_rule("wt_girder")
 
     @property
     def registry_url(self):
         """str: Docker Registry's public url."""
-        if self._registry_url is None:
-            self._registry_url = self.get_host_from_traefik_rule("wt_registry")
-        return self._registry_url
+        return self._discovered("registry_url")
+
+    def _discover_registry_url(self):
+        return self.get_host_from_traefik_rule("wt_registry")
 
     def get_host_from_traefik_rule(self, service_name):
         """Infer service's hostname from traefik frontend rule label.
@@ -187,6 +347,8 @@ if os.environ.get("DEPLOYMENT", "docker") == "k8s":
     DEPLOYMENT = K8SDeployment()
 else:
     DEPLOYMENT = DockerDeployment()
+    # The refresher thread doesn't survive in the pool processes celery forks
+    os.register_at_fork(after_in_child=lambda: setattr(DEPLOYMENT, "_refresher", None))
 logger.warning(f"gwvolman:init: Using {DEPLOYMENT.__name__} as a Deployment backend")
 
 
@@ -210,7 +372,27 @@ def _safe_mkdir(dest):
         pass
 
 
-def _get_api_key(gc):
+def _api_key_cache_key(gc, user=None):
+    if user is None:
+        user = gc.get("/user/me")
+    return getattr(gc, "urlBase", None), user["_id"]
+
+
+def _get_api_key(gc, user=None):
+    """Get (or create) the API key used by the WT Filesystem and Tales.
+
+    Keys are cached per user for API_KEY_CACHE_TTL seconds, as every job
+    comes with a new token. ``user`` is the owner of ``gc``'s token, which is
+    looked up if it isn't given. See _invalidate_api_key if a key gets
+    rejected.
+    """
+    cache_key = _api_key_cache_key(gc, user)
+    now = time.monotonic()
+    with _api_keys_lock:
+        api_key, expires = _api_keys.get(cache_key, (None, 0))
+    if api_key is not None and expires > now:
+        return api_key
+
     api_key = None
     for key in gc.get("/api_key"):
         if key["name"] == "tmpnb" and key["active"]:
@@ -218,9 +400,21 @@ def _get_api_key(gc):
 
     if api_key is None:
         api_key = gc.post("/api_key", data={"name": "tmpnb", "active": True})["key"]
+
+    with _api_keys_lock:
+        for stale in [key for key, (_, expires) in _api_keys.items() if expires <= now]:
+            del _api_keys[stale]
+        _api_keys[cache_key] = (api_key, now + API_KEY_CACHE_TTL)
     return api_key
 
 
+def _invalidate_api_key(gc, user=None):
+    """Forget the cached API key, e.g. after it was rejected."""
+    cache_key = _api_key_cache_key(gc, user)
+    with _api_keys_lock:
+        _api_keys.pop(cache_key, None)
+
+
 def _get_user_and_instance(girder_client, instanceId):
     user = girder_client.get("/user/me")
     if user is None:
@@ -230,11 +424,32 @@ def _get_user_and_instance(girder_client, instanceId):
     return user, instance
 
 
-def _get_container_config(gc, tale):
+def _get_image(gc, image_id):
+    """Get an image document, public ones cached process wide for IMAGE_DOC_TTL seconds.
+
+    Image documents hardly ever change, but they're needed by every launch and
+    build. Girder doesn't send ETags for them, so once the TTL passes the
+    document is simply fetched again. Only public images are cached, as they
+    are handed out regardless of the user asking for them.
+    """
+    cache_key = (getattr(gc, "urlBase", None), image_id)
+    now = time.monotonic()
+    with _image_docs_lock:
+        image, expires = _image_docs.get(cache_key, (None, 0))
+    if image is None or expires <= now:
+        image = gc.get("/image/%s" % image_id)
+        if image.get("public"):
+            with _image_docs_lock:
+                _image_docs[cache_key] = (image, now + IMAGE_DOC_TTL)
+    # Callers modify what they get (e.g. image["config"])
+    return copy.deepcopy(image)
+
+
+def _get_container_config(gc, tale, default_mem_limit=2 * 1024**3):
     if tale is None:
         container_config = {}  # settings['container_config']
     else:
-        image = gc.get("/image/%s" % tale["imageId"])
+        image = _get_image(gc, tale["imageId"])
         tale_config = image["config"] or {}
         if tale.get("config"):
             tale_config.update(tale["config"])
@@ -244,9 +459,9 @@ def _get_container_config(gc, tale):
         repo2docker_version = image_info.get("repo2docker_version", REPO2DOCKER_VERSION)
 
         try:
-            mem_limit = size_notation_to_bytes(tale_config.get("memLimit", "2g"))
+            mem_limit = size_notation_to_bytes(tale_config.get("memLimit", default_mem_limit))
         except (ValueError, TypeError):
-            mem_limit = 2 * 1024**3
+            mem_limit = default_mem_limit
         container_config = ContainerConfig(
             buildpack=tale_config.get("buildpack"),
             repo2docker_version=repo2docker_version,
@@ -264,9 +479,8 @@ def _get_container_config(gc, tale):
     return container_config
 
 
-def _launch_container(volume_info, container_config, gc):
-    token = uuid.uuid4().hex
-    # command
+def _render_command(container_config, token):
+    """Fill in the Tale's command and url path templates."""
     if container_config.command:
         rendered_command = container_config.command.format(
             base_path="",
@@ -281,10 +495,46 @@ def _launch_container(volume_info, container_config, gc):
         rendered_url_path = container_config.url_path.format(token=token)
     else:
         rendered_url_path = ""
+    return rendered_command, rendered_url_path
+
+
+def _traefik_labels(host, container_config):
+    """Service labels routing ``https://{host}.{DOMAIN}`` to the Tale."""
+    # Use the specified CSP for iframes or default to deployed host
+    csp = ""
+    if container_config.csp:
+        csp = container_config.csp
+    else:
+        csp = "frame-ancestors 'self' {}".format(DEPLOYMENT.dashboard_url)
+
+    traefik_loadbalancer_prefix = f"traefik.http.services.{host}.loadbalancer"
+
+    return {
+        f"{traefik_loadbalancer_prefix}.server.port": str(
+            container_config.container_port
+        ),
+        "traefik.enable": "true",
+        "traefik.http.routers.%s.rule" % host: "Host(`{}.{}`)".format(host, DOMAIN),
+        "traefik.http.routers.%s.entrypoints" % host: TRAEFIK_ENTRYPOINT,
+        "traefik.http.routers.%s.tls" % host: "true",
+        (
+            f"traefik.http.middlewares.{host}"
+            "-csp.headers.customresponseheaders.Content-Security-Policy"
+        ): csp,
+        f"{traefik_loadbalancer_prefix}.passhostheader": "true",
+        "traefik.http.routers.%s.middlewares" % host: "girder, %s-csp" % host,
+        "traefik.docker.network": DEPLOYMENT.traefik_network,
+    }
+
+
+def _launch_container(volume_info, container_config, gc):
+    token = uuid.uuid4().hex
+    # command
+    rendered_command, rendered_url_path = _render_command(container_config, token)
 
     logging.info("config = " + str(container_config))
     logging.info("command = " + str(rendered_command))
-    cli = docker.from_env(version="1.28")
+    cli = get_docker_client()
     cli.login(
         username=REGISTRY_USER, password=REGISTRY_PASS, registry=DEPLOYMENT.registry_url
     )
@@ -295,8 +545,9 @@ def _launch_container(volume_info, container_config, gc):
     #                        target=container_config.target_mount)
     # ]
 
-    # inject Girder token into the container
-    environment = container_config.environment or []
+    # inject Girder token into the container (without touching the config,
+    # which is recorded on the service below)
+    environment = list(container_config.environment or [])
     environment += [
         f"GIRDER_TOKEN={gc.token}",
         f"GIRDER_API_URL={gc.urlBase}",
@@ -329,38 +580,20 @@ def _launch_container(volume_info, container_config, gc):
     # https://github.com/containous/traefik/issues/2582#issuecomment-354107053
     endpoint_spec = docker.types.EndpointSpec(mode="vip")
 
-    # Use the specified CSP for iframes or default to deployed host
-    csp = ""
-    if container_config.csp:
-        csp = container_config.csp
-    else:
-        csp = "frame-ancestors 'self' {}".format(DEPLOYMENT.dashboard_url)
-
-    traefik_loadbalancer_prefix = f"traefik.http.services.{host}.loadbalancer"
-
     fqdn = f"{host}.{DOMAIN}"
 
     service = cli.services.create(
         container_config.image,
         command=rendered_command,
         labels={
-            f"{traefik_loadbalancer_prefix}.server.port": str(
-                container_config.container_port
-            ),
-            "traefik.enable": "true",
-            "traefik.http.routers.%s.rule" % host: "Host(`{}.{}`)".format(host, DOMAIN),
-            "traefik.http.routers.%s.entrypoints" % host: TRAEFIK_ENTRYPOINT,
-            "traefik.http.routers.%s.tls" % host: "true",
-            (
-                f"traefik.http.middlewares.{host}"
-                "-csp.headers.customresponseheaders.Content-Security-Policy"
-            ): csp,
-            f"{traefik_loadbalancer_prefix}.passhostheader": "true",
-            "traefik.http.routers.%s.middlewares" % host: "girder, %s-csp" % host,
-            "traefik.docker.network": DEPLOYMENT.traefik_network,
+            **_traefik_labels(host, container_config),
             "wholetale.instanceId": volume_info["instanceId"],
             "wholetale.taleId": volume_info["taleId"],
+            # Lets the instance pool find out which configs are popular
+            CONTAINER_CONFIG_LABEL: json.dumps(container_config._asdict()),
         },
+        # Lets the nodes find their Tales' containers (e.g. to detect idle ones)
+        container_labels={"wholetale.instanceId": volume_info["instanceId"]},
         env=environment,
         mode=docker.types.ServiceMode("replicated", replicas=1),
         networks=[DEPLOYMENT.traefik_network],
@@ -373,10 +606,8 @@ def _launch_container(volume_info, container_config, gc):
         restart_policy=docker.types.RestartPolicy(condition="none"),
     )
 
-    # Wait for the server to launch within the container before adding it
-    # to the pool or serving it to a user.
-    # _wait_for_server(host_ip, host_port, path) # FIXME
-
+    # NOTE: the caller is expected to _wait_for_server(url) once the service
+    # is running, before serving the url to a user.
     url = "{proto}://{host}.{domain}/{path}".format(
         proto="https", host=host, domain=DOMAIN, path=rendered_url_path
     )
@@ -384,6 +615,178 @@ def _launch_container(volume_info, container_config, gc):
     return service, {"url": url}
 
 
+def _wait_for_docker_event(cli, filters, until, since=None):
+    """Block until an event matching ``filters`` shows up or ``until`` passes.
+
+    Returns True if an event was received. Events older than ``since`` (which
+    defaults to now) are skipped, as the daemon may return events from
+    earlier in the same second.
+    """
+    since = since or time.time()
+    events = cli.events(
+        since=f"{since:.9f}", until=int(until) + 1, filters=filters, decode=True
+    )
+    try:
+        for event in events:
+            if event.get("timeNano", float("inf")) >= since * 1e9:
+                return True
+    except docker.errors.APIError as exc:
+        logger.warning("Unable to follow docker events: %s", exc)
+        # Don't spin if the daemon refuses to stream events
+        time.sleep(max(0, min(until - time.time(), SERVICE_POLL_INTERVAL)))
+    finally:
+        events.close()
+    return False
+
+
+def _get_service_task_status(service):
+    """Status of the newest task of a service.
+
+    Tasks of the container that was stopped before (e.g. by suspending the
+    instance) are listed too, in no particular order.
+    """
+    tasks = service.tasks()
+    if not tasks:
+        return None
+    newest = max(tasks, key=lambda task: dateutil.parser.isoparse(task["CreatedAt"]))
+    return newest["Status"]
+
+
+def _wait_for_service(service, timeout=300.0):
+    """Wait until the (single) task of a swarm service is running.
+
+    Instead of polling ``service.tasks()`` in a tight loop, follow the docker
+    events stream of the service's containers and only look at the task again
+    when something happened. Container events are only visible on the node
+    running the task, so the state is also re-checked every
+    SERVICE_POLL_INTERVAL seconds as a fallback.
+    """
+    filters = {
+        "type": "container",
+        "label": f"com.docker.swarm.service.id={service.id}",
+    }
+    deadline = time.time() + timeout
+    while True:
+        checked = time.time()
+        status = _get_service_task_status(service)
+        if status is not None:
+            if status["State"] in {"failed", "rejected"}:
+                raise ValueError("Failed to start environment: %s" % status["Err"])
+            elif status["State"] == "running":
+                return status
+        if checked >= deadline:
+            raise ValueError("Tale did not start before timeout exceeded")
+        _wait_for_docker_event(
+            service.client,
+            filters,
+            until=min(deadline, checked + SERVICE_POLL_INTERVAL),
+            since=checked,
+        )
+
+
+def _wait_for_services(services, timeout=300.0):
+    """Wait until the tasks of several swarm services are running.
+
+    Same as ``_wait_for_service``, but a single events subscription (to any
+    swarm container on this node) is shared by all the services. Returns the
+    task status of each service by its id, or the ValueError that explains why
+    it didn't start.
+    """
+    filters = {"type": "container", "label": "com.docker.swarm.service.id"}
+    pending = {service.id: service for service in services}
+    statuses = {}
+    deadline = time.time() + timeout
+    while pending:
+        checked = time.time()
+        for service_id, service in list(pending.items()):
+            status = _get_service_task_status(service)
+            if status is None:
+                continue
+            if status["State"] in {"failed", "rejected"}:
+                statuses[service_id] = ValueError(
+                    "Failed to start environment: %s" % status["Err"]
+                )
+            elif status["State"] == "running":
+                statuses[service_id] = status
+            else:
+                continue
+            del pending[service_id]
+        if not pending:
+            break
+        if checked >= deadline:
+            for service_id in pending:
+                statuses[service_id] = ValueError("Tale did not start before timeout exceeded")
+            break
+        _wait_for_docker_event(
+            next(iter(pending.values())).client,
+            filters,
+            until=min(deadline, checked + SERVICE_POLL_INTERVAL),
+            since=checked,
+        )
+    return statuses
+
+
+def _wait_for_service_update(service, timeout=180.0, canceled=None):
+    """Wait until the rolling update of a swarm service completes.
+
+    Like ``_wait_for_service`` the service is only inspected again when the
+    events stream reports a change to it (or every SERVICE_POLL_INTERVAL
+    seconds). ``canceled`` is an optional callable that aborts the wait.
+    """
+    filters = {"type": "service", "service": service.id}
+    deadline = time.time() + timeout
+    while True:
+        checked = time.time()
+        service.reload()
+        status = service.attrs.get("UpdateStatus") or {}
+        if status.get("State") == "paused":
+            raise RuntimeError(
+                'Restarting the Tale failed with "{}"'.format(status.get("Message"))
+            )
+        elif status.get("State") == "completed":
+            return status
+        if canceled is not None and canceled():
+            raise RuntimeError("Tale restart cancelled")
+        if checked >= deadline:
+            raise RuntimeError("Tale update timed out")
+        _wait_for_docker_event(
+            service.client,
+            filters,
+            until=min(deadline, checked + SERVICE_POLL_INTERVAL),
+            since=checked,
+        )
+
+
+def _wait_for_server(url, timeout=READINESS_PROBE_TIMEOUT, max_interval=2.0):
+    """Wait for the server running in a Tale to answer HTTP requests.
+
+    Probes ``url`` with an exponential backoff until it returns anything but
+    a "not there yet" response from the proxy. Returns the time (in seconds)
+    it took for the server to become ready or None if it didn't answer before
+    ``timeout``.
+    """
+    if timeout <= 0:
+        return None
+    tic = time.time()
+    interval = 0.1
+    with requests.Session() as session:
+        while True:
+            try:
+                resp = session.get(
+                    url, allow_redirects=False, timeout=min(5.0, max(timeout, 0.1))
+                )
+                if resp.status_code not in NOT_READY_STATUS_CODES:
+                    return time.time() - tic
+            except requests.exceptions.RequestException:
+                pass
+            elapsed = time.time() - tic
+            if elapsed + interval > timeout:
+                logger.warning("%s did not respond within %.0f s", url, timeout)
+                return None
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+
 def _get_container_volumes(mountpoint, container_config, directories):
     volumes = {}
     for path in directories:
@@ -427,7 +830,9 @@ def stop_container(container: docker.models.containers.Container):
         raise
 
 
-def _recorded_run(cli, mountpoint, container_config, tag, entrypoint, name, task=None):
+def _recorded_run(
+    cli, mountpoint, container_config, tag, entrypoint, name, task=None, labels=None
+):
     def logging_worker(log_queue, container):
         for line in container.logs(stream=True):
             log_queue.put(line.decode("utf-8").strip(), block=False)
@@ -456,6 +861,7 @@ def _recorded_run(cli, mountpoint, container_config, tag, entrypoint, name, task
         name=name,
         volumes=volumes,
         working_dir=os.path.join(container_config.target_mount, "workspace"),
+        labels=labels,
     )
 
     logging_thread = threading.Thread(
@@ -471,11 +877,14 @@ def _recorded_run(cli, mountpoint, container_config, tag, entrypoint, name, task
     stats_thread.start()
     logging_thread.start()
 
+    # Full output is dumped to the workspace below, no need to keep another copy.
+    log = JobLogSink(keep_full_log=False)
     try:
         container = cli.containers.get(container.id)
         while container.status == "running":
             while not log_queue.empty():
-                print(log_queue.get_nowait(), flush=True)
+                log.write(log_queue.get_nowait())
+            log.flush(force=False)
             if task.canceled:
                 stop_container(container)
                 break
@@ -485,9 +894,10 @@ def _recorded_run(cli, mountpoint, container_config, tag, entrypoint, name, task
         pass
 
     stats_thread.join()
-    while not log_queue.empty():
-        print(log_queue.get_nowait())
     logging_thread.join()
+    while not log_queue.empty():
+        log.write(log_queue.get_nowait())
+    log.close()
 
     if task.canceled:
         ret = {"StatusCode": -123}
@@ -6,6 +6,13 @@ from kubernetes import client, config
 
 from .constants import NFS_PATH, NFS_SERVER, VOLUMES_ROOT
 
+# Requests are the limits scaled by these, values below 1 overcommit the nodes
+MEMORY_REQUEST_RATIO = float(os.environ.get("K8S_MEMORY_REQUEST_RATIO", 1.0))
+CPU_REQUEST_RATIO = float(os.environ.get("K8S_CPU_REQUEST_RATIO", 1.0))
+# Used when neither the image nor the Tale configure them (see _get_container_config)
+DEFAULT_MEMORY_LIMIT = 4 * 1024**3
+DEFAULT_CPU_SHARES = 1024
+
 
 def split_and_clean_quotes(input_string):
     """
@@ -127,6 +134,47 @@ def tale_service(params):
     )
 
 
+def remove_tale_objects(params, created):
+    """Delete what the functions in ``created`` (tale_deployment, tale_service
+    and/or tale_ingress) created with ``params``."""
+    config.load_incluster_config()
+    namespace = params["deploymentNamespace"]
+    if tale_deployment in created:
+        client.AppsV1Api().delete_namespaced_deployment(
+            name=params["deploymentName"], namespace=namespace
+        )
+    if tale_service in created:
+        client.CoreV1Api().delete_namespaced_service(
+            name=params["deploymentName"], namespace=namespace
+        )
+    if tale_ingress in created:
+        client.NetworkingV1Api().delete_namespaced_ingress(
+            name=f"tale-{params['host']}", namespace=namespace
+        )
+
+
+def tale_resources(mem_limit=None, cpu_shares=None):
+    """Resources of a Tale's container from its ``mem_limit`` and ``cpu_shares``.
+
+    As in Docker, 1024 CPU shares amount to one CPU. ``cpu_shares`` comes
+    straight from the Tale's config and falls back to the default if it isn't
+    a number.
+    """
+    memory = int(mem_limit or DEFAULT_MEMORY_LIMIT)
+    try:
+        cpu_shares = int(cpu_shares or DEFAULT_CPU_SHARES)
+    except (ValueError, TypeError):
+        cpu_shares = DEFAULT_CPU_SHARES
+    millicpus = int(cpu_shares * 1000 / 1024)
+    return client.V1ResourceRequirements(
+        limits={"memory": str(memory), "cpu": f"{millicpus}m"},
+        requests={
+            "memory": str(max(int(memory * MEMORY_REQUEST_RATIO), 1)),
+            "cpu": f"{max(int(millicpus * CPU_REQUEST_RATIO), 1)}m",
+        },
+    )
+
+
 def compose_volumes(params):
     volumes = [
         client.V1Volume(name="data", empty_dir={}),
@@ -284,15 +332,8 @@ def tale_deployment(params):
                                     )
                                 ],
                                 volume_mounts=instance_mounts,
-                                resources=client.V1ResourceRequirements(
-                                    limits={
-                                        "memory": "4Gi",
-                                        "cpu": "1",
-                                    },
-                                    requests={
-                                        "memory": "4Gi",
-                                        "cpu": "1",
-                                    },
+                                resources=tale_resources(
+                                    params.get("memLimit"), params.get("cpuShares")
                                 ),
                                 env=[
                                     client.V1EnvVar(
@@ -329,12 +370,12 @@ def tale_deployment(params):
                                     limits={
                                         "memory": "1Gi",
                                         "cpu": "1",
-                                        "smarter-devices/fuse": 1,
+                                        "smarter-devices/fuse": "1",
                                     },
                                     requests={
                                         "memory": "1Gi",
                                         "cpu": "0.5",
-                                        "smarter-devices/fuse": 1,
+                                        "smarter-devices/fuse": "1",
                                     },
                                 ),
                                 env=[
@@ -23,8 +23,9 @@ setup(
         "girder-client",
         "girder-worker>=5.0.0a5.dev0",
         "kubernetes",
-        "docker>=2.3.0",
+        "docker>=6.1.0",
         "requests",
+        "urllib3>=2",
         "markdown",
         "lxml_html_clean",
         "pystache",
@@ -1,4 +1,7 @@
 # content of conftest.py
+import pytest
+
+
 def pytest_configure(config):
     import sys
 
@@ -9,3 +12,27 @@ def pytest_unconfigure(config):
     import sys  # This was missing from the manual
 
     del sys._called_from_test
+
+
+@pytest.fixture(autouse=True)
+def deployment_cache(tmp_path, monkeypatch):
+    """Keep discovered deployment values to the test (and don't refresh them)."""
+    from gwvolman import utils
+
+    monkeypatch.setattr(utils, "DEPLOYMENT_CACHE", str(tmp_path / "deployment.json"))
+    monkeypatch.setattr(utils, "DEPLOYMENT_REFRESH_INTERVAL", 0)
+
+
+@pytest.fixture(autouse=True)
+def reset_process_caches():
+    """Don't let (mocked) shared clients or cached documents leak between tests."""
+    from gwvolman import utils
+
+    def reset():
+        utils._reset_docker_client()
+        utils._api_keys.clear()
+        utils._image_docs.clear()
+
+    reset()
+    yield
+    reset()
@@ -223,6 +223,7 @@ def test_r2d_calls(dtmp, depl, dapicli):
 
     from gwvolman.r2d import ImageBuilder
     from gwvolman.constants import REPO2DOCKER_VERSION
+    from gwvolman.utils import _reset_docker_client
 
     with mock.patch("docker.from_env") as dcli:
         dcli.return_value.images.pull.side_effect = docker.errors.NotFound("blah")
@@ -231,6 +232,8 @@ def test_r2d_calls(dtmp, depl, dapicli):
             image_builder.pull_r2d()
         assert ex.match(f"Requested r2d image '{REPO2DOCKER_VERSION}' not found.")
 
+    # The docker client is shared, drop the one mocked above
+    _reset_docker_client()
     with mock.patch("docker.from_env") as dcli:
         mock_container_run = mock.MagicMock(wraps=docker_run_r2d_container)
         dcli.return_value.containers.run = mock_container_run
@@ -407,3 +410,17 @@ def test_build_image_task(dtmpdir, drurl, task):
         result = build_tale_image(tale["_id"], force=False)
         image_builder.return_value.run_r2d.assert_called()
         assert result["image_digest"] == "foo:tag@some_digest"
+
+        # A fresh build gets distributed to the nodes
+        image_builder.return_value.cached_image.side_effect = [
+            None,
+            None,
+            {"digest": "new_digest", "name": "foo", "tag": "tag"},
+        ]
+        with mock.patch("gwvolman.tasks_docker.app.send_task") as send_task:
+            result = build_tale_image(tale["_id"], force=False)
+        assert result["image_digest"] == "foo:tag@new_digest"
+        image_builder.return_value.push_image.assert_called_with("some_tag")
+        send_task.assert_called_once_with(
+            "gwvolman.tasks.prepull_images", args=[["foo:tag@new_digest"]]
+        )
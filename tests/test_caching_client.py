@@ -0,0 +1,72 @@
+import mock
+from girder_client import GirderClient
+
+from gwvolman.lib.caching_client import CachingGirderClient, get_fresh
+from gwvolman.lib.girder_session import get_girder_session, girder_retries
+
+
+def _response(doc):
+    return mock.MagicMock(ok=True, json=mock.Mock(return_value=doc))
+
+
+def test_caching_client():
+    gc = GirderClient(apiUrl="https://girder.dev.wholetale.org/api/v1")
+    gc.token = "token"
+    gc = CachingGirderClient.wrap(gc)
+    assert gc.urlBase == "https://girder.dev.wholetale.org/api/v1/"
+    assert gc.token == "token"
+
+    session = mock.MagicMock()
+    session.get.side_effect = lambda url, **kwargs: _response({"_id": "tale1", "config": {}})
+    session.put.return_value = _response({"_id": "tale1"})
+    with mock.patch.object(gc, "_requestFunc", side_effect=lambda m: getattr(session, m.lower())):
+        with mock.patch("time.monotonic", return_value=0):
+            tale = gc.get("/tale/tale1")
+            tale["config"]["modified"] = True  # copies are handed out
+            assert gc.get("tale/tale1") == {"_id": "tale1", "config": {}}
+            gc.get("/tale/tale1", parameters={"x": [1]})
+            gc.get("/user/me")
+            assert session.get.call_count == 3
+            assert (gc.cache_hits, gc.cache_misses) == (1, 3)
+
+            # Writes to the resource invalidate it
+            gc.put("/tale/tale1/build")
+            gc.get("/tale/tale1")
+            gc.get("/user/me")
+            assert session.get.call_count == 4
+
+            # Polling loops go to Girder every time
+            get_fresh(gc, "/tale/tale1")
+            gc.get("/tale/tale1")
+            assert session.get.call_count == 5
+
+        # Expired
+        with mock.patch("time.monotonic", return_value=gc.cache_ttl + 1):
+            gc.get("/user/me")
+            assert session.get.call_count == 6
+
+
+def test_prerun_wraps_girder_client():
+    from gwvolman.tasks import cache_girder_requests, create_volume, log_girder_cache_stats
+
+    create_volume.girder_client = GirderClient(apiUrl="https://girder.dev.wholetale.org/api/v1")
+    cache_girder_requests(task=create_volume, sender=create_volume)
+    assert isinstance(create_volume.girder_client, CachingGirderClient)
+    assert create_volume.girder_client._session is get_girder_session()
+
+    # Nothing cached outlives the task
+    create_volume.girder_client._get_cache[("user/me", "[]")] = ({}, float("inf"))
+    log_girder_cache_stats(task=create_volume, sender=create_volume)
+    assert create_volume.girder_client._get_cache == {}
+    create_volume.girder_client = None
+
+
+def test_girder_retries():
+    session = get_girder_session()
+    assert session is get_girder_session()
+    retries = session.get_adapter("https://girder.dev.wholetale.org").max_retries
+    assert retries.is_retry("GET", 503)
+    assert not retries.is_retry("POST", 503)
+    assert not retries.is_retry("PUT", 503)
+    assert not retries.is_retry("GET", 500)
+    assert girder_retries(total=0).total == 0
@@ -1,5 +1,6 @@
 import docker
 import mock
+import pytest
 from girder_client import GirderClient
 
 
@@ -46,3 +47,79 @@ def test_cleanup_run():
         gc.patch.assert_called_with("/run/run_id/status", parameters={"status": 4})
         gc.put.assert_called_with("/job/jobId", parameters={"status": 4})
         cleanup.assert_called_with(canceled=False)
+
+
+def test_reap_orphans():
+    from girder_client import HttpError
+
+    from gwvolman.tasks_docker import DockerTasks
+
+    old, new = "2020-01-01T00:00:00.000000000Z", "2999-01-01T00:00:00Z"
+    task = mock.MagicMock()
+
+    def gc_get(path, parameters=None):
+        if path == "/user/me":
+            return {"_id": "admin", "admin": True}
+        elif path == "/instance":
+            return [{"_id": "i1", "containerInfo": {"volumeName": "tale1_user1_abc"}}]
+        elif path == "/run/run1/status":
+            return {"status": 2}
+        elif path == "/run/run2/status":
+            return {"status": 3}
+        raise HttpError(400, "Invalid ObjectId", path, "GET")
+
+    task.girder_client.get.side_effect = gc_get
+
+    def service(name, instance_id, created):
+        obj = mock.MagicMock(
+            attrs={"Spec": {"Labels": {"wholetale.instanceId": instance_id}}, "CreatedAt": created}
+        )
+        obj.name = name
+        return obj
+
+    def container(name, created=1577836800, **attrs):
+        return mock.MagicMock(id=name, attrs={"Names": [f"/{name}"], "Created": created, **attrs})
+
+    services = [
+        service("tmp-live", "i1", old),
+        service("tmp-gone", "i2", old),
+        service("tmp-new", "i3", new),
+    ]
+    sidecars = [
+        container("tale1_user1_abc"),
+        container("tale2_user1_abc"),
+        container("run1_user1_abc"),
+        container("wt-fs-pool-abc"),
+    ]
+    runs = [
+        container("rrun-live", Labels={"wholetale.runId": "run1"}, State="running"),
+        container("rrun-done", Labels={"wholetale.runId": "run2"}, State="exited"),
+        container("rrun-unknown", Labels={}, State="running"),
+    ]
+
+    with mock.patch("gwvolman.tasks_docker.get_docker_client") as cli, mock.patch(
+        "gwvolman.tasks_docker.FSContainer.stop_container"
+    ) as stop_container:
+        cli.return_value.info.return_value = {"Swarm": {"ControlAvailable": True}}
+        cli.return_value.services.list.return_value = services
+        cli.return_value.containers.list.side_effect = lambda **kw: (
+            sidecars if "ancestor" in kw["filters"] else runs
+        )
+
+        report = DockerTasks().reap_orphans(task, dry_run=True)
+        assert [(r["type"], r["name"]) for r in report] == [
+            ("service", "tmp-gone"),
+            ("WT Filesystem container", "tale2_user1_abc"),
+            ("recorded run container", "rrun-done"),
+        ]
+        services[1].remove.assert_not_called()
+
+        report = DockerTasks().reap_orphans(task)
+        assert all(r["removed"] for r in report)
+        services[1].remove.assert_called_once()
+        stop_container.assert_called_once_with("tale2_user1_abc")
+        cli.return_value.api.remove_container.assert_called_once_with("rrun-done", force=True)
+
+    task.girder_client.get.side_effect = lambda path, parameters=None: {"_id": "user1"}
+    with pytest.raises(ValueError, match="admin"):
+        DockerTasks().reap_orphans(task)
@@ -1,10 +1,15 @@
+import itertools
+
+import docker
 import pytest
 import mock
+import requests
 
 import girder_worker
 from gwvolman.tasks import update_container
 from girder_client import GirderClient
 
+CREATED_AT = "2024-05-01T12:00:00.123456789Z"
 
 @pytest.fixture(scope="session")
 def celery_config():
@@ -22,5 +27,284 @@ def test_update_container(services):
     update_container.job_manager = mock.MagicMock()
     girder_worker.task.Task.canceled = mock.PropertyMock(return_value=False)
 
-    task = update_container("123", digest="digest_hash")
+    with mock.patch("gwvolman.tasks_docker.ImageCache") as image_cache:
+        task = update_container("123", digest="digest_hash")
     assert task == {"image_digest": "digest_hash"}
+    image_cache.return_value.pull.assert_called_once_with("digest_hash")
+    _, kwargs = mock_service.update.call_args
+    assert kwargs["image"] == "digest_hash"
+    assert kwargs["update_config"]["Order"] == "start-first"
+
+    # The Tale runs on another node, which gets to pull the image
+    mock_gc.get.side_effect = ["user", {"containerInfo": {"name": "blah", "nodeId": "node2"}}]
+    with mock.patch("gwvolman.tasks_docker.ImageCache") as image_cache, mock.patch(
+        "docker.client.DockerClient.info", return_value={"Swarm": {"NodeID": "node1"}}
+    ), mock.patch("gwvolman.tasks_docker.app.send_task") as send_task, mock.patch.dict(
+        "os.environ", {"SWARM_NODE_ID": "node1"}
+    ):
+        update_container("123", digest="digest_hash")
+    image_cache.return_value.pull.assert_not_called()
+    send_task.assert_called_once_with(
+        "gwvolman.tasks.prepull_images", args=[["digest_hash"]], queue="node2"
+    )
+
+
+def test_wait_for_service_update():
+    from gwvolman.utils import _wait_for_service_update
+
+    service = mock.MagicMock(id="service_id", attrs={})
+
+    def reload():
+        states = ["updating", "completed"]
+        service.attrs = {"UpdateStatus": {"State": states[service.reload.call_count - 1]}}
+
+    service.reload.side_effect = reload
+    service.client.events.return_value.__iter__.return_value = iter([{"Action": "update"}])
+    assert _wait_for_service_update(service, timeout=10) == {"State": "completed"}
+    _, kwargs = service.client.events.call_args
+    assert kwargs["filters"] == {"type": "service", "service": "service_id"}
+
+    service.reload.side_effect = None
+    service.attrs = {"UpdateStatus": {"State": "paused", "Message": "oom"}}
+    with pytest.raises(RuntimeError, match="oom"):
+        _wait_for_service_update(service, timeout=10)
+
+    service.attrs = {}
+    with pytest.raises(RuntimeError, match="cancelled"):
+        _wait_for_service_update(service, timeout=10, canceled=lambda: True)
+
+
+def test_wait_for_docker_event():
+    from gwvolman.utils import _wait_for_docker_event
+
+    cli = mock.MagicMock()
+    since = 1700000000.5
+    # An event from earlier in the same second doesn't count
+    cli.events.return_value.__iter__.return_value = iter(
+        [{"timeNano": 1700000000250000000}]
+    )
+    assert not _wait_for_docker_event(cli, {}, until=since, since=since)
+    assert cli.events.call_args.kwargs["since"] == "1700000000.500000000"
+
+    cli.events.return_value.__iter__.return_value = iter(
+        [{"timeNano": 1700000000250000000}, {"timeNano": 1700000000750000000}]
+    )
+    assert _wait_for_docker_event(cli, {}, until=since, since=since)
+
+
+def test_wait_for_service():
+    from gwvolman.utils import _wait_for_service
+
+    service = mock.MagicMock(id="service_id")
+    service.tasks.side_effect = [
+        [],
+        [{"CreatedAt": CREATED_AT, "Status": {"State": "preparing"}}],
+        [{"CreatedAt": CREATED_AT, "Status": {"State": "running"}}],
+    ]
+    service.client.events.return_value.__iter__.return_value = iter(
+        [{"status": "start"}]
+    )
+
+    status = _wait_for_service(service, timeout=10)
+    assert status == {"State": "running"}
+    assert service.tasks.call_count == 3
+    assert service.client.events.call_count == 2
+    _, kwargs = service.client.events.call_args
+    assert kwargs["filters"] == {
+        "type": "container",
+        "label": "com.docker.swarm.service.id=service_id",
+    }
+
+    service.tasks.side_effect = None
+    service.tasks.return_value = [
+        {"CreatedAt": CREATED_AT, "Status": {"State": "rejected", "Err": "no space"}}
+    ]
+    with pytest.raises(ValueError, match="no space"):
+        _wait_for_service(service, timeout=10)
+
+    service.tasks.return_value = []
+    service.client.events.return_value.__iter__.return_value = iter([])
+    with pytest.raises(ValueError, match="timeout exceeded"):
+        _wait_for_service(service, timeout=0)
+
+    # The task of a container stopped before (e.g. suspended) is listed first
+    service.tasks.return_value = [
+        {"CreatedAt": "2024-05-01T12:00:00Z", "Status": {"State": "shutdown"}},
+        {"CreatedAt": "2024-05-01T13:00:00.5Z", "Status": {"State": "running"}},
+    ]
+    assert _wait_for_service(service, timeout=10) == {"State": "running"}
+
+
+def test_wait_for_server():
+    from gwvolman.utils import _wait_for_server
+
+    responses = [
+        requests.exceptions.ConnectionError(),
+        mock.MagicMock(status_code=404),
+        mock.MagicMock(status_code=502),
+        mock.MagicMock(status_code=302),
+    ]
+    with mock.patch("requests.Session.get", side_effect=responses) as get, mock.patch(
+        "time.sleep"
+    ) as sleep:
+        assert _wait_for_server("https://tmp-abc.wholetale.org/lab", timeout=10) >= 0
+    assert get.call_count == 4
+    assert [_.args[0] for _ in sleep.call_args_list] == [0.1, 0.2, 0.4]
+
+    with mock.patch(
+        "requests.Session.get", return_value=mock.MagicMock(status_code=503)
+    ), mock.patch("time.sleep"), mock.patch(
+        "time.time", side_effect=itertools.chain([0, 0], itertools.repeat(20))
+    ):
+        assert _wait_for_server("https://tmp-abc.wholetale.org/lab", timeout=10) is None
+
+    assert _wait_for_server("https://tmp-abc.wholetale.org/lab", timeout=0) is None
+
+
+def test_get_api_key_cache():
+    from gwvolman import utils
+
+    keys = [
+        {"name": "other", "active": True, "key": "nope"},
+        {"name": "tmpnb", "active": True, "key": "key1"},
+    ]
+
+    def client(token):
+        gc = mock.MagicMock(spec=GirderClient)
+        gc.urlBase = "https://girder.dev.wholetale.org/api/v1/"
+        gc.token = token
+        gc.get.side_effect = lambda path: {"_id": "user1"} if path == "/user/me" else keys
+        return gc
+
+    gc = client("token1")
+    with mock.patch("time.monotonic", return_value=0):
+        assert utils._get_api_key(gc) == "key1"
+        assert utils._get_api_key(gc, {"_id": "user1"}) == "key1"
+        # Every job gets a new token, the key is the user's
+        other_job = client("token2")
+        assert utils._get_api_key(other_job) == "key1"
+    assert [call.args for call in gc.get.call_args_list] == [("/user/me",), ("/api_key",)]
+    other_job.get.assert_called_once_with("/user/me")
+
+    # Rejected key
+    keys = []
+    gc.post.return_value = {"key": "key2"}
+    utils._invalidate_api_key(gc, {"_id": "user1"})
+    with mock.patch("time.monotonic", return_value=0):
+        assert utils._get_api_key(gc) == "key2"
+    gc.post.assert_called_once_with("/api_key", data={"name": "tmpnb", "active": True})
+
+    # Expired
+    keys = [{"name": "tmpnb", "active": True, "key": "key3"}]
+    with mock.patch("time.monotonic", return_value=utils.API_KEY_CACHE_TTL + 1):
+        assert utils._get_api_key(gc, {"_id": "user1"}) == "key3"
+
+
+def test_get_image_cache():
+    from gwvolman import utils
+
+    gc = mock.MagicMock(spec=GirderClient)
+    gc.urlBase = "https://girder.dev.wholetale.org/api/v1/"
+    gc.get.return_value = {"_id": "image1", "public": True, "config": {"port": 8888}}
+    tale = {"_id": "tale1", "imageId": "image1", "config": {"port": 8080}}
+
+    with mock.patch("time.monotonic", return_value=0):
+        assert utils._get_container_config(gc, tale).container_port == 8080
+        # Tale's config must not leak into the cached image
+        tale.pop("config")
+        assert utils._get_container_config(gc, tale).container_port == 8888
+        assert utils._get_container_config(gc, tale).mem_limit == 2 * 1024**3
+        # Kubernetes gives Tales more memory by default
+        config = utils._get_container_config(gc, tale, default_mem_limit=4 * 1024**3)
+        assert config.mem_limit == 4 * 1024**3
+    gc.get.assert_called_once_with("/image/image1")
+
+    with mock.patch("time.monotonic", return_value=utils.IMAGE_DOC_TTL + 1):
+        utils._get_container_config(gc, tale)
+    assert gc.get.call_count == 2
+
+    # Private images are subject to Girder's access checks every time
+    gc.get.return_value = {"_id": "image2", "public": False, "config": {}}
+    tale["imageId"] = "image2"
+    with mock.patch("time.monotonic", return_value=0):
+        utils._get_container_config(gc, tale)
+        utils._get_container_config(gc, tale)
+    assert gc.get.call_count == 4
+
+
+def test_plugin_routes():
+    from gwvolman import GWVolumeManagerPlugin
+
+    app = mock.MagicMock()
+    app.conf.beat_schedule = {}
+    cli = mock.MagicMock()
+    cli.nodes.get.return_value.attrs = {"Spec": {"Role": "manager"}}
+    with mock.patch("docker.from_env", return_value=cli), mock.patch.dict(
+        "os.environ", {"SWARM_NODE_ID": "node1"}
+    ):
+        GWVolumeManagerPlugin(app)
+    routes = app.conf.task_routes
+    assert routes["gwvolman.tasks.prepull_popular_images"] == {"queue": "manager"}
+    assert app.conf.beat_schedule["prepull-popular-images"] == {
+        "task": "gwvolman.tasks.prepull_popular_images",
+        "schedule": 3600.0,
+    }
+
+
+def test_shutdown_route():
+    """Girder sends shutdowns without SWARM_NODE_ID or a node to send them to."""
+    from celery import Celery
+    from gwvolman import GWVolumeManagerPlugin
+
+    app = Celery(set_as_current=False)
+    with mock.patch.dict("os.environ", clear=True), mock.patch("docker.from_env") as from_env:
+        GWVolumeManagerPlugin(app)
+    from_env.assert_not_called()
+    router = app.amqp.router
+    route = router.route({}, "gwvolman.tasks.shutdown_container", args=["123"])
+    assert route["queue"].name == "manager"
+    # ...and workers without node ids listen on it
+    assert "manager" in {queue.name for queue in app.conf.task_queues}
+
+
+def test_shutdown_container_worker_node():
+    from gwvolman.tasks_docker import DockerTasks
+
+    task = mock.MagicMock()
+    with mock.patch("gwvolman.tasks_docker.get_docker_client") as cli:
+        cli.return_value.info.return_value = {"Swarm": {"ControlAvailable": False}}
+        with pytest.raises(RuntimeError, match="isn't a swarm manager"):
+            DockerTasks().shutdown_container(task, "123")
+        task.girder_client.get.assert_not_called()
+
+        cli.return_value.info.return_value = {"Swarm": {"ControlAvailable": True}}
+        task.girder_client.get.side_effect = ["user", {"containerInfo": {"name": "blah"}}]
+        DockerTasks().shutdown_container(task, "123")
+        cli.return_value.services.get.return_value.remove.assert_called_once()
+
+
+def test_suspend_resume_instance():
+    from gwvolman.tasks_docker import DockerTasks
+
+    task = mock.MagicMock()
+    container_info = {"name": "tmp-abc", "url": "https://tmp-abc.wholetale.org/lab"}
+    task.girder_client.get.side_effect = lambda path: (
+        {"_id": "user1"} if path == "/user/me" else {"containerInfo": container_info}
+    )
+    with mock.patch("gwvolman.tasks_docker.get_docker_client") as cli, mock.patch(
+        "gwvolman.tasks_docker._wait_for_service"
+    ) as wait_for_service, mock.patch.object(
+        DockerTasks, "wait_for_instance", return_value=0.5
+    ) as wait_for_instance:
+        service = cli.return_value.services.get.return_value
+        assert DockerTasks().suspend_instance(task, "i1") == container_info
+        service.scale.assert_called_once_with(0)
+
+        assert DockerTasks().resume_instance(task, "i1") == container_info
+        service.scale.assert_called_with(1)
+        wait_for_service.assert_called_once_with(service, timeout=300.0)
+        wait_for_instance.assert_called_once_with(task, container_info["url"])
+
+        cli.return_value.services.get.side_effect = docker.errors.NotFound("gone")
+        with pytest.raises(RuntimeError, match="launched again"):
+            DockerTasks().resume_instance(task, "i1")
@@ -1,5 +1,7 @@
 # Write a pytest based test for ..utils.Deployment class
 # mocking all docker.Client calls
+import time
+
 import mock
 import pytest
 
@@ -70,3 +72,60 @@ def test_girder_url(deployment):
             }
         }
         assert deployment.girder_url == "https://girder.example.com"
+
+
+def _stack_services(domain):
+    def get(name):
+        router = name[3:]
+        service = mock.Mock()
+        service.attrs = {
+            "Spec": {
+                "Labels": {
+                    "com.docker.stack.namespace": "wt",
+                    f"traefik.http.routers.{router}.rule": f"Host(`{router}.{domain}`)",
+                    "traefik.docker.network": "wt_traefik-net",
+                },
+                "TaskTemplate": {"ContainerSpec": {"Mounts": []}},
+            }
+        }
+        return service
+
+    return get
+
+
+@mock.patch("gwvolman.utils.DEPLOYMENT_REFRESH_INTERVAL", 300)
+def test_deployment_cache(deployment):
+    with mock.patch.object(deployment, "docker_client") as mock_docker_client, mock.patch.object(
+        deployment, "_start_refresher"
+    ):
+        mock_docker_client.services.get.side_effect = _stack_services("example.com")
+        assert deployment.girder_url == "https://girder.example.com"
+
+    # Other workers take it from the shared cache
+    other = Deployment()
+    with mock.patch.object(other, "docker_client") as mock_docker_client, mock.patch.object(
+        other, "_start_refresher"
+    ):
+        assert other.girder_url == "https://girder.example.com"
+        mock_docker_client.services.get.assert_not_called()
+
+        # ... and rediscover it only when it's stale
+        mock_docker_client.services.get.side_effect = _stack_services("example.org")
+        other.refresh()
+        mock_docker_client.services.get.assert_not_called()
+        with mock.patch("time.time", return_value=time.time() + 1000):
+            other.refresh()
+        assert other.girder_url == "https://girder.example.org"
+        assert other.registry_url == "https://registry.example.org"
+
+    deployment.load_cache()
+    assert deployment.girder_url == "https://girder.example.org"
+
+
+def test_shared_docker_client():
+    from gwvolman.utils import get_docker_client
+
+    with mock.patch("docker.from_env") as from_env:
+        cli = get_docker_client()
+        assert get_docker_client() is cli
+        from_env.assert_called_once_with(version="1.41", max_pool_size=10)
@@ -0,0 +1,106 @@
+import mock
+
+from gwvolman.idle_detector import IdleDetector
+
+
+def _stats(cpu, system, network):
+    return {
+        "cpu_stats": {"cpu_usage": {"total_usage": cpu}, "system_cpu_usage": system},
+        "precpu_stats": {},
+        "networks": {"eth0": {"rx_bytes": network, "tx_bytes": 0}},
+    }
+
+
+def test_idle_instances(tmp_path):
+    busy = mock.MagicMock(id="c1", labels={"wholetale.instanceId": "busy"})
+    idle = mock.MagicMock(id="c2", labels={"wholetale.instanceId": "idle"})
+    cli = mock.MagicMock()
+    cli.containers.list.return_value = [busy, idle]
+    detector = IdleDetector(cli=cli, state_path=str(tmp_path / "idle.json"), timeout=150)
+
+    samples = [
+        # time, busy stats, idle stats
+        (0, _stats(0, 0, 0), _stats(0, 0, 0)),
+        (100, _stats(50, 1000, 0), _stats(1, 1000, 10)),
+        (200, _stats(50, 2000, 10**6), _stats(1, 2000, 10)),
+    ]
+    results = []
+    for now, busy_stats, idle_stats in samples:
+        busy.stats.return_value = busy_stats
+        idle.stats.return_value = idle_stats
+        with mock.patch("time.time", return_value=now):
+            results.append(detector.idle_instances())
+
+    # Everything starts active, idle for 100s isn't over the timeout yet...
+    assert results[:2] == [{}, {}]
+    # ...but 200s is, while network traffic keeps the other one active
+    assert results[2] == {"idle": 200}
+    busy.stats.assert_called_with(stream=False, one_shot=True)
+
+    # Gone containers are forgotten
+    cli.containers.list.return_value = [busy]
+    with mock.patch("time.time", return_value=300):
+        detector.idle_instances()
+    assert list(detector._load()) == ["c1"]
+
+
+def test_is_active_counts_cpus():
+    def sample(now, cpu, system, online_cpus):
+        return {
+            "time": now,
+            "cpu_stats": {
+                "cpu_usage": {"total_usage": cpu},
+                "system_cpu_usage": system,
+                "online_cpus": online_cpus,
+            },
+            "network": 0,
+        }
+
+    # 0.5% of the time of all 4 CPUs is 2% of one (cgroup v2 has no percpu_usage)
+    assert IdleDetector.is_active(sample(0, 0, 0, 4), sample(100, 5, 1000, 4))
+    assert not IdleDetector.is_active(sample(0, 0, 0, None), sample(100, 5, 1000, None))
+
+
+def test_pooled_instances(tmp_path):
+    claimed = mock.MagicMock(
+        id="c1", labels={"wholetale.pool": "true", "com.docker.swarm.service.name": "tmp-a"}
+    )
+    unclaimed = mock.MagicMock(
+        id="c2", labels={"wholetale.pool": "true", "com.docker.swarm.service.name": "tmp-b"}
+    )
+    cli = mock.MagicMock()
+    cli.containers.list.side_effect = lambda filters: (
+        [claimed, unclaimed] if filters == {"label": "wholetale.pool"} else []
+    )
+    claimed.stats.return_value = _stats(0, 0, 0)
+    detector = IdleDetector(
+        cli=cli,
+        state_path=str(tmp_path / "idle.json"),
+        timeout=50,
+        pooled_instances={"tmp-a": "i1"},
+    )
+    for now in (0, 100):
+        with mock.patch("time.time", return_value=now):
+            idle = detector.idle_instances()
+    assert idle == {"i1": 100}
+    unclaimed.stats.assert_not_called()
+
+
+def test_detect_idle_instances():
+    from gwvolman.tasks_docker import DockerTasks
+
+    task = mock.MagicMock()
+    with mock.patch("gwvolman.tasks_docker.IdleDetector") as detector:
+        detector.return_value.idle_instances.return_value = {"i1": 4000.0}
+        assert DockerTasks().detect_idle_instances(task) == [
+            {"instanceId": "i1", "idleFor": 4000.0, "culled": False}
+        ]
+        task.girder_client.delete.assert_not_called()
+
+        assert DockerTasks().detect_idle_instances(task, cull=True)[0]["culled"]
+        task.girder_client.delete.assert_called_once_with("/instance/i1")
+
+        task.girder_client.delete.side_effect = RuntimeError("girder is down")
+        assert DockerTasks().detect_idle_instances(task, cull=True) == [
+            {"instanceId": "i1", "idleFor": 4000.0, "culled": False, "error": "girder is down"}
+        ]
@@ -0,0 +1,97 @@
+import json
+
+import docker
+import mock
+import pytest
+
+from gwvolman.image_cache import ImageCache, popular_images, pull_reference
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    with mock.patch(
+        "gwvolman.utils.DockerDeployment.registry_url",
+        new_callable=mock.PropertyMock,
+        return_value="https://registry.dev.wholetale.org",
+    ):
+        yield
+
+
+def _image(image_id, size, tag=None):
+    image = mock.MagicMock()
+    image.id = image_id
+    image.attrs = {
+        "Size": size,
+        "RepoTags": [tag or f"registry.dev.wholetale.org/tale/{image_id}:latest"],
+        "RepoDigests": None,
+    }
+    return image
+
+
+def test_pull_reference():
+    assert pull_reference("registry.dev.wholetale.org/tale/abc:123@sha256:def") == (
+        "registry.dev.wholetale.org/tale/abc@sha256:def"
+    )
+    assert pull_reference("localhost:5000/tale@sha256:def") == "localhost:5000/tale@sha256:def"
+    assert pull_reference("jupyter/base:latest") == "jupyter/base:latest"
+
+
+def test_popular_images():
+    cli = mock.MagicMock()
+    services = []
+    for image in ("a", "b", "b"):
+        service = mock.MagicMock()
+        service.attrs = {"Spec": {"TaskTemplate": {"ContainerSpec": {"Image": image}}}}
+        services.append(service)
+    cli.services.list.return_value = services
+    assert popular_images(cli, count=1) == ["b"]
+
+
+def test_pull_and_evict(tmp_path):
+    state_path = str(tmp_path / "state.json")
+    cli = mock.MagicMock()
+    cache = ImageCache(cli, budget=250, state_path=state_path)
+
+    cli.images.pull.return_value = _image("sha256:new", 100)
+    assert cache.pull("registry.dev.wholetale.org/tale/new:1@sha256:abc") == "sha256:new"
+    cli.images.pull.assert_called_once_with("registry.dev.wholetale.org/tale/new@sha256:abc")
+    cli.images.pull.side_effect = docker.errors.APIError("manifest unknown")
+    assert cache.pull("registry.dev.wholetale.org/tale/gone:1@sha256:abc") is None
+
+    with open(state_path) as fp:
+        state = json.load(fp)
+    assert list(state) == ["sha256:new"]
+    state.update({"sha256:old": 1, "sha256:older": 0, "sha256:recent": 2})
+    with open(state_path, "w") as fp:
+        json.dump(state, fp)
+
+    running = mock.MagicMock(attrs={"ImageID": "sha256:running"})
+    cli.containers.list.return_value = [running]
+    cli.images.list.return_value = [
+        _image("sha256:new", 100),
+        _image("sha256:running", 100),
+        _image("sha256:recent", 100),
+        _image("sha256:old", 100),
+        _image("sha256:older", 100),
+        _image("sha256:base", 1000, tag="jupyter/base:latest"),
+    ]
+    # 500 bytes of Tale images, 250 allowed
+    assert cache.evict(keep=["sha256:new"]) == ["sha256:older", "sha256:old", "sha256:recent"]
+    with open(state_path) as fp:
+        state = json.load(fp)
+    assert set(state) == {"sha256:running", "sha256:new"}
+
+    assert ImageCache(cli, budget=0, state_path=state_path).evict() == []
+
+
+def test_used(tmp_path):
+    state_path = str(tmp_path / "state.json")
+    cli = mock.MagicMock()
+    cli.images.get.side_effect = lambda ref: _image(f"sha256:{ref[-3:]}", 100)
+    with mock.patch("time.time", return_value=42):
+        ImageCache(cli, state_path=state_path).used(
+            "registry.dev.wholetale.org/tale/abc:1@sha256:abc"
+        )
+    cli.images.get.assert_called_once_with("registry.dev.wholetale.org/tale/abc@sha256:abc")
+    with open(state_path) as fp:
+        assert json.load(fp) == {"sha256:abc": 42}
@@ -0,0 +1,242 @@
+import json
+
+import docker
+import mock
+import pytest
+
+from gwvolman import instance_pool
+from gwvolman.instance_pool import InstancePool, config_hash
+from gwvolman.utils import CONTAINER_CONFIG_LABEL, ContainerConfig
+
+
+CONTAINER_CONFIG = ContainerConfig(
+    buildpack="JupyterBuildPack",
+    repo2docker_version="wholetale/repo2docker_wholetale:v1.2",
+    image="registry.local/tale@sha256:abc",
+    command="jupyter notebook --port={port} --NotebookApp.token={token}",
+    mem_limit=2 * 1024**3,
+    cpu_shares=None,
+    container_port=8888,
+    container_user="jovyan",
+    target_mount="/home/jovyan/work",
+    url_path="?token={token}",
+    environment=["FOO=bar"],
+    csp="",
+)
+
+
+@pytest.fixture(autouse=True)
+def deployment():
+    with mock.patch.multiple(
+        "gwvolman.utils.DockerDeployment",
+        dashboard_url=mock.PropertyMock(return_value="https://dashboard.dev.wholetale.org"),
+        traefik_network=mock.PropertyMock(return_value="wt_traefik"),
+        registry_url=mock.PropertyMock(return_value="https://registry.dev.wholetale.org"),
+    ):
+        yield
+
+
+def _pooled_service(name, state="idle", config=CONTAINER_CONFIG):
+    service = mock.MagicMock()
+    service.id = f"{name}_id"
+    service.name = name
+    service.attrs = {
+        "Spec": {
+            "Labels": {
+                "traefik.enable": "false",
+                "wholetale.pool": config_hash(config),
+                "wholetale.pool.node": "node1",
+                "wholetale.pool.state": state,
+                "wholetale.pool.volume": f"pool_{name}",
+                "wholetale.pool.urlPath": "?token=secret",
+                CONTAINER_CONFIG_LABEL: json.dumps(config._asdict()),
+            }
+        }
+    }
+    return service
+
+
+def _pool():
+    cli = mock.MagicMock()
+    cli.info.return_value = {"Swarm": {"NodeID": "node1"}}
+    return InstancePool(cli), cli
+
+
+def test_claim():
+    pool, cli = _pool()
+    taken = _pooled_service("tmp-taken")
+    taken.update.side_effect = docker.errors.APIError("update out of sequence")
+    free = _pooled_service("tmp-free")
+    cli.services.list.return_value = [taken, free]
+
+    with mock.patch.object(InstancePool, "replenish") as replenish:
+        pooled = pool.claim(CONTAINER_CONFIG, "inst1", "node1")
+        replenish.assert_called_once()
+
+    assert pooled.id == "tmp-free_id"
+    assert pooled.path == "pool_tmp-free"
+    assert pooled.host == "tmp-free"
+    cli.services.list.assert_called_once_with(
+        filters={
+            "label": [
+                "wholetale.pool.node=node1",
+                "wholetale.pool.state=idle",
+                f"wholetale.pool={config_hash(CONTAINER_CONFIG)}",
+            ]
+        }
+    )
+    labels = free.update.call_args.kwargs["labels"]
+    assert labels["wholetale.pool.state"] == "claimed"
+    # Reaped along with the instance, should it never be launched
+    assert labels["wholetale.instanceId"] == "inst1"
+
+    cli.services.list.return_value = []
+    with mock.patch.object(InstancePool, "replenish"):
+        assert pool.claim(CONTAINER_CONFIG, "inst1", "node1") is None
+
+
+def test_set_credentials(tmp_path):
+    gc = mock.MagicMock(token="girderToken", urlBase="https://girder.dev.wholetale.org/api/v1")
+    (tmp_path / "mountpoints").mkdir()
+    with mock.patch("gwvolman.instance_pool.POOL_ENV_ROOT", str(tmp_path)), mock.patch(
+        "gwvolman.instance_pool.VOLUMES_ROOT", str(tmp_path)
+    ), mock.patch("gwvolman.instance_pool._get_api_key", return_value="apiKey"):
+        slot = InstancePool.prepare_slot()
+        for directory in instance_pool.POOL_DIRECTORIES:
+            assert (tmp_path / "mountpoints" / slot / directory).is_dir()
+        InstancePool.set_credentials(slot, gc)
+        env_file = tmp_path / slot / "girder.env"
+        assert env_file.read_text().splitlines() == [
+            "GIRDER_TOKEN=girderToken",
+            "GIRDER_API_URL=https://girder.dev.wholetale.org/api/v1",
+            "GIRDER_API_KEY=apiKey",
+        ]
+
+        InstancePool.release_slot(slot)
+    assert not (tmp_path / slot).exists()
+    assert not (tmp_path / "mountpoints" / slot).exists()
+
+
+def test_activate(tmp_path):
+    pool, cli = _pool()
+    service = _pooled_service("tmp-abc", state="claimed")
+    cli.services.get.return_value = service
+    service_info = {"pooledService": service.id, "instanceId": "inst1", "taleId": "tale1"}
+    (tmp_path / "pool_tmp-abc").mkdir()
+    env_file = tmp_path / "pool_tmp-abc" / "girder.env"
+    env_file.write_text("GIRDER_TOKEN=girderToken\n")
+
+    _, attrs = pool.activate(service_info, CONTAINER_CONFIG)
+    assert attrs == {"url": "https://tmp-abc.dev.wholetale.org/?token=secret"}
+    labels = service.update.call_args.kwargs["labels"]
+    assert labels["traefik.enable"] == "true"
+    assert labels["traefik.http.routers.tmp-abc.rule"] == "Host(`tmp-abc.dev.wholetale.org`)"
+    assert labels["wholetale.instanceId"] == "inst1"
+    assert labels["wholetale.pool.state"] == "active"
+
+    # Image changed since the environment was claimed
+    service.reset_mock()
+    with mock.patch("os.rmdir"), mock.patch(
+        "gwvolman.instance_pool.POOL_ENV_ROOT", str(tmp_path)
+    ):
+        assert pool.activate(service_info, CONTAINER_CONFIG._replace(image="new")) is None
+    service.update.assert_not_called()
+    service.remove.assert_called_once()
+    # Removing it also removes the credentials
+    assert not env_file.exists()
+
+
+def test_fill():
+    pool, cli = _pool()
+    running = mock.MagicMock()
+    running.attrs = {
+        "Spec": {"Labels": {CONTAINER_CONFIG_LABEL: json.dumps(CONTAINER_CONFIG._asdict())}}
+    }
+    stale_config = CONTAINER_CONFIG._replace(image="registry.local/old@sha256:def")
+    stale = _pooled_service("tmp-stale", config=stale_config)
+    idle = _pooled_service("tmp-idle")
+
+    def list_services(filters):
+        if filters["label"] == "wholetale.instanceId":
+            return [running, running]
+        return [idle, stale]
+
+    cli.services.list.side_effect = list_services
+    with mock.patch("os.rmdir"), mock.patch("gwvolman.instance_pool._safe_mkdir") as mkdir:
+        pool.fill(size=2)
+
+    stale.remove.assert_called_once()
+    idle.remove.assert_not_called()
+    cli.services.create.assert_called_once()
+    args, kwargs = cli.services.create.call_args
+    assert args == (CONTAINER_CONFIG.image,)
+    assert kwargs["labels"]["traefik.enable"] == "false"
+    assert kwargs["labels"]["wholetale.pool.state"] == "idle"
+    assert kwargs["constraints"] == ["node.id == node1"]
+    token = kwargs["labels"]["wholetale.pool.urlPath"].split("=")[1]
+    # The Tale only starts once the user's credentials are there
+    assert kwargs["command"][:2] == ["sh", "-c"]
+    assert kwargs["command"][2].endswith(
+        f"exec jupyter notebook --port=8888 --NotebookApp.token={token}"
+    )
+    assert "/run/wholetale/girder.env" in kwargs["command"][2]
+    assert kwargs["container_labels"] == {"wholetale.pool": "true"}
+    assert "FOO=bar" in kwargs["env"]
+    slot = kwargs["labels"]["wholetale.pool.volume"]
+    *volumes, env_mount = kwargs["mounts"]
+    for mount in volumes:
+        assert slot in mount["Source"]
+        assert mount["BindOptions"]["Propagation"] == "rslave"
+    assert env_mount["Source"].endswith(f"pool_env/{slot}")
+    assert env_mount["Target"] == "/run/wholetale"
+    assert env_mount["ReadOnly"]
+    assert mkdir.call_count == len(instance_pool.POOL_DIRECTORIES) + 2
+
+
+def test_fill_nodes():
+    pool, cli = _pool()
+    running = mock.MagicMock()
+    running.attrs = {
+        "Spec": {"Labels": {CONTAINER_CONFIG_LABEL: json.dumps(CONTAINER_CONFIG._asdict())}}
+    }
+    local = _pooled_service("tmp-local")
+    # Left behind by a node that was drained
+    drained = _pooled_service("tmp-drained")
+    drained.attrs["Spec"]["Labels"]["wholetale.pool.node"] = "node3"
+
+    def list_services(filters):
+        if filters["label"] == "wholetale.instanceId":
+            return [running]
+        return [local, drained]
+
+    cli.services.list.side_effect = list_services
+    nodes = [mock.MagicMock(id="node1"), mock.MagicMock(id="node2")]
+    with mock.patch.dict("os.environ", {"SWARM_NODE_ID": "node1"}), mock.patch(
+        "gwvolman.instance_pool.ready_nodes", return_value=nodes
+    ), mock.patch("gwvolman.instance_pool.app") as app:
+        pool.fill(size=1)
+
+    local.remove.assert_not_called()
+    cli.services.create.assert_not_called()
+    drained.remove.assert_called_once()
+    # Slots are set up and removed by the nodes they are on
+    assert app.send_task.call_args_list == [
+        mock.call("gwvolman.tasks.release_pool_slot", args=["pool_tmp-drained"], queue="node3"),
+        mock.call(
+            "gwvolman.tasks.prepare_pool_slots",
+            args=[CONTAINER_CONFIG._asdict(), 1],
+            queue="node2",
+        ),
+    ]
+
+    # Managers start the services once the node is ready
+    from gwvolman.tasks_docker import DockerTasks
+
+    with mock.patch("gwvolman.instance_pool.get_docker_client", return_value=cli):
+        DockerTasks().launch_pooled_instances(
+            "node2", CONTAINER_CONFIG._asdict(), ["pool_a"]
+        )
+    kwargs = cli.services.create.call_args.kwargs
+    assert kwargs["constraints"] == ["node.id == node2"]
+    assert kwargs["labels"]["wholetale.pool.node"] == "node2"
+    assert kwargs["labels"]["wholetale.pool.volume"] == "pool_a"
@@ -0,0 +1,114 @@
+import os
+import time
+from unittest.mock import MagicMock, call, patch
+
+from gwvolman.lib.log_sink import JobLogSink
+
+
+def test_batching():
+    with patch("builtins.print") as mock_print:
+        with JobLogSink(batch_bytes=8, interval=3600, keep_full_log=False) as log:
+            log.write("one")
+            mock_print.assert_not_called()
+            log.write("two")
+            mock_print.assert_called_once_with("one\ntwo", flush=True)
+            log.write("three")
+            log.flush(force=False)
+            assert mock_print.call_count == 1
+        mock_print.assert_called_with("three", flush=True)
+        assert mock_print.call_count == 2
+
+
+def test_time_based_flush():
+    with patch("builtins.print") as mock_print:
+        log = JobLogSink(interval=0, keep_full_log=False)
+        log.write("one")
+        mock_print.assert_called_once_with("one", flush=True)
+
+
+def test_head_and_tail(tmp_path):
+    gc = MagicMock()
+    gc.get.return_value = {"_id": "user_id"}
+    gc.createFolder.return_value = {"_id": "folder_id"}
+
+    def upload(folder_id, path, filename=None):
+        with open(path) as fp:
+            assert fp.read().splitlines() == [f"line{i}" for i in range(10)]
+
+    gc.uploadFileToFolder.side_effect = upload
+    with patch("builtins.print") as mock_print, patch(
+        "gwvolman.lib.log_sink.JOB_LOG_DIR", str(tmp_path)
+    ):
+        with JobLogSink(batch_bytes=1e6, head_lines=2, tail_lines=2, gc=gc) as log:
+            for i in range(10):
+                log.write(f"line{i}")
+
+    assert log.truncated == 6
+    gc.createFolder.assert_called_once_with(
+        "user_id", "Logs", parentType="user", public=False, reuseExisting=True
+    )
+    name = gc.uploadFileToFolder.call_args.kwargs["filename"]
+    gc.uploadFileToFolder.assert_called_once_with(
+        "folder_id", os.path.join(str(tmp_path), name), filename=name
+    )
+    # Uploaded logs don't stay on the worker
+    assert log.full_log_path is None
+    assert os.listdir(tmp_path) == []
+
+    assert mock_print.call_args_list == [
+        call(
+            "\n".join(
+                [
+                    "line0",
+                    "line1",
+                    "[Output exceeded 2 lines, only the last 2 lines will be shown]",
+                    f"[... 6 lines omitted, full log uploaded to Logs/{name} ...]",
+                    "line8",
+                    "line9",
+                ]
+            ),
+            flush=True,
+        )
+    ]
+
+
+def test_full_log_kept_if_upload_fails(tmp_path):
+    gc = MagicMock()
+    gc.get.side_effect = Exception("Girder is down")
+    with patch("builtins.print") as mock_print, patch(
+        "gwvolman.lib.log_sink.JOB_LOG_DIR", str(tmp_path)
+    ):
+        with JobLogSink(batch_bytes=1e6, head_lines=1, tail_lines=1, gc=gc) as log:
+            for i in range(3):
+                log.write(f"line{i}")
+    assert os.path.isfile(log.full_log_path)
+    assert "[... 1 lines omitted ...]" in mock_print.call_args.args[0]
+
+    # Until it expires
+    with patch("gwvolman.lib.log_sink.JOB_LOG_DIR", str(tmp_path)):
+        JobLogSink.remove_expired_logs()
+        assert os.path.isfile(log.full_log_path)
+        JobLogSink.remove_expired_logs(now=time.time() + 86401)
+    assert os.listdir(tmp_path) == []
+
+
+def test_timer_flush():
+    with patch("builtins.print") as mock_print:
+        with JobLogSink(batch_bytes=1e6, interval=0.05, keep_full_log=False) as log:
+            log.write("one")
+            # Nothing else is written, the timer forwards the line anyway
+            for _ in range(100):
+                if mock_print.called:
+                    break
+                time.sleep(0.01)
+            mock_print.assert_called_once_with("one", flush=True)
+
+
+def test_full_log_removed_if_not_truncated(tmp_path):
+    with patch("builtins.print"), patch(
+        "gwvolman.lib.log_sink.JOB_LOG_DIR", str(tmp_path)
+    ):
+        with JobLogSink(head_lines=10) as log:
+            log.write("line")
+    assert log.full_log_path is None
+    assert os.listdir(tmp_path) == []
@@ -59,6 +59,7 @@ RPZ_RUN_CALL = mock.call(
         },
     },
     working_dir="/work/workspace",
+    labels={"wholetale.runId": "123abc"},
 )
 CPR_RUN_CALL = mock.call(
     image="wholetale/wt-cpr:latest",
@@ -118,7 +119,7 @@ def test_recorded_run(
         "requests.Session.post", return_value=mock.MagicMock()
     ) as mock_post, mock.patch(
         "requests.delete", return_value=mock.MagicMock()
-    ) as mock_delete:
+    ) as mock_delete, mock.patch("socket.create_connection"):
         mock_status = mock.PropertyMock(side_effect=["starting", "running", "running"])
         fscontainer = mock.MagicMock(
             id="container1",
@@ -169,7 +170,7 @@ def test_recorded_run(
             "requests.Session.post", return_value=mock.MagicMock()
         ) as mock_post, mock.patch(
             "requests.delete", return_value=mock.MagicMock()
-        ) as mock_delete:
+        ) as mock_delete, mock.patch("socket.create_connection"):
             mock_status = mock.PropertyMock(
                 side_effect=["starting", "running", "running"]
             )
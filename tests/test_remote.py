@@ -21,7 +21,7 @@ def image_builder():
     )
 
 
-@patch("requests.put")
+@patch("requests.Session.put")
 def test_pull_r2d(mock_put, image_builder):
     mock_response = MagicMock()
     mock_response.iter_lines.return_value = [b'{"status": "pulling"}']
@@ -29,10 +29,10 @@ def test_pull_r2d(mock_put, image_builder):
 
     with patch("builtins.print") as mock_print:
         image_builder.pull_r2d()
-        mock_print.assert_called_with("pulling")
+        mock_print.assert_called_with("pulling", flush=True)
 
 
-@patch("requests.put")
+@patch("requests.Session.put")
 def test_push_image(mock_put, image_builder):
     mock_response = MagicMock()
     mock_response.iter_lines.return_value = [b'{"status": "pushing"}']
@@ -40,10 +40,10 @@ def test_push_image(mock_put, image_builder):
 
     with patch("builtins.print") as mock_print:
         image_builder.push_image("test_image:latest")
-        mock_print.assert_called_with(b'{"status": "pushing"}')
+        mock_print.assert_called_with('{"status": "pushing"}', flush=True)
 
 
-@patch("requests.post")
+@patch("requests.Session.post")
 def test_run_r2d_success(mock_post, image_builder):
     mock_response = MagicMock()
     mock_response.iter_lines.return_value = [
@@ -57,7 +57,7 @@ def test_run_r2d_success(mock_post, image_builder):
     assert digest == "test_digest"
 
 
-@patch("requests.post")
+@patch("requests.Session.post")
 def test_run_r2d_fail_build(mock_post, image_builder):
     mock_response = MagicMock()
     mock_response.iter_lines.return_value = [
@@ -71,7 +71,7 @@ def test_run_r2d_fail_build(mock_post, image_builder):
     assert digest is None
 
 
-@patch("requests.post")
+@patch("requests.Session.post")
 def test_run_r2d_fail_other(mock_post, image_builder):
     mock_response = MagicMock()
     mock_response.iter_lines.return_value = [
@@ -83,3 +83,20 @@ def test_run_r2d_fail_other(mock_post, image_builder):
     ret, digest = image_builder.run_r2d("test_tag")
     assert ret == {"StatusCode": 1, "error": "something bad happened"}
     assert digest is None
+
+
+def test_session_is_shared(image_builder):
+    assert image_builder.session() is RemoteImageBuilder.session()
+    adapter = image_builder.session().get_adapter("https://builder.test.url")
+    assert adapter.max_retries.connect == 5
+
+
+@patch("requests.Session.put")
+def test_gzip_header(mock_put, image_builder):
+    mock_put.return_value.iter_lines.return_value = []
+    image_builder.pull_r2d()
+    assert mock_put.call_args.kwargs["headers"] == {"Accept-Encoding": "identity"}
+
+    image_builder.gzip = True
+    image_builder.pull_r2d()
+    assert mock_put.call_args.kwargs["headers"] == {"Accept-Encoding": "gzip"}
@@ -0,0 +1,160 @@
+import mock
+from celery.app.task import Context
+
+from gwvolman import scheduler
+from gwvolman.scheduler import reroute, schedule, schedule_many, select_node, select_nodes
+from gwvolman.utils import ContainerConfig
+
+GB = 1024**3
+
+CONTAINER_CONFIG = ContainerConfig(
+    buildpack="JupyterBuildPack",
+    repo2docker_version="wholetale/repo2docker_wholetale:v1.2",
+    image="registry/tale@sha256:abc",
+    command=None,
+    mem_limit=2 * GB,
+    cpu_shares=None,
+    container_port=8888,
+    container_user="jovyan",
+    target_mount="/home/jovyan/work",
+    url_path="",
+    environment=[],
+    csp="",
+)
+
+
+def _node(node_id, memory, state="ready", availability="active"):
+    node = mock.MagicMock()
+    node.id = node_id
+    node.attrs = {
+        "Status": {"State": state},
+        "Spec": {"Availability": availability},
+        "Description": {"Resources": {"MemoryBytes": memory}},
+    }
+    return node
+
+
+def _service(service_id, node_id, memory, image="registry/other", pooled=False):
+    service = mock.MagicMock()
+    service.id = service_id
+    labels = {"wholetale.pool.node": node_id} if pooled else {"wholetale.instanceId": "i"}
+    placement = {} if pooled else {"Constraints": [f"node.id == {node_id}"]}
+    service.attrs = {
+        "Spec": {
+            "Labels": labels,
+            "TaskTemplate": {
+                "ContainerSpec": {"Image": image},
+                "Placement": placement,
+                "Resources": {"Limits": {"MemoryBytes": memory}},
+            },
+        }
+    }
+    return service
+
+
+def _cli(nodes, tales, pooled=()):
+    cli = mock.MagicMock()
+    cli.nodes.list.return_value = nodes
+    cli.services.list.side_effect = lambda filters: list(
+        tales if filters["label"] == "wholetale.instanceId" else pooled
+    )
+    return cli
+
+
+def test_select_node():
+    nodes = [
+        _node("full", 4 * GB),
+        _node("busy", 16 * GB),
+        _node("idle", 16 * GB),
+        _node("down", 64 * GB, state="down"),
+        _node("drained", 64 * GB, availability="drain"),
+    ]
+    tales = [
+        _service("s1", "full", 3 * GB),
+        _service("s2", "busy", 2 * GB),
+        _service("s3", "busy", 2 * GB),
+    ]
+    # Not enough memory left on "full", "idle" has the fewest instances
+    assert select_node(_cli(nodes, tales), CONTAINER_CONFIG) == "idle"
+
+    # ...unless the image is only on "busy"
+    tales.append(_service("s4", "busy", 2 * GB, image=CONTAINER_CONFIG.image))
+    assert select_node(_cli(nodes, tales), CONTAINER_CONFIG) == "busy"
+
+    # Pooled environments count too
+    pooled = [_service(f"p{i}", "idle", 4 * GB, pooled=True) for i in range(4)]
+    assert select_node(_cli(nodes, tales, pooled), CONTAINER_CONFIG) == "busy"
+
+    # Nothing fits, go with the most free memory
+    big = CONTAINER_CONFIG._replace(mem_limit=32 * GB)
+    assert select_node(_cli(nodes, tales, pooled), big) == "busy"
+
+    assert select_node(_cli([], []), CONTAINER_CONFIG) is None
+
+
+def test_select_nodes():
+    nodes = [_node("n1", 8 * GB), _node("n2", 8 * GB)]
+    tales = [_service("s1", "n1", 1 * GB, image=CONTAINER_CONFIG.image)]
+    # The image is on n1, until the Tales placed there before take its memory
+    placement = select_nodes(_cli(nodes, tales), [CONTAINER_CONFIG] * 5)
+    assert placement == ["n1", "n1", "n1", "n2", "n2"]
+    assert select_nodes(_cli([], []), [CONTAINER_CONFIG]) == [None]
+
+    task = mock.MagicMock()
+    task.request = Context(args=[["i1", "i2"]], kwargs={})
+    with mock.patch.dict("os.environ", {"SWARM_NODE_ID": "n1"}), mock.patch(
+        "gwvolman.scheduler.get_docker_client"
+    ) as cli:
+        cli.return_value = _cli(nodes, tales)
+        cli.return_value.info.return_value = {"Swarm": {"ControlAvailable": True}}
+        assert schedule_many(task, [CONTAINER_CONFIG] * 4, "n1") == [None, None, None, "n2"]
+        cli.return_value.info.return_value = {"Swarm": {"ControlAvailable": False}}
+        assert schedule_many(task, [CONTAINER_CONFIG] * 2, "n1") == "manager"
+
+
+def test_schedule_and_reroute():
+    task = mock.MagicMock()
+    task.request = Context(
+        args=["instance1", None],
+        kwargs={},
+        jobInfoSpec={"url": "job"},
+        girder_client_token="token",
+    )
+
+    with mock.patch.dict("os.environ", {"SWARM_NODE_ID": "local"}), mock.patch(
+        "gwvolman.scheduler.select_node", return_value="other"
+    ), mock.patch("docker.from_env"):
+        assert schedule(task, CONTAINER_CONFIG, "local") == "other"
+        with mock.patch.object(scheduler, "SCHEDULE_INSTANCES", False):
+            assert schedule(task, CONTAINER_CONFIG, "local") is None
+        with mock.patch("gwvolman.scheduler.select_node", return_value="local"):
+            assert schedule(task, CONTAINER_CONFIG, "local") is None
+
+        reroute(task, "other")
+        task.signature.assert_called_once_with(
+            args=["instance1", None],
+            kwargs={},
+            queue="other",
+            headers={
+                "jobInfoSpec": {"url": "job"},
+                "girder_client_token": "token",
+                "wholetale_scheduled": True,
+            },
+        )
+        task.replace.assert_called_once_with(task.signature.return_value)
+
+        # Only managers can place instances
+        with mock.patch("gwvolman.scheduler.get_docker_client") as cli:
+            cli.return_value.info.return_value = {"Swarm": {"ControlAvailable": False}}
+            assert schedule(task, CONTAINER_CONFIG, "local") == "manager"
+        task.signature.reset_mock()
+        reroute(task, "manager", scheduled=False)
+        assert "wholetale_scheduled" not in task.signature.call_args.kwargs["headers"]
+
+        # The managers hand what they claimed for the instance over to its node
+        reroute(task, "other", pooled={"id": "s1"})
+        assert task.signature.call_args.kwargs["kwargs"] == {"pooled": {"id": "s1"}}
+
+        # Already moved once
+        task.request.wholetale_scheduled = True
+        assert schedule(task, CONTAINER_CONFIG, "local") is None
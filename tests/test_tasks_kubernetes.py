@@ -2,6 +2,7 @@ import mock
 import pytest
 
 from girder_client import GirderClient
+from kubernetes.client.rest import ApiException
 from gwvolman.tasks_kubernetes import KubernetesTasks
 from celery import Task
 
@@ -77,23 +78,31 @@ def test_remove_volume(task_handler):
     assert result is None
 
 
-def test_wait_for_pod(task_handler):
+def _pod(
+    phase, reason="reason", message="message", conditions=None, containers=None, deleted=False
+):
+    return mock.MagicMock(
+        metadata=mock.MagicMock(deletion_timestamp="2024-05-01T12:00:00Z" if deleted else None),
+        status=mock.MagicMock(
+            phase=phase,
+            reason=reason,
+            message=message,
+            conditions=conditions or [],
+            container_statuses=containers or [],
+        )
+    )
+
+
+def test_wait_for_pod(task_handler, task):
     instance_id = "instance_id"
     with mock.patch("kubernetes.client.CoreV1Api") as api_mock, mock.patch(
-        "time.sleep"
-    ):
-        api_mock.return_value.list_namespaced_pod.side_effect = [
-            mock.MagicMock(items=[]),
-            mock.MagicMock(
-                items=[
-                    mock.MagicMock(
-                        status=mock.MagicMock(
-                            phase="Failed", reason="reason", message="message"
-                        )
-                    )
-                ]
-            ),
-        ]
+        "kubernetes.watch.Watch"
+    ) as watch_mock:
+        list_pods = api_mock.return_value.list_namespaced_pod
+        list_pods.return_value = mock.MagicMock(items=[])
+        watch_mock.return_value.stream.return_value = iter(
+            [{"type": "MODIFIED", "object": _pod("Failed")}]
+        )
         with pytest.raises(Exception) as exc:
             task_handler._wait_for_pod(instance_id)
         assert str(exc.value) == "Pod %s failed. Reason: %s, message: %s" % (
@@ -101,22 +110,71 @@ def test_wait_for_pod(task_handler):
             "reason",
             "message",
         )
+        watch_mock.return_value.stop.assert_called_once()
 
-        api_mock.return_value.list_namespaced_pod.side_effect = [
-            mock.MagicMock(
-                items=[
-                    mock.MagicMock(
-                        status=mock.MagicMock(phase="Running", reason="reason")
-                    )
-                ]
-            ),
-        ]
+        # Already running, nothing to watch
+        watch_mock.reset_mock()
+        list_pods.return_value = mock.MagicMock(items=[_pod("Running")])
         task_handler._wait_for_pod(instance_id)
+        watch_mock.return_value.stream.assert_not_called()
+
+        # Problems are reported while the pod is pending
+        unschedulable = mock.MagicMock(
+            type="PodScheduled", status="False", message="0/3 nodes are available"
+        )
+        pull_failed = mock.MagicMock()
+        pull_failed.name = "instance"
+        pull_failed.state.waiting.reason = "ErrImagePull"
+        pull_failed.state.waiting.message = "not found"
+        list_pods.return_value = mock.MagicMock(
+            items=[_pod("Pending", conditions=[unschedulable])]
+        )
+        watch_mock.return_value.stream.return_value = iter(
+            [
+                {"type": "MODIFIED", "object": _pod("Pending", conditions=[unschedulable])},
+                {"type": "MODIFIED", "object": _pod("Pending", containers=[pull_failed])},
+                {"type": "MODIFIED", "object": _pod("Running")},
+            ]
+        )
+        task.job_manager.reset_mock()
+        task_handler._wait_for_pod(instance_id, task=task)
+        assert [
+            call.kwargs["message"] for call in task.job_manager.updateProgress.call_args_list
+        ] == [
+            "Waiting for a node: 0/3 nodes are available",
+            "Container instance: ErrImagePull not found",
+        ]
+        assert watch_mock.return_value.stream.call_args.kwargs["label_selector"] == (
+            "instanceId=instance_id"
+        )
+
+        # The old pod of a restarted instance is still terminating
+        watch_mock.reset_mock()
+        list_pods.return_value = mock.MagicMock(items=[_pod("Running", deleted=True)])
+        new_pod = _pod("Running")
+        watch_mock.return_value.stream.return_value = iter(
+            [
+                {"type": "MODIFIED", "object": _pod("Failed", deleted=True)},
+                {"type": "ADDED", "object": new_pod},
+            ]
+        )
+        assert task_handler._wait_for_pod(instance_id) is new_pod
+
+        # The deadline holds across watches
+        watch_mock.reset_mock()
+        list_pods.return_value = mock.MagicMock(items=[_pod("Pending")])
+        watch_mock.return_value.stream.side_effect = lambda *args, **kwargs: iter([])
+        with mock.patch("time.time", side_effect=[0, 10, 20, 301]):
+            with pytest.raises(Exception) as exc:
+                task_handler._wait_for_pod(instance_id)
+        assert str(exc.value) == "Pod instance_id startup timed out"
+        assert watch_mock.return_value.stream.call_count == 2
 
 
 def test_launch_container(task_handler, task, mounts):
     payload = {"instanceId": "instance_id", "mounts": mounts}
     task_handler._wait_for_pod = mock.Mock()
+    task_handler.wait_for_instance = mock.Mock(return_value=1.0)
     with mock.patch("kubernetes.client.CoreV1Api") as api_mock, mock.patch(
         "kubernetes.config.load_incluster_config"
     ), mock.patch("gwvolman.tasks_kubernetes.stream") as stream_mock, mock.patch(
@@ -130,6 +188,34 @@ def test_launch_container(task_handler, task, mounts):
         stream_mock.assert_called_once()
         assert result["instanceId"] == payload["instanceId"]
 
+        # A failure to create any of them fails the launch
+        net_api_mock.return_value.create_namespaced_ingress.side_effect = ApiException(
+            status=409
+        )
+        task_handler._wait_for_pod.reset_mock()
+        with pytest.raises(ApiException):
+            task_handler.launch_container(task, payload)
+        task_handler._wait_for_pod.assert_not_called()
+        # ...and removes what was created
+        create_deployment = apps_api_mock.return_value.create_namespaced_deployment
+        deployment_name = create_deployment.call_args.kwargs["body"].metadata.name
+        namespace = task_handler.deployment.namespace
+        apps_api_mock.return_value.delete_namespaced_deployment.assert_called_once_with(
+            name=deployment_name, namespace=namespace
+        )
+        api_mock.return_value.delete_namespaced_service.assert_called_once_with(
+            name=deployment_name, namespace=namespace
+        )
+        net_api_mock.return_value.delete_namespaced_ingress.assert_not_called()
+
+        # A failing cleanup doesn't hide why the launch failed
+        apps_api_mock.return_value.delete_namespaced_deployment.side_effect = ApiException(
+            status=500
+        )
+        with pytest.raises(ApiException) as exc:
+            task_handler.launch_container(task, payload)
+        assert exc.value.status == 409
+
 
 def test_shutdown_container(task_handler, task):
     instance_id = "instance_id"
@@ -164,3 +250,103 @@ def test_shutdown_container(task_handler, task):
         net_api_mock.return_value.delete_namespaced_ingress.assert_called_with(
             name=ingress.metadata.name, namespace=task_handler.deployment.namespace
         )
+
+
+def test_reap_orphans(task_handler, task):
+    import datetime
+
+    old = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def gc_get(path, parameters=None):
+        if path == "/user/me":
+            return {"_id": "admin", "admin": True}
+        elif path == "/instance":
+            return [{"_id": "instance_id"}]
+
+    task.girder_client.get = gc_get
+
+    def resource(name, labels=None, **status):
+        obj = mock.MagicMock()
+        obj.metadata.name = name
+        obj.metadata.labels = labels
+        obj.metadata.creation_timestamp = old
+        obj.status = mock.MagicMock(succeeded=None, failed=None)
+        obj.status.configure_mock(**status)
+        return obj
+
+    with mock.patch("kubernetes.client.AppsV1Api") as apps_api_mock, mock.patch(
+        "kubernetes.client.BatchV1Api"
+    ) as batch_api_mock, mock.patch("kubernetes.client.CoreV1Api") as api_mock, mock.patch.object(
+        task_handler, "shutdown_container"
+    ) as shutdown:
+        apps_api_mock.return_value.list_namespaced_deployment.return_value.items = [
+            resource("tale-live", {"instanceId": "instance_id"}),
+            resource("tale-gone", {"instanceId": "gone_id"}),
+        ]
+        batch_api_mock.return_value.list_namespaced_job.return_value.items = [
+            resource("r2d-job-abc", succeeded=1),
+            resource("r2d-job-def"),
+        ]
+        report = task_handler.reap_orphans(task)
+
+    assert [(r["name"], r["removed"]) for r in report] == [
+        ("tale-gone", True),
+        ("r2d-job-abc", True),
+    ]
+    shutdown.assert_called_once_with(task, "gone_id")
+    batch_api_mock.return_value.delete_namespaced_job.assert_called_once_with(
+        name="r2d-job-abc", namespace="wt", propagation_policy="Background"
+    )
+    api_mock.return_value.delete_namespaced_config_map.assert_called_once_with(
+        name="job-configmap-abc", namespace="wt"
+    )
+
+
+def test_suspend_resume_instance(task_handler, task):
+    with mock.patch("kubernetes.client.AppsV1Api") as apps_api_mock, mock.patch.object(
+        task_handler, "_wait_for_pod"
+    ) as wait_for_pod, mock.patch.object(
+        task_handler, "_execute_girderfs"
+    ) as execute_girderfs, mock.patch.object(
+        task_handler, "wait_for_instance", return_value=None
+    ):
+        deployment = mock.MagicMock()
+        deployment.metadata.name = "deployment_name"
+        apps_api_mock.return_value.list_namespaced_deployment.return_value.items = [deployment]
+
+        task_handler.suspend_instance(task, "instance_id")
+        apps_api_mock.return_value.patch_namespaced_deployment_scale.assert_called_once_with(
+            name="deployment_name",
+            namespace=task_handler.deployment.namespace,
+            body={"spec": {"replicas": 0}},
+        )
+
+        task_handler.resume_instance(task, "instance_id")
+        apps_api_mock.return_value.patch_namespaced_deployment_scale.assert_called_with(
+            name="deployment_name",
+            namespace=task_handler.deployment.namespace,
+            body={"spec": {"replicas": 1}},
+        )
+        wait_for_pod.assert_called_once_with("instance_id", task=task)
+        execute_girderfs.assert_called_once_with(wait_for_pod.return_value, "girderfs-mount")
+
+
+def test_tale_resources():
+    from gwvolman import utils_k8s
+
+    resources = utils_k8s.tale_resources(2 * 1024**3, 512)
+    assert resources.limits == {"memory": str(2 * 1024**3), "cpu": "500m"}
+    assert resources.requests == resources.limits
+
+    with mock.patch.object(utils_k8s, "MEMORY_REQUEST_RATIO", 0.5), mock.patch.object(
+        utils_k8s, "CPU_REQUEST_RATIO", 0.1
+    ):
+        resources = utils_k8s.tale_resources()
+    assert resources.limits == {"memory": str(4 * 1024**3), "cpu": "1000m"}
+    assert resources.requests == {"memory": str(2 * 1024**3), "cpu": "100m"}
+
+    # Tale configs are user input
+    resources = utils_k8s.tale_resources(2 * 1024**3, "2048")
+    assert resources.limits["cpu"] == "2000m"
+    resources = utils_k8s.tale_resources(2 * 1024**3, "lots")
+    assert resources.limits["cpu"] == "1000m"
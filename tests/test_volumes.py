@@ -1,8 +1,11 @@
 from girder_client import GirderClient
+import docker
 import mock
 import os
+import pytest
 
 os.environ["GIRDER_API_URL"] = "https://girder.dev.wholetale.org/api/v1"
+CREATED_AT = "2024-05-01T12:00:00.123456789Z"
 
 from gwvolman.tasks import create_volume  # noqa: E402
 
@@ -26,6 +29,81 @@ def mock_gc_get(path, parameters=None):
         return {}
 
 
+@mock.patch("gwvolman.tasks_docker.new_user", return_value="123456")
+@mock.patch("gwvolman.tasks_docker._get_api_key", return_value="apikey1")
+@mock.patch("gwvolman.tasks_docker.ImageCache")
+def test_create_volume_pulls_image(image_cache, gak, nu):
+    def gc_get(path, parameters=None):
+        if path == "/tale/tale1":
+            return {"_id": "tale1", "imageInfo": {"digest": "registry/tale1:1@sha256:abc"}}
+        return mock_gc_get(path, parameters=parameters)
+
+    mock_gc = mock.MagicMock(spec=GirderClient)
+    mock_gc.get = gc_get
+    mock_gc.token = "some_token"
+    create_volume.girder_client = mock_gc
+    create_volume.job_manager = mock.MagicMock()
+
+    with mock.patch("docker.from_env"), mock.patch(
+        "gwvolman.tasks_docker.FSContainer"
+    ) as fs_container:
+        create_volume("instance1", None)
+
+    image_cache.return_value.pull.assert_called_once_with("registry/tale1:1@sha256:abc")
+    image_cache.return_value.used.assert_not_called()
+    fs_container.claim_container.assert_called_once_with("tale1_user1_123456")
+
+    # Already pulled (or pooled), the use is still recorded on this node
+    from gwvolman.tasks_docker import DockerTasks
+
+    tale = gc_get("/tale/tale1")
+    with mock.patch("docker.from_env"), mock.patch("gwvolman.tasks_docker.FSContainer"):
+        DockerTasks()._create_volume(
+            mock_gc, mock_gc_get("/user/me"), tale, "instance1", None, "node1", pull=False
+        )
+    image_cache.return_value.used.assert_called_once_with("registry/tale1:1@sha256:abc")
+
+
+@mock.patch("gwvolman.tasks_docker._get_api_key", return_value="apikey1")
+@mock.patch("gwvolman.tasks_docker.ImageCache")
+@mock.patch("gwvolman.tasks_docker.INSTANCE_POOL_SIZE", 1)
+def test_create_volume_pooled(image_cache, gak):
+    from gwvolman.tasks_docker import DockerTasks
+    from gwvolman.utils import PooledContainer
+
+    tale = {"_id": "tale1", "imageId": "image1", "imageInfo": {"digest": "registry/tale1@abc"}}
+    task = mock.MagicMock()
+    task.girder_client.token = "some_token"
+    task.girder_client.get.side_effect = lambda path: (
+        tale if path == "/tale/tale1" else mock_gc_get(path)
+    )
+    pooled = PooledContainer(id="service1", path="pool_abc", host="tmp-abc")
+    with mock.patch("gwvolman.tasks_docker.get_docker_client") as cli, mock.patch(
+        "gwvolman.tasks_docker._get_container_config", return_value="config"
+    ), mock.patch("gwvolman.tasks_docker.schedule", return_value="node2"), mock.patch(
+        "gwvolman.tasks_docker.reroute"
+    ) as reroute, mock.patch("gwvolman.tasks_docker.InstancePool") as pool:
+        cli.return_value.info.return_value = {"Swarm": {"NodeID": "node1"}}
+        pool.return_value.claim.return_value = pooled
+        DockerTasks().create_volume(task, "instance1")
+    # Claimed by the manager for the node the instance is moved to
+    pool.return_value.claim.assert_called_once_with("config", "instance1", "node2")
+    reroute.assert_called_once_with(task, "node2", pooled=pooled._asdict())
+
+    with mock.patch("gwvolman.tasks_docker.FSContainer") as fs_container, mock.patch(
+        "gwvolman.tasks_docker.InstancePool"
+    ) as pool:
+        service_info = DockerTasks()._create_volume(
+            task.girder_client, mock_gc_get("/user/me"), tale, "instance1", "config", "node2",
+            pooled=pooled._asdict(), pull=False,
+        )
+    fs_container.claim_container.assert_called_once_with("pool_abc")
+    # The environment starts once the WT Filesystem is mounted in its slot
+    pool.set_credentials.assert_called_once_with("pool_abc", task.girder_client)
+    assert service_info["pooledService"] == "service1"
+    assert service_info["volumeName"] == "pool_abc"
+
+
 @mock.patch("gwvolman.tasks_docker.new_user", return_value="123456")
 @mock.patch("os.mkdir", return_value=None)
 @mock.patch(
@@ -43,7 +121,7 @@ def test_create_volume(gak, info, osmk, nu):
 
     with mock.patch("docker.from_env") as mock_docker, mock.patch(
         "requests.Session.post"
-    ) as mock_post:
+    ) as mock_post, mock.patch("socket.create_connection"):
         mock_docker.return_value = mock.MagicMock()
         # mock docker info
         mock_docker.return_value.info.return_value = {"Swarm": {"NodeID": "node1"}}
@@ -87,3 +165,250 @@ def test_create_volume(gak, info, osmk, nu):
     }
 
     assert ret == expected
+
+
+def test_claim_container_from_pool():
+    from gwvolman.fs_container import FS_POOL_LABEL, FSContainer
+
+    cli = mock.MagicMock()
+    pooled = [mock.MagicMock(), mock.MagicMock()]
+    pooled[0].name = "wt-fs-pool-first"
+    pooled[1].name = "wt-fs-pool-second"
+    cli.containers.list.return_value = pooled
+    # the first one gets claimed by someone else
+    cli.api.rename.side_effect = [docker.errors.NotFound("gone"), None]
+
+    with mock.patch("docker.from_env", return_value=cli), mock.patch(
+        "gwvolman.fs_container.FS_POOL_SIZE", 2
+    ), mock.patch.object(FSContainer, "replenish_pool") as replenish:
+        assert FSContainer.claim_container("tale1_user1_123456") is pooled[1]
+        replenish.assert_called_once()
+
+        cli.api.rename.assert_called_with("wt-fs-pool-second", "tale1_user1_123456")
+        pooled[1].reload.assert_called_once()
+        cli.containers.list.assert_called_with(
+            filters={"label": FS_POOL_LABEL, "name": "wt-fs-pool-"}
+        )
+
+        # Empty pool, a new container is started
+        cli.containers.list.return_value = []
+        with mock.patch.object(FSContainer, "start_container") as start:
+            FSContainer.claim_container("tale1_user1_654321")
+            start.assert_called_once_with("tale1_user1_654321")
+
+
+def test_fill_pool():
+    from gwvolman.fs_container import FSContainer
+
+    cli = mock.MagicMock()
+    cli.containers.list.return_value = [mock.MagicMock()]
+    with mock.patch("docker.from_env", return_value=cli), mock.patch.object(
+        FSContainer, "_run_container"
+    ) as run:
+        FSContainer.fill_pool(size=3)
+        assert run.call_count == 2
+        assert run.call_args.args[0].startswith("wt-fs-pool-")
+
+    idle = [mock.MagicMock() for _ in range(3)]
+    cli.containers.list.return_value = idle
+    with mock.patch("docker.from_env", return_value=cli), mock.patch(
+        "gwvolman.fs_container.stop_container"
+    ) as stop:
+        FSContainer.fill_pool(size=1)
+        assert stop.call_args_list == [mock.call(idle[1]), mock.call(idle[2])]
+
+
+def test_pool_filled_on_worker_ready():
+    from gwvolman.fs_container import FSContainer
+    from celery.signals import worker_ready
+
+    with mock.patch.object(FSContainer, "replenish_pool") as replenish:
+        worker_ready.send(sender=None)
+    replenish.assert_called_once()
+
+
+def test_wait_until_ready():
+    from gwvolman.fs_container import FSContainer
+
+    container = mock.MagicMock()
+    container.name = "tale1_user1_123456"
+    type(container).status = mock.PropertyMock(
+        side_effect=["created", "running", "running"]
+    )
+    with mock.patch(
+        "socket.create_connection", side_effect=[ConnectionRefusedError, mock.MagicMock()]
+    ) as conn, mock.patch("time.sleep") as sleep:
+        FSContainer.wait_until_ready(container)
+    assert conn.call_count == 2
+    conn.assert_called_with(("tale1_user1_123456", 8888), timeout=0.5)
+    assert sleep.call_args_list == [mock.call(0.02), mock.call(0.04)]
+
+    type(container).status = mock.PropertyMock(return_value="exited")
+    with pytest.raises(Exception, match="Failed to create"):
+        FSContainer.wait_until_ready(container)
+
+
+@mock.patch("gwvolman.tasks_docker.new_user", return_value="123456")
+@mock.patch("gwvolman.tasks_docker._get_api_key", return_value="apikey1")
+@mock.patch("gwvolman.tasks_docker.ImageCache")
+@mock.patch("gwvolman.tasks_docker._wait_for_server", return_value=0.5)
+def test_bulk_launch(wait_for_server, image_cache, gak, nu):
+    from gwvolman.tasks_docker import DockerTasks
+    from gwvolman.utils import ContainerConfig
+
+    container_config = ContainerConfig(*[None] * len(ContainerConfig._fields))
+
+    owners = {"i5": "other"}
+
+    def gc_get(path, parameters=None):
+        if path.startswith("/instance/"):
+            instance_id = path.split("/")[-1]
+            return {
+                "_id": instance_id,
+                "taleId": "tale2" if instance_id == "i3" else "tale1",
+                "creatorId": owners.get(instance_id, "ghi567"),
+            }
+        elif path == "/tale/tale1":
+            return {
+                "_id": "tale1",
+                "imageId": "image1",
+                "imageInfo": {"digest": "registry/tale1@sha256:abc"},
+            }
+        elif path == "/tale/tale2":
+            return {"_id": "tale2", "imageId": "image1"}
+        return mock_gc_get(path, parameters=parameters)
+
+    task = mock.MagicMock()
+    task.girder_client.get.side_effect = gc_get
+    task.girder_client.token = "some_token"
+    services = {}
+
+    def launch(service_info, container_config, gc):
+        if service_info["instanceId"] == "i4":
+            raise docker.errors.APIError("no such network")
+        service = mock.MagicMock(id=service_info["instanceId"])
+        service.name = "tmp-" + service_info["instanceId"]
+        service.tasks.return_value = [{"CreatedAt": CREATED_AT, "Status": {"State": "running"}}]
+        services[service.id] = service
+        return service, {"url": f"https://{service.name}.wholetale.org"}
+
+    def create_volume(gc, user, tale, instance_id, *args, **kwargs):
+        if instance_id == "i6":
+            raise RuntimeError("mount failed")
+        return {
+            "instanceId": instance_id,
+            "nodeId": "node1",
+            "volumeName": "vol_" + instance_id,
+            "fscontainerId": "fs_" + instance_id,
+        }
+
+    def remote_volumes(volumes):
+        return [
+            dict(instanceId=v["instanceId"], nodeId="node2", volumeName="vol", fscontainerId="fs")
+            for v in volumes
+        ]
+
+    def server_ready(url):
+        return None if "i7" in url else 0.5
+
+    wait_for_server.side_effect = server_ready
+    with mock.patch("gwvolman.tasks_docker.get_docker_client") as cli, mock.patch(
+        "gwvolman.tasks_docker.FSContainer"
+    ) as fs_container, mock.patch(
+        "gwvolman.tasks_docker._get_container_config", return_value=container_config
+    ) as get_config, mock.patch(
+        "gwvolman.tasks_docker._launch_container", side_effect=launch
+    ) as launch_container, mock.patch.object(
+        DockerTasks, "_create_volume", side_effect=create_volume
+    ), mock.patch(
+        "gwvolman.tasks_docker.schedule_many",
+        return_value=[None, "node2", None, None, None, "node2"],
+    ) as schedule_many, mock.patch(
+        "gwvolman.tasks_docker.app"
+    ) as app, mock.patch(
+        "gwvolman.tasks_docker.GirderClient"
+    ):
+        cli.return_value.info.return_value = {"Swarm": {"NodeID": "node1"}}
+        app.send_task.return_value.get.side_effect = lambda **kwargs: remote_volumes(
+            app.send_task.call_args.kwargs["args"][0]
+        )
+        results = DockerTasks().bulk_launch(
+            task, ["i1", "i2", "i3", "i4", "i5", "i6", "i7"], concurrency=2
+        )
+
+    assert [r["instanceId"] for r in results] == ["i1", "i2", "i3", "i4", "i5", "i6", "i7"]
+    assert results[0]["name"] == "tmp-i1"
+    assert results[0]["url"] == "https://tmp-i1.wholetale.org"
+    assert results[0]["nodeId"] == "node1"
+    # Placed on another node, which only sets up the volumes
+    assert schedule_many.call_args.args[2] == "node1"
+    create_volumes = app.send_task.call_args_list[0]
+    assert create_volumes.args == ("gwvolman.tasks.create_volumes",)
+    assert create_volumes.kwargs["queue"] == "node2"
+    assert [v["instanceId"] for v in create_volumes.kwargs["args"][0]] == ["i2", "i7"]
+    assert create_volumes.kwargs["args"][0][0]["girderToken"] == "some_token"
+    # ...while its services are started here
+    assert results[1]["nodeId"] == "node2"
+    assert results[1]["name"] == "tmp-i2"
+    started = {c.args[0]["instanceId"]: c.args[0] for c in launch_container.call_args_list}
+    assert started["i2"]["nodeId"] == "node2"
+    assert "does not have an image" in results[2]["error"]
+    # The volume of a failed launch is removed
+    assert "no such network" in results[3]["error"]
+    fs_container.stop_container.assert_called_once_with("fs_i4")
+    # Only admins launch the instances of others
+    assert "Only admins" in results[4]["error"]
+    assert "mount failed" in results[5]["error"]
+    # Not responding is a failure too, cleaned up on the instance's node
+    assert "did not respond" in results[6]["error"]
+    services["i7"].remove.assert_called_once()
+    remove_volumes = app.send_task.call_args_list[-1]
+    assert remove_volumes.args == ("gwvolman.tasks.remove_volumes",)
+    assert remove_volumes.kwargs["queue"] == "node2"
+    assert remove_volumes.kwargs["args"][0][0]["fscontainerId"] == "fs"
+    # Shared lookups
+    get_config.assert_called_once()
+    image_cache.return_value.pull.assert_called_once_with("registry/tale1@sha256:abc")
+    assert wait_for_server.call_count == 3
+    user_calls = [c for c in task.girder_client.get.call_args_list if c.args[0] == "/user/me"]
+    assert len(user_calls) == 1
+
+
+def test_bulk_launch_as_owner():
+    from gwvolman.tasks_docker import _owner_client
+
+    gc = mock.MagicMock(urlBase="https://girder.dev.wholetale.org/api/v1/")
+    gc.get.side_effect = lambda path, parameters=None: (
+        [{"name": "tmpnb", "active": True, "key": "studentkey"}]
+        if path == "/api_key"
+        else {"_id": "student", "login": "student"}
+    )
+    admin = {"_id": "admin", "admin": True}
+    assert _owner_client(gc, admin, "admin") == (gc, admin)
+
+    with mock.patch("gwvolman.tasks_docker.GirderClient") as client:
+        owner_gc, owner = _owner_client(gc, admin, "student")
+    assert owner_gc is client.return_value
+    client.return_value.authenticate.assert_called_once_with(apiKey="studentkey")
+    gc.get.assert_any_call("/api_key", parameters={"userId": "student"})
+    assert owner["login"] == "student"
+
+    with pytest.raises(ValueError, match="Only admins"):
+        _owner_client(gc, {"_id": "user"}, "student")
+
+
+def test_wait_for_services():
+    from gwvolman.utils import _wait_for_services
+
+    running = mock.MagicMock(id="s1")
+    running.tasks.side_effect = [[], [{"CreatedAt": CREATED_AT, "Status": {"State": "running"}}]]
+    failed = mock.MagicMock(id="s2")
+    failed.tasks.return_value = [
+        {"CreatedAt": CREATED_AT, "Status": {"State": "rejected", "Err": "no space"}}
+    ]
+    running.client.events.return_value.__iter__.return_value = iter([{"status": "start"}])
+
+    statuses = _wait_for_services([running, failed], timeout=10)
+    assert statuses["s1"] == {"State": "running"}
+    assert "no space" in str(statuses["s2"])
+    running.client.events.assert_called_once()